@@ -1,6 +1,10 @@
 import os
 import jwt
 import json
+import time
+import hmac
+import hashlib
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 from flask import Flask, request, jsonify, g, send_from_directory, Response
@@ -10,14 +14,31 @@ from flask_bcrypt import Bcrypt
 from werkzeug.utils import secure_filename
 
 from talk_agent import get_agent_and_checkpointer
+from talk_picture_worker import submit_talk_picture, is_picture_pending
+from job_queue import get_job_queue
+from post_talk_jobs import register_post_talk_jobs, job_key, MOMENT_JOB, DIARY_JOB
+from rolling_summary import register_summary_jobs
+from image_store import get_image_store
+from ttl_cache import TTLCache
+from app_logging import get_logger, fields, summarize
+from metrics import register_collector, flatten_stats, render as render_metrics
+from recall_cache import recall_metrics
+from context_builder import context_stats
+from get_memory import tag_cache
+from llm_cache import get_llm_cache
+from llm_router import get_router
+from base import DEFER_TALK_PICTURE, TALK_PICTURE_TIMEOUT, SHORT_MEMORY_WINDOW, SHORT_MEMORY_CAPACITY, \
+    MOMENT_INTERVAL, DIARY_INTERVAL, provider_registry
 
 picture_dir_name = 'talk_picture'
 if not os.path.exists(picture_dir_name):
     os.makedirs(picture_dir_name)
 from langchain_core.messages import HumanMessage, AIMessage
-from get_character_full_data import get_db, SimpleDatabase
+from get_character_full_data import get_db, SimpleDatabase, FTS_SOURCES
 import re
 
+logger = get_logger(__name__)
+
 # --- 应用和数据库配置 ---
 app = Flask(__name__, static_folder='static', static_url_path='')
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -25,7 +46,19 @@ app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'ap
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'a_very_secret_key_that_should_be_changed' ##需要修改
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'uploads')
+app.config['STREAM_TOKENS'] = True  # 是否通过 text_delta 事件逐字推送回复
+app.config['METRICS_ENABLED'] = False  # 是否开放 /metrics 指标端点
+app.config['METRICS_TOKEN'] = ''       # 设置后抓取方需带 Authorization: Bearer <令牌>；为空时只允许本机访问
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+HISTORY_PAGE_SIZE = 50       # 聊天记录分页的默认每页条数
+HISTORY_MAX_PAGE_SIZE = 200  # 单页最多条数
+SEARCH_PAGE_SIZE = 20        # 全文检索默认返回条数
+IMAGE_LIST_WIDTH = 768       # 聊天记录/朋友圈中图片请求的显示宽度（像素），图片路由据此返回缩略图
+IMAGE_TOKEN_WINDOW = 3600    # 图片访问签名的过期时间按该秒数对齐，窗口内图片 URL 保持不变
+AUTH_CACHE_TTL = 60          # 令牌解码结果、用户和角色归属在进程内缓存的秒数
+AUTH_CACHE_SIZE = 4096       # 每类缓存最多保留的条目数
+IMAGE_CACHE_MAX_AGE = 3600   # 图片响应的浏览器缓存秒数（不超过令牌有效期）
+IMAGE_LIST_REFRESH_INTERVAL = 10  # 请求的图片不在会话图片缓存中时，距上次加载至少该秒数才重新查询
 
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
@@ -33,6 +66,17 @@ if not os.path.exists(app.config['UPLOAD_FOLDER']):
 db = SQLAlchemy(app)
 bcrypt = Bcrypt(app)
 
+# 朋友圈/日记的后台任务队列。工作线程在第一个请求到来时才启动，
+# 这样 debug 模式下负责重载的父进程不会和子进程抢任务。
+job_queue = get_job_queue()
+register_post_talk_jobs(job_queue)
+register_summary_jobs(job_queue)
+
+
+@app.before_request
+def ensure_job_workers():
+    job_queue.start()
+
 
 # --- 数据库模型 (用于用户/角色的SQLAlchemy) ---
 class User(db.Model):
@@ -60,12 +104,92 @@ class Character(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
 
-def get_true_filename(image_path,user_id):
+# 令牌 -> 用户 id；用户 id -> CurrentUser；用户 id -> {角色 id: OwnedCharacter}；会话 id -> (加载时间, 图片路径集合)
+_token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_user_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_characters_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_conversation_images_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """缓存的当前用户。不缓存 ORM 实例：请求结束后它会脱离会话，下次访问属性时报错。"""
+    id: int
+    username: str
+
+
+@dataclass(frozen=True)
+class OwnedCharacter:
+    """缓存的角色信息，字段与 Character 模型一致。"""
+    id: int
+    name: str
+    description: str
+    first_talk: str
+    avatar_path: str | None
+
+
+def get_owned_characters(user_id):
+    """用户的全部角色（按 id 索引），一次查询后缓存，创建角色时失效。"""
+    characters = _characters_cache.get(user_id)
+    if characters is None:
+        characters = {c.id: OwnedCharacter(c.id, c.name, c.description, c.first_talk, c.avatar_path)
+                      for c in Character.query.filter_by(user_id=user_id).order_by(Character.id).all()}
+        _characters_cache.set(user_id, characters)
+    return characters
+
+
+def get_owned_character(character_id, user_id):
+    """返回用户拥有的角色，不存在或无权访问时返回 None。"""
+    try:
+        character_id = int(character_id)
+    except (TypeError, ValueError):
+        return None
+    return get_owned_characters(user_id).get(character_id)
+
+
+def image_scope(conversation_id):
+    """
+    为一次列表响应生成会话范围的图片访问签名（查询参数串），列表中的所有图片共用。
+    过期时间按 IMAGE_TOKEN_WINDOW 对齐，同一窗口内同一会话的签名（即图片 URL）不变，浏览器缓存才能命中；
+    有效期在 10 分钟到 10 分钟 + 一个窗口之间。
+    """
+    window = IMAGE_TOKEN_WINDOW
+    expires = (int(time.time()) // window + 1) * window + 600
+    return f"c={conversation_id}&e={expires}&sig={_image_signature(conversation_id, expires)}"
+
+
+def _image_signature(conversation_id, expires):
+    message = f"picture:{conversation_id}:{expires}".encode('utf-8')
+    return hmac.new(app.config['SECRET_KEY'].encode('utf-8'), message, hashlib.sha256).hexdigest()[:32]
+
+
+def get_conversation_images(conversation_id, refresh=False):
+    """
+    会话中出现过的图片路径集合（统一为正斜杠），用于校验签名范围内的图片请求。
+    refresh=True 时只有缓存加载超过 IMAGE_LIST_REFRESH_INTERVAL 秒才重新查询，
+    请求不存在或不属于该会话的路径不会每次都触发查询；本进程写入新图片时由 invalidate_conversation_images 失效。
+    """
+    entry = _conversation_images_cache.get(conversation_id)
+    if entry is None or (refresh and time.monotonic() - entry[0] >= IMAGE_LIST_REFRESH_INTERVAL):
+        images = frozenset(path for path in map(extract_path, get_db().get_image_urls(conversation_id)) if path)
+        entry = (time.monotonic(), images)
+        _conversation_images_cache.set(conversation_id, entry)
+    return entry[1]
+
+
+def invalidate_conversation_images(conversation_id):
+    """会话有新图片时丢弃其图片路径缓存，下一次图片请求重新加载。"""
+    _conversation_images_cache.pop(conversation_id)
+
+
+def get_true_filename(image_path,conversation_id,width=IMAGE_LIST_WIDTH,scope=None):
     # 检查image_path是否为None
     if image_path is None:
         return ""
-    temp_token = generate_temp_access_token(user_id, image_path)
-    return "/picture/{a}?token={temp_token}".format(a=image_path.replace('\\', '/'), temp_token=temp_token)
+    scope = scope or image_scope(conversation_id)
+    url = "/picture/{a}?{scope}".format(a=image_path.replace('\\', '/'), scope=scope)
+    # w 为需要的显示宽度，图片路由据此返回不小于该宽度的最小缩略图
+    return f"{url}&w={width}" if width else url
 
 
 # --- 认证与辅助函数 ---
@@ -82,9 +206,18 @@ def token_required(f):
 
         if not token: return jsonify({'message': '令牌缺失!'}), 401
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = User.query.get(data['user_id'])
-            if not current_user: return jsonify({'message': '用户未找到!'}), 401
+            # 解码结果缓存到令牌过期为止（最多 AUTH_CACHE_TTL 秒），热路径上不再重复验签
+            user_id = _token_cache.get(token)
+            if user_id is None:
+                data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+                user_id = data['user_id']
+                _token_cache.set(token, user_id, data['exp'] - time.time() if 'exp' in data else None)
+            current_user = _user_cache.get(user_id)
+            if current_user is None:
+                user = User.query.get(user_id)
+                if not user: return jsonify({'message': '用户未找到!'}), 401
+                current_user = CurrentUser(user.id, user.username)
+                _user_cache.set(user_id, current_user)
             g.current_user = current_user
         except (jwt.ExpiredSignatureError, jwt.InvalidTokenError) as e:
             return jsonify({'message': f'令牌无效或已过期! {e}'}), 401
@@ -93,14 +226,6 @@ def token_required(f):
     return decorated
 
 
-def generate_temp_access_token(user_id, filename):
-    # 确保文件名使用网络友好的正斜杠
-    normalized_filename = filename.replace('\\', '/')
-    payload = {'user_id': user_id, 'filename': normalized_filename,
-               'exp': datetime.now(timezone.utc) + timedelta(minutes=10)}
-    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm="HS256")
-
-
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -123,25 +248,46 @@ def serve_secure_file(filename):
 
 @app.route('/picture/<path:filename>')
 def serve_picture_file(filename):
+    conversation_id = request.args.get('c', '')
+    expires = request.args.get('e', type=int)
+    signature = request.args.get('sig', '')
     token = request.args.get('token')
-    if not token:
+    # 带 sig 的链接只按会话签名校验，缺少或无效的 e 直接拒绝，不回退到 token
+    if signature and expires is None:
+        return "访问令牌无效或已过期", 403
+    if not signature and not token:
         return "访问令牌缺失", 403
     try:
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-
-        # *** 核心修复：解决403错误 ***
-        # 规范化两个路径，使用正斜杠以便进行一致的比较
-        token_filename = payload.get('filename', '').replace('\\', '/')
+        # 规范化路径，使用正斜杠以便进行一致的比较
         requested_filename = filename.replace('\\', '/')
-
-        if token_filename != requested_filename:
-            print(f"访问被拒绝：令牌文件名 '{token_filename}' 与请求的文件名 '{requested_filename}' 不匹配")
-            return "令牌与文件不匹配", 403
-
-        # 假设代理将图片保存到基础目录中
-        return send_from_directory(basedir, filename)
+        if signature:
+            # 会话范围签名：校验签名与有效期，再确认图片确实属于该会话（新图片不在缓存中时按间隔重新加载）
+            if expires < time.time() or not hmac.compare_digest(signature, _image_signature(conversation_id, expires)):
+                return "访问令牌无效或已过期", 403
+            if requested_filename not in get_conversation_images(conversation_id) and \
+                    requested_filename not in get_conversation_images(conversation_id, refresh=True):
+                logger.warning("访问被拒绝：图片 '%s' 不属于会话 '%s'", requested_filename, conversation_id)
+                return "令牌与文件不匹配", 403
+        else:
+            # 兼容旧版按图片签发的 JWT 链接（已保存的聊天记录/前端缓存中仍可能存在），令牌只对应单张图片
+            payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            token_filename = payload.get('filename', '').replace('\\', '/')
+            if token_filename != requested_filename:
+                logger.warning("访问被拒绝：令牌文件名 '%s' 与请求的文件名 '%s' 不匹配", token_filename, requested_filename)
+                return "令牌与文件不匹配", 403
+
+        # 内容寻址的图片按 w 参数选择缩略图；文件内容永不改变，可长期缓存，条件请求直接返回 304
+        width = request.args.get('w', type=int)
+        path, etag = get_image_store().resolve(requested_filename, width)
+        response = send_from_directory(basedir, path, etag=etag or True, conditional=True,
+                                       max_age=IMAGE_CACHE_MAX_AGE)
+        response.cache_control.public = False
+        response.cache_control.private = True
+        if etag:
+            response.cache_control.immutable = True
+        return response
     except (jwt.ExpiredSignatureError, jwt.InvalidTokenError) as e:
-        print(f"令牌错误，文件名 {filename}: {e}")
+        logger.warning("令牌错误，文件名 %s: %s", filename, e)
         return "访问令牌无效或已过期", 403
 
 
@@ -186,7 +332,7 @@ def get_characters():
     auth_header = request.headers.get('Authorization')
     token = auth_header.split(" ")[1] if auth_header else request.args.get('token')
 
-    characters = Character.query.filter_by(user_id=g.current_user.id).all()
+    characters = get_owned_characters(g.current_user.id).values()
     char_list = [{
         'id': char.id,
         'name': char.name,
@@ -221,6 +367,8 @@ def create_character():
     )
     db.session.add(new_char)
     db.session.commit()
+    # 角色列表与归属缓存失效
+    _characters_cache.pop(g.current_user.id)
 
     app_db = get_db()
     conversation_id = f"char_{new_char.id}_chat"
@@ -265,33 +413,39 @@ def start_talk():
 
     text = data.get('text')
     character_id = data.get('character_id')
-    character = Character.query.filter_by(id=character_id, user_id=user.id).first()
+    character = get_owned_character(character_id, user.id)
     if not character:
         return jsonify({'message': '角色未找到或您无权访问'}), 404
 
+    stream_tokens = app.config['STREAM_TOKENS']
+
     # 这个生成器函数将被执行并以流的形式发送给客户端。
     def event_stream():
         app_db = None
+        request_start = time.perf_counter()
         try:
             app_db = SimpleDatabase()
             agent, checkpointer = get_agent_and_checkpointer()
             conversation_id = f"char_{character_id}_chat"
             generate_id = f"char_{character_id}_text"  # 用于朋友圈/日记
             # 首先将用户的消息添加到我们的数据库中
-            app_db.add_chat_message(conversation_id, 'human', text)
+            human_message_id = app_db.add_chat_message(conversation_id, 'human', text)
+            yield sse_format({'type': 'user_message', 'message_id': human_message_id})
 
             thread_config = {"configurable": {"thread_id": conversation_id}}
             # 从检查点获取对话的当前状态
             # 使用同步的 get_state 方法
             state = agent.get_state(thread_config).values
 
-            print(f"开始对话，角色ID: {character_id}, 姓名: {character.name}")
-            print("当前状态:", state)
+            logger.info("开始对话", extra=fields(character_id=character_id, name=character.name))
+            # 状态包含数百条消息，只在 DEBUG 级别输出各字段的条目数和字节数
+            logger.debug("当前状态: %s", summarize(state))
             # 为代理准备输入
             if not state:
-                all_message = app_db.get_chat_history(conversation_id)
-                if len(all_message) == 0:
-                    print('新建聊天')
+                # 检查点丢失时只按索引统计条数并读取末尾 SHORT_MEMORY_WINDOW 条，更早的内容已在滚动摘要中
+                message_count = app_db.count_chat_messages(conversation_id)
+                if message_count == 0:
+                    logger.info('新建聊天', extra=fields(conversation_id=conversation_id))
                     # 这是用户在此对话中的第一条消息
                     input_data = {
                         'short_messages': [AIMessage(content=character.first_talk), HumanMessage(content=text)],
@@ -300,49 +454,95 @@ def start_talk():
                         'character_profile': character.description,
                         'user_id': conversation_id
                     }
-                elif len(all_message) <= 400:
-                    print('聊天内容过短,全部读取')
-                    input_data = {
-                        'short_messages': all_message,
-                        'page': 'get_long_message',
-                        'character_name': character.name,
-                        'character_profile': character.description,
-                        'user_id': conversation_id,
-                        'talk_number': int(len(all_message) / 2)-4,
-                    }
-                    print(input_data)
                 else:
-                    num =int( len(all_message) / 2)
-                    num = num % 80
-                    print('聊天内容过长,只读取最后400条')
+                    # 没超过短期记忆容量时全部读回，否则只读窗口内的部分（更早的由 op_memory 折叠进摘要）；
+                    # 一轮对话两条消息，轮数按日记周期取余，朋友圈/日记的触发节奏与检查点丢失前一致
+                    if message_count <= SHORT_MEMORY_CAPACITY:
+                        logger.info('检查点缺失，聊天内容较短，全部读取', extra=fields(messages=message_count))
+                        limit = message_count
+                    else:
+                        logger.info('检查点缺失，聊天内容过长，只读取最后 %d 条', SHORT_MEMORY_WINDOW,
+                                    extra=fields(messages=message_count))
+                        limit = SHORT_MEMORY_WINDOW
                     input_data = {
-                        'short_messages': all_message[-400:],
+                        'short_messages': app_db.get_recent_messages(conversation_id, limit),
                         'page': 'get_long_message',
                         'character_name': character.name,
                         'character_profile': character.description,
                         'user_id': conversation_id,
-                        'talk_number': num
+                        'talk_number': (message_count // 2) % DIARY_INTERVAL,
                     }
             else:
-                print("找到历史记录，追加新消息。")
+                logger.debug("找到历史记录，追加新消息。")
                 input_data = state
                 input_data['short_messages'].append(HumanMessage(content=text))
                 input_data['page'] = 'get_long_message'
                 input_data['character_name'] = character.name
                 input_data['character_profile'] = character.description
 
-            print("给代理的输入:", input_data)
-
+            logger.debug("给代理的输入: %s", summarize(input_data))
+
+            def queue_post_talk_jobs(talk_number):
+                """
+                AI 回复落库后立即把朋友圈/日记任务写入持久化队列，返回要推送给前端的事件。
+                不等待配图和 done，客户端中途断开也不会丢任务。
+                """
+                job_payload = {
+                    'conversation_id': conversation_id,
+                    'generate_id': generate_id,
+                    'character_name': character.name,
+                    'character_profile': character.description,
+                    'talk_number': talk_number,
+                }
+                events = []
+                # 检查是否生成朋友圈动态
+                if 0 < talk_number < DIARY_INTERVAL and talk_number % MOMENT_INTERVAL == 0:
+                    key = job_key(MOMENT_JOB, conversation_id, talk_number, human_message_id)
+                    job_id = job_queue.enqueue(MOMENT_JOB, dict(job_payload, job_key=key), key)
+                    events.append(sse_format({'type': 'event', 'event_name': 'moment_job_queued', 'job_id': job_id}))
+                # 检查是否生成日记
+                if talk_number == DIARY_INTERVAL:
+                    key = job_key(DIARY_JOB, conversation_id, talk_number, human_message_id)
+                    job_id = job_queue.enqueue(DIARY_JOB, dict(job_payload, job_key=key), key)
+                    events.append(sse_format({'type': 'event', 'event_name': 'diary_job_queued', 'job_id': job_id}))
+                return events
 
             ai_full_message = ''
+            talk_number = 0
+            ai_message_id = None
+            picture_future = None
+            first_delta_sent = False
+            # updates 用于拿到各节点的最终结果，custom 用于接收 generate_talk 推出的增量片段
+            stream_modes = ["updates", "custom"] if stream_tokens else ["updates"]
             # 使用同步的 agent.stream 方法
-            for chunk in agent.stream(input_data, thread_config, stream_mode="updates"):
+            for mode, chunk in agent.stream(input_data, thread_config, stream_mode=stream_modes):
+                if mode == "custom":
+                    if chunk.get('type') == 'text_delta':
+                        if not first_delta_sent:
+                            first_delta_sent = True
+                            logger.info("首字延迟(请求到首个 text_delta): %.0f ms",
+                                        (time.perf_counter() - request_start) * 1000)
+                        yield sse_format({'type': 'text_delta', 'content': chunk['content']})
+                    continue
+
+                if 'start_talk' in chunk:
+                    talk_number = chunk['start_talk'].get('talk_number', 0)
+
                 if 'generate_talk' in chunk:
                     messages = chunk['generate_talk'].get('short_messages', [])
                     if messages:
                         # 最后一条消息是AI的回复
                         ai_full_message = messages[-1].content
-                        yield sse_format({'type': 'text', 'content': ai_full_message})
+                        if DEFER_TALK_PICTURE:
+                            # 延迟配图模式：先落库文字回复，配图在后台生成后回写到这一行
+                            ai_message_id = app_db.add_chat_message(conversation_id=conversation_id, message_type='ai',
+                                                                    content=ai_full_message)
+                            picture_future = submit_talk_picture(ai_message_id, messages)
+                            job_events = queue_post_talk_jobs(talk_number)
+                            yield sse_format({'type': 'text', 'content': ai_full_message, 'message_id': ai_message_id})
+                            yield from job_events
+                        else:
+                            yield sse_format({'type': 'text', 'content': ai_full_message})
 
                 if 'generate_talk_picture' in chunk:
                     image_path = chunk['generate_talk_picture']['picture_path']
@@ -350,57 +550,36 @@ def start_talk():
                     if image_path:
                         image_url=get_true_filename(image_path,conversation_id)
                         # 在数据库中用图片URL更新AI消息
-                        app_db.add_chat_message(conversation_id=conversation_id, message_type='ai',
-                                                content=ai_full_message, image_url=image_path)
-                        yield sse_format({'type': 'image', 'url': image_url})
+                        ai_message_id = app_db.add_chat_message(conversation_id=conversation_id, message_type='ai',
+                                                                content=ai_full_message, image_url=image_path)
+                        invalidate_conversation_images(conversation_id)
+                        job_events = queue_post_talk_jobs(talk_number)
+                        yield sse_format({'type': 'image', 'url': image_url, 'message_id': ai_message_id})
                     else:
                         # 如果没有图片，只保存文本消息
-                        app_db.add_chat_message(conversation_id=conversation_id, message_type='ai',
-                                                content=ai_full_message, image_url='')
-                        yield sse_format({'type': 'image', 'url': ''})
+                        ai_message_id = app_db.add_chat_message(conversation_id=conversation_id, message_type='ai',
+                                                                content=ai_full_message, image_url='')
+                        job_events = queue_post_talk_jobs(talk_number)
+                        yield sse_format({'type': 'image', 'url': '', 'message_id': ai_message_id})
+                    yield from job_events
 
             yield sse_format({'type': 'done'})
-            # --- 对话后事件生成 (朋友圈、日记) ---
-            # 再次使用同步的 get_state 获取最终状态
-            final_state_result = agent.get_state(thread_config)
-            final_state = final_state_result.values if final_state_result else {}
-            talk_number = final_state.get('talk_number', 0)
-
-            # 检查是否生成朋友圈动态
-            if talk_number > 0 and talk_number < 80 and talk_number % 30 == 0:
-                moment_thread_config = {"configurable": {"thread_id": generate_id}}
-                final_state['page'] = 'generate_dynamic_condition'
-                moment_message = {}
-                # 使用同步流
-                for chunk in agent.stream(final_state, moment_thread_config, stream_mode="updates"):
-                    if 'generate_dynamic_condition' in chunk:
-                        moment_message = chunk['generate_dynamic_condition']['dynamic_condition']
-                    if 'generate_dynamic_condition_picture' in chunk:
-                        picture_paths = chunk['generate_dynamic_condition_picture']['dynamic_condition_picture_path']
-                        for k, v_path in zip(moment_message.keys(), picture_paths):
-                            # 在应用上下文中执行数据库操作
-                            with app.app_context():
-                                app_db.add_social_post(conversation_id, moment_message[k]['scheme'],
-                                                       moment_message[k]['label'], moment_message[k]['time'], v_path)
-                yield sse_format({'type': 'event', 'event_name': 'new_moment_available'})
-
-            # 检查是否生成日记
-            if talk_number == 80:
-                diary_thread_config = {"configurable": {"thread_id": generate_id}}
-                final_state['page'] = 'generate_diary'
-                # 使用同步流
-                for chunk in agent.stream(final_state, diary_thread_config, stream_mode="updates"):
-                    if 'generate_diary' in chunk:
-                        diary_content = chunk['generate_diary']['diary']
-                        # 在应用上下文中执行数据库操作
-                        with app.app_context():
-                            app_db.add_diary_entry(conversation_id, diary_content)
-                yield sse_format({'type': 'event', 'event_name': 'new_diary_available'})
+
+            # 延迟配图：等待后台任务完成后通过同一条 SSE 连接补发图片
+            if picture_future is not None:
+                try:
+                    image_path = picture_future.result(timeout=TALK_PICTURE_TIMEOUT)
+                except Exception as e:
+                    logger.warning("后台配图失败或超时，消息ID: %s: %s", ai_message_id, e)
+                    image_path = ''
+                image_url = ''
+                if image_path:
+                    image_url = get_true_filename(image_path, conversation_id)
+                    invalidate_conversation_images(conversation_id)
+                yield sse_format({'type': 'image', 'url': image_url, 'message_id': ai_message_id})
 
         except Exception as e:
-            print(f"事件流中发生错误: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("事件流中发生错误: %s", e)
             yield sse_format({'type': 'error', 'content': str(e)})
         finally:
             if app_db:
@@ -411,31 +590,120 @@ def start_talk():
 def extract_path(text):
     # 正则表达式模式
     # 注意在Python字符串中，'\'本身也需要转义，所以'\\'变成了'\\\\'
-    pattern = re.compile(r"(talk_picture[/\\]+.*?\.png)")
+    pattern = re.compile(r"(talk_picture[/\\]+.*?\.(?:png|webp))")
     match = pattern.search(text)
     if match:
         # 提取捕获组1的内容，并统一替换反斜杠为正斜杠
         return match.group(1).replace('\\', '/')
     else:
         return None
+def with_image_urls(history, conversation_id):
+    """把聊天记录中的图片路径替换为访问地址，整页共用一个会话范围的签名。"""
+    scope = image_scope(conversation_id)
+    for h in history:
+        if h['image_url']:
+            path = extract_path(h['image_url'])
+            h['image_url'] = get_true_filename(path, conversation_id, scope=scope)
+    return history
+
+
 @app.route('/api/characters/<int:character_id>/history', methods=['GET'])
 @token_required
 def get_chat_history(character_id):
-    character = Character.query.filter_by(id=character_id, user_id=g.current_user.id).first()
+    character = get_owned_character(character_id, g.current_user.id)
     if not character:
         return jsonify({'message': '角色未找到或无权访问'}), 404
 
     app_db = get_db()
     conversation_id = f"char_{character.id}_chat"
-    history = app_db.get_chat_history(conversation_id)
-    full_history=[]
-    for h in history:
-        if h['image_url']:
-            path = extract_path(h['image_url'])
-            img_url=get_true_filename( path,conversation_id)
-            h['image_url'] = img_url
-        full_history.append(h)
-    return jsonify(full_history)
+    # 参数无法转换为整数时 Flask 会返回 None，等同于未传
+    before_id = request.args.get('before_id', type=int)
+    since_id = request.args.get('since_id', type=int)
+    limit = request.args.get('limit', type=int)
+
+    # 未携带任何分页参数时保持旧行为：一次返回全部记录
+    if before_id is None and since_id is None and limit is None:
+        history = app_db.get_chat_history(conversation_id)
+        return jsonify(with_image_urls(history, conversation_id))
+
+    limit = max(1, min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE))
+    if since_id is not None:
+        # 增量同步：只返回 since_id 之后的新消息
+        history, has_more = app_db.get_chat_since(conversation_id, since_id, limit)
+    else:
+        # 键集分页：返回 before_id 之前最新的一页
+        history, has_more = app_db.get_chat_page(conversation_id, before_id, limit)
+    return jsonify({'messages': with_image_urls(history, conversation_id), 'has_more': has_more})
+
+
+@app.route('/api/characters/<int:character_id>/search', methods=['GET'])
+@token_required
+def search_character_content(character_id):
+    """全文检索一个角色的聊天记录、日记和朋友圈，按相关度排序。"""
+    character = get_owned_character(character_id, g.current_user.id)
+    if not character:
+        return jsonify({'message': '角色未找到或无权访问'}), 404
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'message': '缺少检索关键词 q'}), 400
+    kinds = [k for k in (request.args.get('kinds') or 'chat,diary,moment').split(',') if k in FTS_SOURCES]
+    limit = max(1, min(request.args.get('limit', type=int) or SEARCH_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE))
+
+    app_db = get_db()
+    conversation_id = f"char_{character.id}_chat"
+    start = time.perf_counter()
+    results = app_db.search(conversation_id, query, kinds, limit)
+    scope = image_scope(conversation_id)
+    for r in results:
+        if r.get('image_url'):
+            path = extract_path(r['image_url'])
+            r['image_url'] = get_true_filename(path, conversation_id, scope=scope) if path else ''
+    return jsonify({'results': results, 'took_ms': round((time.perf_counter() - start) * 1000, 2)})
+
+
+@app.route('/api/messages/<int:message_id>/image', methods=['GET'])
+@token_required
+def get_message_image(message_id):
+    """轮询某条 AI 消息的后台配图状态：pending / ready / none。"""
+    app_db = get_db()
+    message = app_db.get_chat_message(message_id)
+    if not message:
+        return jsonify({'message': '消息不存在'}), 404
+    match = re.fullmatch(r"char_(\d+)_chat", message['conversation_id'])
+    character = get_owned_character(match.group(1), g.current_user.id) if match else None
+    if not character:
+        return jsonify({'message': '角色未找到或无权访问'}), 404
+
+    if is_picture_pending(message_id):
+        return jsonify({'message_id': message_id, 'status': 'pending', 'url': ''})
+    path = extract_path(message['image_url']) if message['image_url'] else None
+    if path:
+        return jsonify({'message_id': message_id, 'status': 'ready',
+                        'url': get_true_filename(path, message['conversation_id'])})
+    return jsonify({'message_id': message_id, 'status': 'none', 'url': ''})
+
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+@token_required
+def get_job_status(job_id):
+    """查询朋友圈/日记后台任务的状态。"""
+    job = job_queue.get_job(job_id)
+    conversation_id = job['payload'].get('conversation_id', '') if job else ''
+    match = re.fullmatch(r"char_(\d+)_chat", conversation_id)
+    character = get_owned_character(match.group(1), g.current_user.id) if match else None
+    if not character:
+        return jsonify({'message': '任务不存在或无权访问'}), 404
+    return jsonify({
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'last_error': job['last_error'],
+        'result': job['result'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    })
 
 
 @app.route('/api/get_dynamic_text', methods=['GET'])
@@ -443,19 +711,19 @@ def get_chat_history(character_id):
 def get_dynamic_text():
     app_db = get_db()
     character_id = request.args.get('character_id')
-    print(character_id)
     if not character_id: return jsonify({'message': '缺少角色ID'}), 400
-    character = Character.query.filter_by(id=character_id, user_id=g.current_user.id).first()
+    character = get_owned_character(character_id, g.current_user.id)
     if not character: return jsonify({'message': '角色未找到或无权访问'}), 404
     character_db_id = f"char_{character.id}_chat"
     full_data = app_db.get_all_social_posts(character_db_id)
     full_history = []
+    scope = image_scope(character_db_id)
     for h in full_data:
         if h['image_url']:
             path = extract_path(h['image_url'])
             # 检查path是否为None
             if path is not None:
-                img_url = get_true_filename(path,character_db_id)
+                img_url = get_true_filename(path,character_db_id,scope=scope)
                 h['image_url'] = img_url
             else:
                 h['image_url'] = ""
@@ -469,13 +737,60 @@ def get_diary():
     app_db = get_db()
     character_id = request.args.get('character_id')
     if not character_id: return jsonify({'message': '缺少角色ID'}), 400
-    character = Character.query.filter_by(id=character_id, user_id=g.current_user.id).first()
+    character = get_owned_character(character_id, g.current_user.id)
     if not character: return jsonify({'message': '角色未找到或无权访问'}), 404
     character_db_id = f"char_{character.id}_chat"
     full_data = app_db.get_all_diaries(character_db_id)
     return jsonify(full_data)
 
 
+# --- 指标 ---
+def _register_metric_collectors():
+    """把各模块已有的统计注册为 /metrics 中的 gauge，抓取时才读取。"""
+    register_collector('recall_cache', '召回缓存占用（会话数、条目数、token 数、字符数）',
+                       lambda: {(('field', k),): v for k, v in recall_metrics().items()})
+    register_collector('context_builder', '各节点上下文累计调用次数、实际 token 数、原始渲染 token 数估计和节省的 token 数',
+                       lambda: flatten_stats(context_stats(), 'node'))
+    register_collector('memory_tag_cache', '长期记忆标签缓存条目数与命中情况',
+                       lambda: {(('field', k),): v for k, v in tag_cache.stats().items()})
+    register_collector('llm_cache', 'LLM 响应缓存各节点的命中/未命中次数',
+                       lambda: flatten_stats(get_llm_cache().stats(), 'node'))
+    register_collector('llm_router', '各节点/模型的样本数、p50/p95 延迟（毫秒）和错误率',
+                       lambda: flatten_stats(get_router().stats(), 'route'))
+    register_collector('http_pool', '各服务商的请求数、新建连接数和连接复用率',
+                       lambda: flatten_stats(provider_registry.stats(), 'provider'))
+    register_collector('auth_cache', '认证相关进程内缓存的条目数与命中情况',
+                       lambda: flatten_stats({'token': _token_cache.stats(), 'user': _user_cache.stats(),
+                                              'characters': _characters_cache.stats(),
+                                              'conversation_images': _conversation_images_cache.stats()}, 'cache'))
+    register_collector('checkpointer', 'LangGraph 检查点热点缓存情况',
+                       lambda: {(('field', k),): v for k, v in checkpointer_stats().items()})
+
+
+def checkpointer_stats():
+    # 检查点在第一次对话时才创建，之前没有统计
+    from talk_agent import checkpointer
+    return checkpointer.stats() if checkpointer is not None else {}
+
+
+_register_metric_collectors()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的指标。只在 METRICS_ENABLED 时开放；配置了 METRICS_TOKEN 时校验令牌，否则只允许本机抓取。"""
+    if not app.config['METRICS_ENABLED']:
+        return "未启用", 404
+    expected = app.config['METRICS_TOKEN']
+    if expected:
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                   f'Bearer {expected}'.encode('utf-8')):
+            return "访问令牌无效", 403
+    elif request.remote_addr not in ('127.0.0.1', '::1'):
+        return "仅允许本机访问", 403
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 # --- 应用清理函数 ---
 @app.teardown_appcontext
 def close_connection(exception):
@@ -489,13 +804,15 @@ def close_connection(exception):
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
-        # 初始化DatabaseManager数据库，确保chat_memories表存在
+        # 初始化DatabaseManager数据库，确保记忆块与标签表存在
         from get_memory import DatabaseManager
 
 
         def init_db_manager():
             db_manager = DatabaseManager()
             db_manager.initialize()
+            # chat_data.db 的迁移同样在启动时执行一次，之后的请求不再检查表结构
+            SimpleDatabase().close()
 
 
         init_db_manager()
@@ -0,0 +1,144 @@
+# app_logging.py
+"""
+分级、惰性格式化的结构化日志。
+
+基于标准库 logging：
+- 每个模块通过 get_logger(__name__) 取得自己的 logger，级别可在 base.LOG_MODULE_LEVELS 中按模块单独配置；
+  热路径上的调试输出（完整状态、模型回复等）都在 DEBUG 级别，默认关闭。
+- 使用 logger.info('... %s', arg) 的参数形式，级别未启用时不会格式化参数；
+  summarize()/truncate() 返回惰性对象，只有在日志真正输出时才计算摘要。
+- 结构化字段通过 extra=fields(key=value) 传入，text 格式追加为 key=value，json 格式作为 JSON 字段。
+- base.LOG_SAMPLE_RATES 可以为高频模块的 DEBUG/INFO 日志设置采样率，WARNING 及以上从不采样丢弃。
+"""
+import json
+import logging
+import random
+import sys
+import threading
+
+from base import LOG_LEVEL, LOG_MODULE_LEVELS, LOG_FORMAT, LOG_SAMPLE_RATES, LOG_MAX_FIELD_CHARS
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class SamplingFilter(logging.Filter):
+    """按比例保留 WARNING 以下的日志。"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extra = getattr(record, 'fields', None)
+        if extra:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in extra.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in (getattr(record, 'fields', None) or {}).items():
+            entry[key] = value if isinstance(value, (int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging():
+    """安装根处理器和按模块的级别/采样配置。重复调用无副作用。"""
+    global _configured
+    if _configured:
+        return
+    with _configure_lock:
+        if _configured:
+            return
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        for name, level in LOG_MODULE_LEVELS.items():
+            logging.getLogger(name).setLevel(level)
+        for name, rate in LOG_SAMPLE_RATES.items():
+            logging.getLogger(name).addFilter(SamplingFilter(rate))
+        _configured = True
+
+
+def get_logger(name: str) -> logging.Logger:
+    configure_logging()
+    return logging.getLogger(name)
+
+
+def fields(**values) -> dict:
+    """结构化字段，用作 logger 调用的 extra 参数：logger.info('...', extra=fields(job_id=1))。"""
+    return {'fields': values}
+
+
+def _size(value) -> int:
+    """估算的字节数：字符串按 UTF-8，消息按内容，容器递归累加。"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return len(value)
+    if hasattr(value, 'content'):
+        return _size(value.content)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sum(_size(item) for item in value)
+    return len(str(value))
+
+
+def _describe(value) -> str:
+    if isinstance(value, (list, tuple, set)):
+        return f'{len(value)} items/{_size(value)}B'
+    if isinstance(value, dict):
+        return f'{len(value)} keys/{_size(value)}B'
+    if isinstance(value, str):
+        return f'{len(value)} chars' if len(value) > LOG_MAX_FIELD_CHARS else repr(value)
+    return str(truncate(value))
+
+
+class summarize:
+    """
+    状态/输入的惰性摘要：字典按键列出条目数和字节数，列表给出条目数和字节数，不输出内容本身。
+    只有日志被输出时才计算。
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self) -> str:
+        if isinstance(self.value, dict):
+            return '{' + ', '.join(f'{key}: {_describe(v)}' for key, v in self.value.items()) + '}'
+        return _describe(self.value)
+
+
+class truncate:
+    """惰性截断：输出时才把值转换为字符串并截断到 limit 个字符。"""
+
+    def __init__(self, value, limit: int = LOG_MAX_FIELD_CHARS):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = str(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f'{text[:self.limit]}…(+{len(text) - self.limit} chars)'
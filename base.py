@@ -2,10 +2,11 @@ from typing import TypedDict, List, Annotated
 from langchain_openai import ChatOpenAI
 from openai import AsyncOpenAI
 import api_key
+from providers import ProviderRegistry
 
 class State(TypedDict):
     short_messages: Annotated[list, "存储短期完整记忆"]
-    long_messages: Annotated[dict, "存储长期完整记忆"]
+    long_messages: Annotated[dict, "召回的长期记忆（recall_cache 维护的有界缓存）"]
     character_profile: Annotated[str, "角色描述"]
     character_name:Annotated[str, "角色名称"]
     diary:Annotated[str, "日记内容"]
@@ -15,6 +16,22 @@ class State(TypedDict):
     page:Annotated[str, "所处阶段"]
     talk_number:Annotated[int, "对话次数"]
     user_id:Annotated[str, "用户id"]
+    memory_key:Annotated[str, "记忆块来源键，后台任务重试时据此跳过已写入的记忆块"]
+
+# --- 模型服务商 HTTP 连接池（providers，每个服务商一个长连接池，文本模型与生图客户端共用参数） ---
+HTTP_POOL_SIZE = 20             # 单个服务商的最大并发连接数
+HTTP_POOL_KEEPALIVE = 10        # 单个服务商最多保留的空闲连接数
+HTTP_KEEPALIVE_EXPIRY = 60      # 空闲连接保留秒数
+HTTP_CONNECT_TIMEOUT = 10       # 建连超时秒数
+HTTP_READ_TIMEOUT = 120         # 读取超时秒数（流式回复为两个数据块之间的间隔）
+
+provider_registry = ProviderRegistry(
+    pool_size=HTTP_POOL_SIZE,
+    keepalive=HTTP_POOL_KEEPALIVE,
+    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+)
 
 llm_google = ChatOpenAI(
     base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
@@ -22,6 +39,8 @@ llm_google = ChatOpenAI(
     model="gemini-2.5-flash",
     temperature=0.6,
     streaming=True,
+    http_client=provider_registry.http_client('google'),
+    http_async_client=provider_registry.async_http_client('google'),
 )
 llm_google_pro = ChatOpenAI(
     base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
@@ -29,6 +48,8 @@ llm_google_pro = ChatOpenAI(
     model="gemini-2.5-pro",
     temperature=0.7,
     streaming=True,
+    http_client=provider_registry.http_client('google'),
+    http_async_client=provider_registry.async_http_client('google'),
 )
 
 llm_qwen=ChatOpenAI(
@@ -37,6 +58,8 @@ llm_qwen=ChatOpenAI(
     model="qwen-max-latest",
     temperature=0.5,
     streaming=True,
+    http_client=provider_registry.http_client('dashscope'),
+    http_async_client=provider_registry.async_http_client('dashscope'),
 )
 llm_kimi=ChatOpenAI(
     base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
@@ -44,6 +67,8 @@ llm_kimi=ChatOpenAI(
     model="Moonshot-Kimi-K2-Instruct",
     temperature=0.7,
     streaming=True,
+    http_client=provider_registry.http_client('dashscope'),
+    http_async_client=provider_registry.async_http_client('dashscope'),
 )
 llm=ChatOpenAI(
     base_url="https://api.deepseek.com",
@@ -51,4 +76,139 @@ llm=ChatOpenAI(
     model="deepseek-chat",
     temperature=0.7,
     streaming=True,
+    http_client=provider_registry.http_client('deepseek'),
+    http_async_client=provider_registry.async_http_client('deepseek'),
 ) ##deepseek_v3
+
+# --- 多模型路由（llm_router） ---
+MODELS = {
+    'gemini-flash': llm_google,
+    'gemini-pro': llm_google_pro,
+    'qwen': llm_qwen,
+    'kimi': llm_kimi,
+    'deepseek': llm,
+}
+NODE_MODEL_ROUTES = {   # 各节点可用的模型，第一个为首选，其余按顺序作为备选
+    'generate_talk': ['gemini-flash', 'deepseek', 'qwen'],
+    'decide_talk_picture': ['deepseek', 'gemini-flash'],
+    'generate_dynamic_condition_picture': ['gemini-pro', 'gemini-flash'],
+    'generate_diary': ['gemini-pro', 'deepseek', 'qwen'],
+    'generate_dynamic_condition': ['gemini-pro', 'deepseek', 'kimi'],
+    'storage_memory_block': ['gemini-flash', 'deepseek'],
+    'get_long_message': ['deepseek', 'gemini-flash'],
+    'fold_summary': ['deepseek', 'qwen'],
+    'default': ['deepseek', 'gemini-flash'],
+}
+ROUTER_HEDGE_AFTER = {   # 首选模型超过该秒数未返回时同时请求备选模型（未列出的节点不对冲）
+    'decide_talk_picture': 8,
+    'get_long_message': 6,
+}
+ROUTER_WINDOW = 100            # 每个模型保留的最近调用数，用于计算 p50/p95 和错误率
+ROUTER_MIN_SAMPLES = 5         # 样本数少于该值的模型视为健康
+ROUTER_SAMPLE_TTL = 300        # 只用最近这么多秒内的样本评估模型健康度
+ROUTER_SCORE_TOLERANCE = 1.5   # 首选模型得分不超过最优得分的这个倍数时仍使用首选
+ROUTER_ERROR_PENALTY = 4       # 得分 = p95 × (1 + 惩罚系数 × 错误率)
+ROUTER_BREAKER_FAILURES = 3    # 连续失败次数达到该值时熔断
+ROUTER_BREAKER_COOLDOWN = 30   # 熔断持续秒数，之后放行一次试探请求
+ROUTER_HEDGE_WORKERS = 8       # 对冲请求使用的线程数
+
+# --- 日志（app_logging） ---
+LOG_LEVEL = "INFO"     # 全局默认级别
+LOG_FORMAT = "text"    # text 或 json
+LOG_MODULE_LEVELS = {  # 按模块覆盖级别（logger 名即模块名）
+    'context_builder': 'WARNING',
+    'get_memory': 'WARNING',
+    'llm_cache': 'WARNING',
+}
+LOG_SAMPLE_RATES = {   # 高频模块 DEBUG/INFO 日志的采样率，WARNING 及以上始终输出
+    'llm_router': 0.2,
+}
+LOG_MAX_FIELD_CHARS = 200   # 日志中单个值（如模型回复）最多输出的字符数
+
+# --- 聊天配图 ---
+DEFER_TALK_PICTURE = True   # True 时配图在后台线程池中生成，文字回复不再等待配图
+TALK_PICTURE_WORKERS = 2    # 后台配图线程数
+TALK_PICTURE_TIMEOUT = 120  # SSE 连接等待后台配图的最长秒数
+
+# --- 图片存储（image_store，按内容哈希命名的 WebP 及缩略图） ---
+IMAGE_STORE_DIR = "talk_picture"
+IMAGE_STORE_DB = "image_store.db"
+IMAGE_WEBP_QUALITY = 82          # WebP 压缩质量
+IMAGE_THUMB_WIDTHS = (256, 768)  # 生成的缩略图宽度（像素），不大于原图宽度的才会生成
+
+# --- 生图限流（rate_limit，按服务商的令牌桶 + 并发上限，聊天配图与朋友圈配图共用） ---
+PROVIDER_RATE_LIMITS = {
+    'google': {'rate': 0.2, 'burst': 2, 'concurrency': 2},   # rate: 每秒补充的请求数
+    'default': {'rate': 1.0, 'burst': 2, 'concurrency': 2},
+}
+
+# --- 后台任务队列（朋友圈、日记） ---
+JOB_QUEUE_DB = "job_queue.db"
+JOB_QUEUE_WORKERS = 2   # 工作线程数
+JOB_MAX_ATTEMPTS = 3    # 单个任务最多尝试次数
+JOB_RETRY_DELAY = 30    # 首次重试等待秒数，之后指数退避
+JOB_LEASE_SECONDS = 120 # 领取任务的租约时长，执行期间由心跳续约；过期的 running 任务可被其他工作者重新领取
+
+# --- LangGraph 检查点 ---
+CHECKPOINT_DB = "checkpoints.db"
+CHECKPOINT_KEEP_LAST = 3       # 每个会话线程保留的检查点数量
+CHECKPOINT_HOT_THREADS = 128   # 内存中保留的活跃会话线程数量（LRU）
+
+# --- 消息与检查点的二进制编码（message_codec） ---
+CODEC_COMPRESSION = "zstd"     # zstd 或 zlib；未安装 zstandard 时自动使用 zlib
+CODEC_LEVEL = 3                # 压缩级别
+CODEC_MIN_COMPRESS = 256       # 小于该字节数的数据不压缩
+
+# --- 长期记忆 ---
+MEMORY_TAG_CACHE_SIZE = 1024   # 进程内标签缓存最多保留的会话数量（LRU）
+MEMORY_INDEX_DIR = "memory_index"   # 长期记忆本地向量索引目录（每个会话一个矩阵文件）
+MEMORY_INDEX_DIM = 4096             # 哈希向量维度
+MEMORY_INDEX_HOT = 64               # 内存中保留映射的会话数量（LRU）
+MEMORY_INDEX_THRESHOLD = 0.08       # 候选标签的最低相似度，全部低于该值时跳过 LLM 记忆路由
+MEMORY_INDEX_TOP_K = 5              # 交给 LLM 做最终判断的候选标签数量
+MEMORY_FTS_MIN_SCORE = 2.0          # 全文检索命中的记忆块作为候选的最低 BM25 相关度（取负后的分数）
+
+# --- Prompt 上下文预算（context_builder，单位: 本地估算的 token 数） ---
+CONTEXT_TOKEN_BUDGETS = {          # 近期聊天记录
+    'generate_talk': 4000,
+    'get_long_message': 1500,
+    'generate_diary': 8000,
+    'generate_dynamic_condition': 3000,
+    'storage_memory_block': 8000,
+    'fold_summary': 6000,
+}
+CONTEXT_REPR_OVERHEAD = 40         # 按 repr 渲染时每条消息除内容外的 token 数估计（类名、additional_kwargs、id 等），用于统计节省量
+LONG_MEMORY_TOKEN_BUDGETS = {      # 被唤起的长期记忆
+    'generate_talk': 2000,
+    'generate_diary': 2000,
+    'generate_dynamic_condition': 1500,
+}
+
+# --- LLM 响应缓存（llm_cache，只用于输出只取决于输入的分类类调用） ---
+LLM_CACHE_DB = "llm_cache.db"
+LLM_CACHE_MAX_ENTRIES = 20000   # 超过后淘汰最久未命中的条目
+NODE_CACHE_TTL = {              # 按节点开启缓存及其有效秒数，未列出的节点不缓存
+    'decide_talk_picture': 24 * 3600,
+    'get_long_message': 3600,
+    'storage_memory_block': 24 * 3600,
+}
+
+# --- 短期记忆与滚动摘要 ---
+SHORT_MEMORY_WINDOW = 120   # 短期记忆保留的消息条数
+SUMMARY_BATCH_SIZE = 40     # 超出窗口这么多条后，一次性移出并交给后台折叠进摘要
+SUMMARY_MAX_CHARS = 800     # 滚动摘要的目标最大字数
+SUMMARY_CACHE_TTL = 3600    # 进程内摘要缓存的有效秒数（save_summary 会直接更新缓存，TTL 只是兜底）
+# 短期记忆最多容纳的消息条数：达到该值时 op_memory 才把超出窗口的部分移出并折叠进摘要
+SHORT_MEMORY_CAPACITY = SHORT_MEMORY_WINDOW + SUMMARY_BATCH_SIZE
+
+# --- 对话后任务（朋友圈、日记） ---
+MOMENT_INTERVAL = 30   # 每隔多少轮对话生成一次朋友圈
+DIARY_INTERVAL = 80    # 每隔多少轮对话生成一次日记
+
+# --- 召回的长期记忆（图状态 long_messages） ---
+RECALL_MAX_ENTRIES = 4             # 最多同时保留的召回条目（按标签去重）
+RECALL_ENTRY_TOKEN_BUDGET = 1500   # 单个条目保留的 token 上限
+RECALL_TOKEN_BUDGET = 4000         # 所有条目的 token 总上限，超出时按最久未使用淘汰
+MEMORY_SNIPPET_WINDOW = 6          # 记忆片段检索的滑动窗口大小（消息条数）
+RECALL_USAGE_SIZE = 1024           # 召回占用统计最多跟踪的会话数（LRU）
+RECALL_USAGE_TTL = 3600            # 会话超过该秒数没有召回活动后不再计入占用统计
@@ -0,0 +1,142 @@
+# benchmarks/checkpointer_benchmark.py
+"""
+检查点存储基准：MemorySaver 与 BoundedSqliteSaver 的内存占用和单轮延迟对比。
+
+模拟 app.start_talk 的调用方式：每轮先 get_state，再把追加了用户消息的完整状态交给图执行。
+每种存储在独立子进程中运行，以便分别统计常驻内存（RSS）。
+
+用法:
+    python benchmarks/checkpointer_benchmark.py --conversations 10000 --turns 3 --output checkpointer.json
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import TypedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAVERS = ('memory', 'bounded_sqlite')
+
+
+class BenchState(TypedDict):
+    short_messages: list
+    talk_number: int
+
+
+def current_rss_mb() -> float:
+    """读取当前进程常驻内存（Linux 下读 /proc，其它平台退化为峰值）。"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def run_saver(saver_name: str, conversations: int, turns: int, history: int, window: int) -> dict:
+    from langchain_core.messages import AIMessage, HumanMessage
+    from langgraph.checkpoint.memory import MemorySaver
+    from langgraph.graph import StateGraph, START, END
+
+    from bounded_checkpointer import BoundedSqliteSaver
+
+    def reply(state: BenchState) -> dict:
+        messages = state['short_messages']
+        messages.append(AIMessage(content='（笑着看向你）今天也辛苦啦，晚饭想吃点什么？' * 2))
+        return {'short_messages': messages[-window:], 'talk_number': state.get('talk_number', 0) + 1}
+
+    db_dir = tempfile.mkdtemp(prefix='checkpointer_bench_')
+    db_path = os.path.join(db_dir, 'checkpoints.db')
+    saver = MemorySaver() if saver_name == 'memory' else BoundedSqliteSaver(db_path)
+
+    workflow = StateGraph(BenchState)
+    workflow.add_node('reply', reply)
+    workflow.add_edge(START, 'reply')
+    workflow.add_edge('reply', END)
+    graph = workflow.compile(checkpointer=saver)
+
+    seed = []
+    for i in range(history):
+        cls = HumanMessage if i % 2 else AIMessage
+        seed.append(cls(content=f'第{i}条消息：我们周末去海边散步吧，顺便看日落。'))
+
+    rss_before = current_rss_mb()
+    latencies = []
+    start = time.perf_counter()
+    for turn in range(turns):
+        for c in range(conversations):
+            config = {"configurable": {"thread_id": f"char_{c}_chat"}}
+            t0 = time.perf_counter()
+            state = graph.get_state(config).values
+            if not state:
+                state = {'short_messages': list(seed), 'talk_number': 0}
+            state['short_messages'].append(HumanMessage(content=f'第{turn}轮：你还记得上次说的事吗？'))
+            graph.invoke(state, config)
+            latencies.append((time.perf_counter() - t0) * 1000)
+    total = time.perf_counter() - start
+
+    result = {
+        'saver': saver_name,
+        'conversations': conversations,
+        'turns': turns,
+        'history': history,
+        'total_s': round(total, 2),
+        'turn_p50_ms': round(statistics.median(latencies), 3),
+        'turn_p95_ms': round(percentile(latencies, 0.95), 3),
+        'rss_growth_mb': round(current_rss_mb() - rss_before, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    if saver_name != 'memory':
+        result['disk_mb'] = round(sum(
+            os.path.getsize(os.path.join(db_dir, f)) for f in os.listdir(db_dir)) / 1024 / 1024, 1)
+        result.update(saver.stats())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=10000)
+    parser.add_argument('--turns', type=int, default=3)
+    parser.add_argument('--history', type=int, default=40, help='每个会话初始的消息条数')
+    parser.add_argument('--window', type=int, default=400, help='短期记忆窗口，与 op_memory 一致')
+    parser.add_argument('--saver', choices=SAVERS, help='只运行指定存储（内部用于子进程）')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    if args.saver:
+        print(json.dumps(run_saver(args.saver, args.conversations, args.turns, args.history, args.window)))
+        return
+
+    results = []
+    for saver_name in SAVERS:
+        cmd = [sys.executable, os.path.abspath(__file__), '--saver', saver_name,
+               '--conversations', str(args.conversations), '--turns', str(args.turns),
+               '--history', str(args.history), '--window', str(args.window)]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=ROOT).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    for r in results:
+        print(f"{r['saver']:>15}: p50 {r['turn_p50_ms']:.2f} ms, p95 {r['turn_p95_ms']:.2f} ms, "
+              f"RSS +{r['rss_growth_mb']} MB (peak {r['peak_rss_mb']} MB), total {r['total_s']} s"
+              + (f", disk {r['disk_mb']} MB" if 'disk_mb' in r else ''))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# benchmarks/db_endpoints_benchmark.py
+"""
+聊天记录 / 朋友圈接口的数据访问吞吐量（requests/sec）对比：改造前 vs 连接池。
+
+每个“请求”都按接口的实际流程执行：创建 SimpleDatabase（get_db）→ 查询 → close（teardown）。
+- legacy: 改造前的方式，每次新建连接并执行三条 CREATE TABLE IF NOT EXISTS 再提交；
+- pooled: 当前的方式，从 db_pool 借出已配置 WAL 的连接，迁移只在进程内检查一次。
+
+--thread-per-request 模拟 Flask 开发服务器每个请求一个新线程的情况。
+
+用法:
+    python benchmarks/db_endpoints_benchmark.py --messages 5000 --posts 300 --requests 2000 --output db_endpoints.json
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from get_character_full_data import SimpleDatabase, _create_chat_tables  # noqa: E402
+
+CONVERSATION_ID = 'char_1_chat'
+
+
+class LegacySimpleDatabase(SimpleDatabase):
+    """改造前的连接方式：每个实例独占一个新连接，并在构造时执行建表语句。"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.create_tables()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+    def create_tables(self):
+        _create_chat_tables(self.conn)
+        self.conn.commit()
+
+
+def seed(db_file: str, messages: int, posts: int):
+    conn = sqlite3.connect(db_file)
+    _create_chat_tables(conn)
+    conn.executemany(
+        "INSERT INTO chat_history (conversation_id, message_type, content, image_url) VALUES (?, ?, ?, ?)",
+        [(CONVERSATION_ID, 'human' if i % 2 else 'ai', f'第{i}条消息：今天晚上一起去看电影吧？' * 3,
+          'talk_picture/20250101000000.png' if i % 25 == 0 else None) for i in range(messages)]
+    )
+    conn.executemany(
+        "INSERT INTO social_posts (character_db_id, content, tags, post_time, image_url) VALUES (?, ?, ?, ?, ?)",
+        [(CONVERSATION_ID, f'第{i}条动态：窗外下雨了。', '日常,雨天', f'今天 {i % 24:02d}:00', '')
+         for i in range(posts)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def endpoint_history(app_db):
+    app_db.get_chat_page(CONVERSATION_ID, None, 50)
+
+
+def endpoint_moments(app_db):
+    app_db.get_all_social_posts(CONVERSATION_ID)
+
+
+def measure(db_cls, db_file: str, endpoint, requests: int, thread_per_request: bool) -> float:
+    def handle():
+        app_db = db_cls(db_file)
+        try:
+            endpoint(app_db)
+        finally:
+            app_db.close()
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        if thread_per_request:
+            thread = threading.Thread(target=handle)
+            thread.start()
+            thread.join()
+        else:
+            handle()
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--posts', type=int, default=300)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--thread-per-request', action='store_true')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='db_endpoints_bench_')
+    files = {'legacy': os.path.join(work_dir, 'legacy.db'), 'pooled': os.path.join(work_dir, 'pooled.db')}
+    for db_file in files.values():
+        seed(db_file, args.messages, args.posts)
+
+    results = []
+    for endpoint_name, endpoint in (('history', endpoint_history), ('moments', endpoint_moments)):
+        row = {'endpoint': endpoint_name}
+        for mode, db_cls in (('legacy', LegacySimpleDatabase), ('pooled', SimpleDatabase)):
+            row[f'{mode}_rps'] = round(measure(db_cls, files[mode], endpoint, args.requests,
+                                               args.thread_per_request), 1)
+        row['speedup'] = round(row['pooled_rps'] / row['legacy_rps'], 2)
+        results.append(row)
+        print(f"{endpoint_name:>8}: legacy {row['legacy_rps']:>9.1f} req/s  "
+              f"pooled {row['pooled_rps']:>9.1f} req/s  x{row['speedup']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
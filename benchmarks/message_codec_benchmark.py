@@ -0,0 +1,157 @@
+# benchmarks/message_codec_benchmark.py
+"""
+记忆块与检查点编码基准：langchain JSON（改造前）vs message_codec 二进制编码。
+
+生成一个接近真实聊天的消息语料（默认 10000 条，人类/AI 交替，长短不一，部分 AI 消息带图片引用），
+按 storage_memory_block 的方式每 --block-size 条切成一个记忆块，分别统计：
+- 编码 / 解码全部记忆块的耗时；
+- 编码后的总字节数，以及写入 SQLite（与 memory_blocks 同结构）并 VACUUM 后的文件大小；
+- 检查点：包含 SHORT_MEMORY_WINDOW 条消息的状态经 JsonPlusSerializer 与 CompactSerializer 序列化的大小和耗时。
+
+用法:
+    python benchmarks/message_codec_benchmark.py --messages 10000 --block-size 100 --output message_codec.json
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from langchain_core.load import dumps, loads  # noqa: E402
+from langchain_core.messages import AIMessage, HumanMessage  # noqa: E402
+
+import message_codec  # noqa: E402
+from message_codec import CompactSerializer, decode_messages, encode_messages  # noqa: E402
+
+PHRASES = [
+    '今天下班路上下起了小雨', '我把伞借给了一个陌生人', '晚饭想吃点热乎的东西', '（轻轻笑了一下）你总是这样',
+    '周末要不要一起去海边看日落', '最近工作有点累，但是还好', '那家咖啡店的拿铁真的很好喝', '我昨天梦到我们去旅行了',
+    '你还记得我们第一次见面吗', '（歪着头看你）你在想什么呢', '我养的猫今天又打翻了水杯', '明天早上要早起开会',
+    '这首歌我循环了一整天', '其实我一直想学做甜点', '外面的风好大，窗户都在响', '你说的那本书我已经看完了',
+]
+# 常用汉字，用来在固定短语之间插入随机片段，避免语料过度重复而高估压缩率
+COMMON_CHARS = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面'
+                '而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好'
+                '应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道'
+                '命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长')
+
+
+def _noise(rng: random.Random) -> str:
+    return ''.join(rng.choice(COMMON_CHARS) for _ in range(rng.randint(2, 8)))
+
+
+def build_corpus(count: int, seed: int = 7) -> list:
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        text = '，'.join(rng.choice(PHRASES) + _noise(rng) for _ in range(rng.randint(1, 12))) + rng.choice('。！？~')
+        if i % 2:
+            extra = {message_codec.IMAGE_KEY: f'talk_picture/{rng.getrandbits(128):032x}.webp'} if i % 40 == 1 else {}
+            messages.append(AIMessage(content=text, additional_kwargs=extra))
+        else:
+            messages.append(HumanMessage(content=text))
+    return messages
+
+
+def disk_size(blobs: list) -> int:
+    """按 memory_blocks 的结构写入临时数据库，VACUUM 后返回文件大小。"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE memory_blocks (id INTEGER PRIMARY KEY, uuid TEXT, memory_content TEXT)")
+        conn.executemany("INSERT INTO memory_blocks (uuid, memory_content) VALUES (?, ?)",
+                         [('char_1_chat', blob) for blob in blobs])
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.close()
+        return os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+
+def bench_format(name: str, blocks: list, encode, decode, rounds: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        blobs = [encode(block) for block in blocks]
+    encode_s = (time.perf_counter() - start) / rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        decoded = [decode(blob) for blob in blobs]
+    decode_s = (time.perf_counter() - start) / rounds
+    assert decoded == blocks, f'{name}: 解码结果与原消息不一致'
+    total = sum(len(blob.encode('utf-8') if isinstance(blob, str) else blob) for blob in blobs)
+    return {
+        'format': name,
+        'encode_ms': round(encode_s * 1000, 2),
+        'decode_ms': round(decode_s * 1000, 2),
+        'bytes': total,
+        'disk_bytes': disk_size(blobs),
+    }
+
+
+def bench_checkpoint(messages: list, rounds: int) -> list:
+    from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+    state = {'short_messages': messages, 'talk_number': 42, 'page': 'get_long_message'}
+    results = []
+    for name, serde in (('jsonplus', JsonPlusSerializer()), ('compact', CompactSerializer())):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            typed = serde.dumps_typed(state)
+        dumps_s = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            loaded = serde.loads_typed(typed)
+        loads_s = (time.perf_counter() - start) / rounds
+        assert loaded['short_messages'] == messages
+        results.append({'serde': name, 'type': typed[0], 'bytes': len(typed[1]),
+                        'dumps_ms': round(dumps_s * 1000, 3), 'loads_ms': round(loads_s * 1000, 3)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--block-size', type=int, default=100, help='每个记忆块的消息条数，与 storage_memory_block 一致')
+    parser.add_argument('--window', type=int, default=120, help='检查点中的短期记忆条数')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages)
+    blocks = [corpus[i:i + args.block_size] for i in range(0, len(corpus), args.block_size)]
+
+    formats = [('legacy_json', dumps, loads),
+               ('codec_raw', lambda b: encode_messages(b, message_codec.RAW), decode_messages),
+               ('codec_zlib', lambda b: encode_messages(b, message_codec.ZLIB), decode_messages)]
+    if message_codec.zstandard is not None:
+        formats.append(('codec_zstd', lambda b: encode_messages(b, message_codec.ZSTD), decode_messages))
+    results = {
+        'messages': args.messages,
+        'blocks': len(blocks),
+        'memory_blocks': [bench_format(name, blocks, enc, dec, args.rounds) for name, enc, dec in formats],
+        'checkpoint': bench_checkpoint(corpus[-args.window:], args.rounds * 10),
+    }
+
+    baseline = results['memory_blocks'][0]
+    for r in results['memory_blocks']:
+        print(f"{r['format']:>12}: encode {r['encode_ms']:.1f} ms, decode {r['decode_ms']:.1f} ms, "
+              f"{r['bytes'] / 1024:.0f} KiB ({r['bytes'] / baseline['bytes']:.0%}), "
+              f"disk {r['disk_bytes'] / 1024:.0f} KiB")
+    for r in results['checkpoint']:
+        print(f"{'checkpoint ' + r['serde']:>20}: {r['bytes'] / 1024:.1f} KiB, "
+              f"dumps {r['dumps_ms']:.2f} ms, loads {r['loads_ms']:.2f} ms")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# benchmarks/storage_benchmark.py
+"""
+存储层离线基准：在不同数据规模下测量 SimpleDatabase 与 DatabaseManager 各方法的延迟。
+
+全部数据离线合成，不调用任何模型：
+- 聊天库：按 --chat-sizes 的每个规模生成 chat_history 行（分摊到 --conversations 个会话），
+  并按比例生成朋友圈动态和日记，然后测量 add_chat_message / get_chat_history /
+  get_all_social_posts / get_all_diaries；
+- 记忆库：按 --tag-sizes 的每个规模为一个会话写入记忆块（每块关联 1~3 个标签，直到标签数达到规模），
+  然后测量 add_memory / get_memory / get_all_tags（标签缓存命中）/ get_all_tags_cold（每次先清空标签缓存）。
+
+每个规模使用独立的临时目录和数据库文件，写入走与线上相同的连接池、迁移和全文索引触发器。
+结果写成 JSON（--output），用于在存储改动合入前对比回归。
+
+用法:
+    python benchmarks/storage_benchmark.py --chat-sizes 10000,100000,1000000 --tag-sizes 100,1000,5000 --output storage.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from langchain_core.messages import AIMessage, HumanMessage  # noqa: E402
+
+from db_pool import get_pool  # noqa: E402
+from get_character_full_data import SimpleDatabase  # noqa: E402
+from get_memory import DatabaseManager, tag_cache  # noqa: E402
+
+PHRASES = [
+    '今天下班路上下起了小雨', '我把伞借给了一个陌生人', '晚饭想吃点热乎的东西', '（轻轻笑了一下）你总是这样',
+    '周末要不要一起去海边看日落', '最近工作有点累，但是还好', '那家咖啡店的拿铁真的很好喝', '我昨天梦到我们去旅行了',
+    '你还记得我们第一次见面吗', '（歪着头看你）你在想什么呢', '我养的猫今天又打翻了水杯', '明天早上要早起开会',
+    '这首歌我循环了一整天', '其实我一直想学做甜点', '外面的风好大，窗户都在响', '你说的那本书我已经看完了',
+]
+TAG_WORDS = ['旅行', '工作', '美食', '猫', '音乐', '读书', '下雨', '海边', '咖啡', '电影', '生日', '搬家', '考试', '运动']
+SEED_BATCH = 5000
+
+
+def sentence(rng: random.Random, max_parts: int = 6) -> str:
+    return '，'.join(rng.choice(PHRASES) for _ in range(rng.randint(1, max_parts))) + rng.choice('。！？')
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        'calls': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3),
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+
+def timed(samples: int, call) -> dict:
+    durations = []
+    for i in range(samples):
+        start = time.perf_counter()
+        call(i)
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def dir_size_mb(path: str) -> float:
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return round(total / 1024 / 1024, 2)
+
+
+def seed_chat(db_file: str, rows: int, conversations: int, rng: random.Random):
+    """批量写入聊天记录、朋友圈和日记；全文索引由迁移创建的触发器同步维护。"""
+    SimpleDatabase(db_file).close()  # 执行迁移
+    pool = get_pool(db_file)
+    for offset in range(0, rows, SEED_BATCH):
+        batch = []
+        for i in range(offset, min(rows, offset + SEED_BATCH)):
+            image = f'talk_picture/{rng.getrandbits(128):032x}.webp' if i % 25 == 0 else None
+            batch.append((f'char_{i % conversations}_chat', 'ai' if i % 2 else 'human', sentence(rng), image))
+        with pool.connection() as conn:
+            conn.executemany(
+                "INSERT INTO chat_history (conversation_id, message_type, content, image_url) VALUES (?, ?, ?, ?)",
+                batch
+            )
+    posts = max(1, rows // 100)
+    diaries = max(1, rows // 200)
+    with pool.connection() as conn:
+        conn.executemany(
+            "INSERT INTO social_posts (character_db_id, content, tags, post_time, image_url) VALUES (?, ?, ?, ?, ?)",
+            [(f'char_{i % conversations}_chat', sentence(rng, 3), ','.join(rng.sample(TAG_WORDS, 2)),
+              f'2025-01-{i % 28 + 1:02d} {i % 24:02d}:00', '') for i in range(posts)]
+        )
+        conn.executemany(
+            "INSERT INTO diary_entries (character_db_id, content) VALUES (?, ?)",
+            [(f'char_{i % conversations}_chat', sentence(rng, 20)) for i in range(diaries)]
+        )
+    return posts, diaries
+
+
+def bench_chat(work_dir: str, rows: int, conversations: int, samples: int, rng: random.Random) -> dict:
+    db_file = os.path.join(work_dir, 'chat_data.db')
+    start = time.perf_counter()
+    posts, diaries = seed_chat(db_file, rows, conversations, rng)
+    seed_s = time.perf_counter() - start
+
+    conversation_ids = [f'char_{i}_chat' for i in range(conversations)]
+    app_db = SimpleDatabase(db_file)
+    try:
+        methods = {
+            'add_chat_message': timed(samples, lambda i: app_db.add_chat_message(
+                rng.choice(conversation_ids), 'ai' if i % 2 else 'human', sentence(rng))),
+            'get_chat_history': timed(samples, lambda i: app_db.get_chat_history(rng.choice(conversation_ids))),
+            'get_all_social_posts': timed(samples, lambda i: app_db.get_all_social_posts(rng.choice(conversation_ids))),
+            'get_all_diaries': timed(samples, lambda i: app_db.get_all_diaries(rng.choice(conversation_ids))),
+        }
+    finally:
+        app_db.close()
+    return {
+        'chat_rows': rows,
+        'conversations': conversations,
+        'rows_per_conversation': rows // conversations,
+        'social_posts': posts,
+        'diaries': diaries,
+        'seed_s': round(seed_s, 2),
+        'db_mb': dir_size_mb(work_dir),
+        'methods': methods,
+    }
+
+
+def memory_block(rng: random.Random, size: int) -> list:
+    return [(AIMessage if i % 2 else HumanMessage)(content=sentence(rng)) for i in range(size)]
+
+
+def bench_memory(work_dir: str, tag_count: int, block_size: int, samples: int, rng: random.Random) -> dict:
+    db_path = os.path.join(work_dir, 'memory_data.db')
+    user_uuid = f'char_{tag_count}_chat'
+    manager = DatabaseManager(db_path)
+    tags = [f'{rng.choice(TAG_WORDS)}_{i}' for i in range(tag_count)]
+
+    start = time.perf_counter()
+    blocks = 0
+    next_tag = 0
+    while next_tag < tag_count:
+        count = rng.randint(1, 3)
+        # 新标签之外再随机关联一个旧标签，模拟同一话题多次出现
+        block_tags = tags[next_tag:next_tag + count] + ([rng.choice(tags[:next_tag])] if next_tag else [])
+        manager.add_memory(user_uuid, block_tags, memory_block(rng, block_size))
+        next_tag += count
+        blocks += 1
+    seed_s = time.perf_counter() - start
+
+    def get_all_tags_cold(i):
+        tag_cache.invalidate((db_path, user_uuid))
+        manager.get_all_tags(user_uuid)
+
+    methods = {
+        'add_memory': timed(samples, lambda i: manager.add_memory(
+            user_uuid, rng.sample(tags, rng.randint(1, 3)), memory_block(rng, block_size))),
+        'get_memory': timed(samples, lambda i: manager.get_memory(user_uuid, rng.choice(tags))),
+        'get_all_tags': timed(samples, lambda i: manager.get_all_tags(user_uuid)),
+        'get_all_tags_cold': timed(samples, get_all_tags_cold),
+    }
+    return {
+        'tags': tag_count,
+        'blocks': blocks + samples,
+        'block_size': block_size,
+        'seed_s': round(seed_s, 2),
+        'db_mb': dir_size_mb(work_dir),
+        'methods': methods,
+    }
+
+
+def parse_sizes(text: str) -> list[int]:
+    return [int(part) for part in text.split(',') if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chat-sizes', default='10000,100000,1000000', help='chat_history 总行数，逗号分隔')
+    parser.add_argument('--tag-sizes', default='100,1000,5000', help='单个会话的记忆标签数，逗号分隔')
+    parser.add_argument('--conversations', type=int, default=100, help='聊天记录分摊到的会话（角色）数')
+    parser.add_argument('--block-size', type=int, default=20, help='每个记忆块的消息条数')
+    parser.add_argument('--samples', type=int, default=200, help='每个方法在每个规模下的调用次数')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--keep', action='store_true', help='保留生成的临时数据库，便于手动检查')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    rng = random.Random(args.seed)
+    root = tempfile.mkdtemp(prefix='storage_bench_')
+    # 记忆向量索引写在工作目录下的 memory_index/，切换到临时目录避免污染仓库
+    os.chdir(root)
+
+    results = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'keep')},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform()},
+        'chat': [],
+        'memory': [],
+    }
+    for rows in parse_sizes(args.chat_sizes):
+        work_dir = tempfile.mkdtemp(prefix=f'chat_{rows}_', dir=root)
+        result = bench_chat(work_dir, rows, args.conversations, args.samples, rng)
+        results['chat'].append(result)
+        print(f"chat_history {rows:>9} 行 (seed {result['seed_s']} s, {result['db_mb']} MB): " + ', '.join(
+            f"{name} p50 {m['p50_ms']:.2f} / p95 {m['p95_ms']:.2f} ms" for name, m in result['methods'].items()))
+    for tag_count in parse_sizes(args.tag_sizes):
+        work_dir = tempfile.mkdtemp(prefix=f'memory_{tag_count}_', dir=root)
+        result = bench_memory(work_dir, tag_count, args.block_size, args.samples, rng)
+        results['memory'].append(result)
+        print(f"memory tags {tag_count:>6} ({result['blocks']} 块, seed {result['seed_s']} s, {result['db_mb']} MB): "
+              + ', '.join(f"{name} p50 {m['p50_ms']:.2f} / p95 {m['p95_ms']:.2f} ms"
+                          for name, m in result['methods'].items()))
+    os.chdir(ROOT)
+    if args.keep:
+        print(f"临时数据目录: {root}")
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
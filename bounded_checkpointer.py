@@ -0,0 +1,354 @@
+# bounded_checkpointer.py
+"""
+持久化、有界的 LangGraph 检查点存储，用来替代进程内的 MemorySaver。
+
+- 所有检查点写入 SQLite 文件，进程重启后状态不丢失；
+- 每个线程（会话）只保留最近 keep_last 个检查点，旧检查点及其 pending writes 写入时即被清理；
+- 内存中只保留最近活跃的 hot_threads 个线程的最新检查点（LRU），
+  空闲线程被挤出内存后，下次访问时再从磁盘读回；
+- 检查点和 pending writes 经 message_codec.CompactSerializer 压缩后存储。
+"""
+import random
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Iterator, Optional, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+)
+
+from base import CHECKPOINT_DB, CHECKPOINT_KEEP_LAST, CHECKPOINT_HOT_THREADS
+from message_codec import CompactSerializer
+
+
+class BoundedSqliteSaver(BaseCheckpointSaver[str]):
+    """
+    SQLite 检查点存储 + 内存 LRU 热点缓存。
+    写操作直接落盘（write-through），因此把线程挤出内存不需要额外的刷盘动作。
+    热点缓存中保存的是序列化后的字节，读取时重新反序列化，节点对状态的原地修改不会污染缓存。
+    """
+
+    def __init__(self, db_path=CHECKPOINT_DB, keep_last=CHECKPOINT_KEEP_LAST,
+                 hot_threads=CHECKPOINT_HOT_THREADS, *, serde=None):
+        """
+        :param db_path: 检查点数据库文件路径。
+        :param keep_last: 每个线程保留的检查点数量（至少为 2，保证当前检查点的父检查点可用）。
+        :param hot_threads: 内存中保留的活跃线程数量。
+        :param serde: 序列化器，默认为带压缩的 CompactSerializer（仍可读取未压缩的旧检查点）。
+        """
+        super().__init__(serde=serde or CompactSerializer())
+        self.db_path = db_path
+        self.keep_last = max(2, keep_last)
+        self.hot_threads = hot_threads
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        # thread_id -> {checkpoint_ns: (checkpoint 行, {(task_id, idx): write 行})}
+        self._hot: OrderedDict[str, dict[str, tuple[tuple, dict]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _create_tables(self):
+        with self.lock:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    parent_checkpoint_id TEXT,
+                    type TEXT,
+                    checkpoint BLOB,
+                    metadata_type TEXT,
+                    metadata BLOB,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS writes (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL DEFAULT '',
+                    checkpoint_id TEXT NOT NULL,
+                    task_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    channel TEXT NOT NULL,
+                    type TEXT,
+                    value BLOB,
+                    task_path TEXT NOT NULL DEFAULT '',
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+                )
+            ''')
+            self.conn.commit()
+
+    # ------------------------------------------------------------------
+    # 热点缓存
+    # ------------------------------------------------------------------
+    def _remember(self, thread_id: str, checkpoint_ns: str, row: tuple, writes: dict):
+        """把线程的最新检查点放入热点缓存，并按 LRU 挤出多余线程。"""
+        entry = self._hot.pop(thread_id, {})
+        entry[checkpoint_ns] = (row, writes)
+        self._hot[thread_id] = entry
+        while len(self._hot) > self.hot_threads:
+            self._hot.popitem(last=False)
+
+    def _hot_entry(self, thread_id: str, checkpoint_ns: str):
+        entry = self._hot.get(thread_id)
+        if entry is None or checkpoint_ns not in entry:
+            return None
+        self._hot.move_to_end(thread_id)
+        return entry[checkpoint_ns]
+
+    # ------------------------------------------------------------------
+    # 行 <-> CheckpointTuple
+    # ------------------------------------------------------------------
+    def _load_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> dict:
+        cursor = self.conn.execute(
+            """
+            SELECT task_id, idx, channel, type, value, task_path FROM writes
+            WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?
+            ORDER BY task_id, idx
+            """,
+            (thread_id, checkpoint_ns, checkpoint_id)
+        )
+        return {(task_id, idx): (task_id, channel, type_, value, task_path)
+                for task_id, idx, channel, type_, value, task_path in cursor.fetchall()}
+
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, row: tuple, writes: dict) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": parent_checkpoint_id,
+            }} if parent_checkpoint_id else None,
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((w_type, value)))
+                for task_id, channel, w_type, value, _ in writes.values()
+            ],
+        )
+
+    # ------------------------------------------------------------------
+    # BaseCheckpointSaver 接口
+    # ------------------------------------------------------------------
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        with self.lock:
+            hot = self._hot_entry(thread_id, checkpoint_ns)
+            if hot is not None and (checkpoint_id is None or hot[0][0] == checkpoint_id):
+                self.hits += 1
+                row, writes = hot
+            else:
+                self.misses += 1
+                if checkpoint_id:
+                    cursor = self.conn.execute(
+                        """
+                        SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata
+                        FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?
+                        """,
+                        (thread_id, checkpoint_ns, checkpoint_id)
+                    )
+                else:
+                    cursor = self.conn.execute(
+                        """
+                        SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata
+                        FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+                        ORDER BY checkpoint_id DESC LIMIT 1
+                        """,
+                        (thread_id, checkpoint_ns)
+                    )
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                writes = self._load_writes(thread_id, checkpoint_ns, row[0])
+                if checkpoint_id is None:
+                    self._remember(thread_id, checkpoint_ns, row, writes)
+            return self._to_tuple(thread_id, checkpoint_ns, row, dict(writes))
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        query = """
+            SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint,
+                   metadata_type, metadata
+            FROM checkpoints
+        """
+        clauses, params = [], []
+        if config is not None:
+            clauses.append("thread_id = ?")
+            params.append(str(config["configurable"]["thread_id"]))
+            if "checkpoint_ns" in config["configurable"]:
+                clauses.append("checkpoint_ns = ?")
+                params.append(config["configurable"]["checkpoint_ns"])
+            if checkpoint_id := get_checkpoint_id(config):
+                clauses.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before is not None and (before_id := get_checkpoint_id(before)):
+            clauses.append("checkpoint_id < ?")
+            params.append(before_id)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY checkpoint_id DESC"
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+
+        count = 0
+        for thread_id, checkpoint_ns, *row in rows:
+            if limit is not None and count >= limit:
+                break
+            if filter:
+                metadata = self.serde.loads_typed((row[4], row[5]))
+                if not all(metadata.get(k) == v for k, v in filter.items()):
+                    continue
+            with self.lock:
+                writes = self._load_writes(thread_id, checkpoint_ns, row[0])
+            count += 1
+            yield self._to_tuple(thread_id, checkpoint_ns, tuple(row), writes)
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(metadata)
+        row = (checkpoint["id"], config["configurable"].get("checkpoint_id"),
+               type_, serialized_checkpoint, metadata_type, serialized_metadata)
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO checkpoints
+                (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (thread_id, checkpoint_ns, *row)
+            )
+            self._prune(thread_id, checkpoint_ns)
+            self.conn.commit()
+            self._remember(thread_id, checkpoint_ns, row, {})
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"],
+        }}
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # 特殊通道（错误、中断等）允许覆盖，普通通道的重复写入会被忽略
+        replace = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, serialized = self.serde.dumps_typed(value)
+            rows.append((task_id, WRITES_IDX_MAP.get(channel, idx), channel, type_, serialized, task_path))
+        with self.lock:
+            self.conn.executemany(
+                f"""
+                INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO writes
+                (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, task_path)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [(thread_id, checkpoint_ns, checkpoint_id, *r) for r in rows]
+            )
+            self.conn.commit()
+            hot = self._hot_entry(thread_id, checkpoint_ns)
+            if hot is not None and hot[0][0] == checkpoint_id:
+                hot_writes = hot[1]
+                for task_id_, idx, channel, type_, serialized, path in rows:
+                    key = (task_id_, idx)
+                    if replace or key not in hot_writes:
+                        hot_writes[key] = (task_id_, channel, type_, serialized, path)
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (str(thread_id),))
+            self.conn.execute("DELETE FROM writes WHERE thread_id = ?", (str(thread_id),))
+            self.conn.commit()
+            self._hot.pop(str(thread_id), None)
+
+    def _prune(self, thread_id: str, checkpoint_ns: str):
+        """只保留该线程最近 keep_last 个检查点，并删除被清理检查点的 pending writes。"""
+        row = self.conn.execute(
+            """
+            SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+            ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?
+            """,
+            (thread_id, checkpoint_ns, self.keep_last - 1)
+        ).fetchone()
+        if row is None:
+            return
+        oldest_kept = row[0]
+        self.conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+            (thread_id, checkpoint_ns, oldest_kept)
+        )
+        self.conn.execute(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+            (thread_id, checkpoint_ns, oldest_kept)
+        )
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        next_v = current_v + 1
+        next_h = random.random()
+        return f"{next_v:032}.{next_h:016}"
+
+    # 异步接口直接复用同步实现（SQLite 操作很快，且全部在锁内完成）
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.get_tuple(config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for item in self.list(config, filter=filter, before=before, limit=limit):
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path="") -> None:
+        return self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return self.delete_thread(thread_id)
+
+    def stats(self) -> dict:
+        """热点缓存命中情况，便于观察内存占用与命中率。"""
+        with self.lock:
+            return {'hot_threads': len(self._hot), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,133 @@
+# context_builder.py
+"""
+各节点 prompt 共用的上下文构建工具。
+
+直接把 LangChain 消息列表塞进 ChatPromptTemplate 时会按 repr 渲染，additional_kwargs、response_metadata、id
+等字段都会进入 prompt。这里把消息渲染成紧凑的“角色: 内容”形式，用本地分词估算 token 数，
+并按节点的 token 预算从最新的消息往前填充，统计每个节点实际用量和相对原始渲染节省的 token 数。
+"""
+import math
+import re
+import threading
+
+from langchain_core.messages import BaseMessage
+
+from base import CONTEXT_TOKEN_BUDGETS, LONG_MEMORY_TOKEN_BUDGETS, CONTEXT_REPR_OVERHEAD
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 本地分词规则：每个汉字（含全角标点）算 1 个 token，连续的英文/数字约 4 个字符 1 个 token，其余符号各算 1 个
+_TOKEN_PATTERN = re.compile(r'[一-鿿㐀-䶿　-〿＀-￯]|[A-Za-z0-9_]+|\S')
+_WIDE_CHAR = re.compile(r'[一-鿿㐀-䶿　-〿＀-￯]')
+
+_stats: dict[str, dict[str, int]] = {}
+_stats_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """用本地规则估算文本的 token 数（不需要联网下载分词表）。"""
+    tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        if len(piece) > 1 and not _WIDE_CHAR.match(piece):
+            tokens += math.ceil(len(piece) / 4)
+        else:
+            tokens += 1
+    return tokens
+
+
+def _content_text(message: BaseMessage) -> str:
+    """消息的文字内容。非文本内容（如图片）只保留其中的文字部分。"""
+    content = message.content
+    if not isinstance(content, str):
+        content = ' '.join(part if isinstance(part, str) else part.get('text', '')
+                           for part in content if isinstance(part, (str, dict)))
+    return content
+
+
+def render_message(message: BaseMessage, ai_name: str = 'AI', human_name: str = '用户') -> str:
+    """把单条消息渲染为“角色: 内容”。非文本内容（如图片）只保留其中的文字部分。"""
+    role = human_name if message.type == 'human' else ai_name if message.type == 'ai' else message.type
+    return f'{role}: {_content_text(message).strip()}'
+
+
+def _raw_tokens(messages) -> int:
+    """按 repr 渲染时的 token 数估计：内容 token 加每条消息固定的字段开销，不实际渲染 repr。"""
+    return sum(count_tokens(_content_text(message)) + CONTEXT_REPR_OVERHEAD for message in messages)
+
+
+def _record(node: str, used: int, raw: int, kept: int, total: int):
+    with _stats_lock:
+        stats = _stats.setdefault(node, {'calls': 0, 'tokens': 0, 'raw_tokens': 0, 'saved_tokens': 0})
+        stats['calls'] += 1
+        stats['tokens'] += used
+        stats['raw_tokens'] += raw
+        stats['saved_tokens'] += raw - used
+    logger.debug('%s: 保留 %d/%d 条, %d tokens (原始渲染约 %d tokens, 节省 %d)',
+                 node, kept, total, used, raw, raw - used)
+
+
+def build_context(node: str, messages: list[BaseMessage], ai_name: str = 'AI', human_name: str = '用户',
+                  budget: int | None = None) -> str:
+    """
+    从最新的消息往前填充，直到用完节点的 token 预算，返回按时间顺序排列的紧凑文本。
+    最新的一条消息总会被保留，即使它本身超出预算。
+    :param node: 节点名，用于查找 CONTEXT_TOKEN_BUDGETS 中的预算和统计。
+    :param budget: 显式指定预算，覆盖配置。
+    """
+    budget = budget if budget is not None else CONTEXT_TOKEN_BUDGETS[node]
+    lines, used = [], 0
+    for message in reversed(messages):
+        line = render_message(message, ai_name, human_name)
+        cost = count_tokens(line) + 1  # 换行
+        if lines and used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    lines.reverse()
+    _record(node, used, _raw_tokens(messages), len(lines), len(messages))
+    return '\n'.join(lines)
+
+
+def render_long_memories(node: str, long_messages: dict, ai_name: str = 'AI',
+                         human_name: str = '用户', budget: int | None = None) -> str:
+    """
+    把 get_long_message 召回的长期记忆（recall_cache 维护的 {标签: 条目}）渲染为紧凑文本。
+    越晚触发的记忆越优先；每段记忆内部同样从最新的消息往前填充，总量不超过 LONG_MEMORY_TOKEN_BUDGETS 中的预算。
+    """
+    budget = budget if budget is not None else LONG_MEMORY_TOKEN_BUDGETS[node]
+    sections, used, kept, total, raw = [], 0, 0, 0, 0
+    for key, entry in reversed(list(long_messages.items())):
+        if isinstance(entry, dict):
+            question, memory = entry['question'], entry['messages']
+        else:
+            question, memory = key, entry or []  # 旧版状态: {用户询问: 消息列表}
+        total += len(memory)
+        raw += count_tokens(question) + _raw_tokens(memory)
+        header = f'用户询问了{question}，引发了你的过往回忆，该段回忆为：'
+        header_cost = count_tokens(header) + 1
+        if used + header_cost >= budget:
+            break
+        used += header_cost
+        lines = []
+        for message in reversed(memory):
+            line = render_message(message, ai_name, human_name)
+            cost = count_tokens(line) + 1
+            if used + cost > budget:
+                break
+            lines.append(line)
+            used += cost
+        if not lines:
+            used -= header_cost
+            break
+        kept += len(lines)
+        sections.append(header + '\n' + '\n'.join(reversed(lines)))
+    sections.reverse()
+    _record(f'{node}.long_messages', used, raw, kept, total)
+    return '\n'.join(sections)
+
+
+def context_stats() -> dict[str, dict[str, int]]:
+    """返回各节点累计的调用次数、实际 token 数、原始渲染 token 数估计和节省的 token 数。"""
+    with _stats_lock:
+        return {node: dict(stats) for node, stats in _stats.items()}
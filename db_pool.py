@@ -0,0 +1,141 @@
+# db_pool.py
+"""
+SimpleDatabase 与 DatabaseManager 共用的 SQLite 连接池。
+
+- 连接按数据库文件池化复用：同一线程内嵌套获取会拿到同一个连接，释放后放回空闲池供其它线程使用；
+- 新连接统一开启 WAL 日志模式，并设置 synchronous / cache_size 等参数，注册全文索引使用的 cjk_ngrams 函数；
+- 表结构通过带版本号的迁移（PRAGMA user_version）管理，每个进程每个数据库只检查一次。
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from fulltext import cjk_ngrams
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 每个新连接执行的 PRAGMA
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # 读写互不阻塞
+    "PRAGMA synchronous=NORMAL",    # WAL 下足够安全，避免每次提交都 fsync
+    "PRAGMA cache_size=-16000",     # 约 16MB 页缓存（负数单位为 KB）
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+# 迁移定义: (版本号, 说明, 接收连接并执行 DDL 的函数)
+Migration = tuple[int, str, Callable[[sqlite3.Connection], None]]
+
+
+class ConnectionPool:
+    """单个 SQLite 数据库文件的连接池。"""
+
+    def __init__(self, db_path: str, max_idle: int = 8):
+        """
+        :param db_path: 数据库文件路径。
+        :param max_idle: 空闲池中最多保留的连接数，多出来的连接在释放时直接关闭。
+        """
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self._idle: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._migrated_version = None
+        self._migrate_lock = threading.Lock()
+
+    def _new_connection(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        # 全文索引触发器中使用的中文分词函数
+        conn.create_function('cjk_ngrams', 1, cjk_ngrams, deterministic=True)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """获取连接。同一线程未释放前重复获取，会得到同一个连接。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            return conn
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._new_connection()
+        self._local.conn = conn
+        self._local.depth = 1
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """释放连接。线程内最外层释放时，未提交的事务会被回滚，连接放回空闲池。"""
+        if getattr(self._local, 'conn', None) is not conn:
+            return
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """获取连接的上下文管理器：正常退出时提交，异常时回滚。"""
+        conn = self.acquire()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def migrate(self, migrations: list[Migration]):
+        """
+        依次执行尚未应用的迁移，并把 user_version 更新为最新版本。
+        每个进程只在第一次调用时访问数据库，之后直接返回。
+        """
+        latest = max(version for version, _, _ in migrations)
+        if self._migrated_version is not None and self._migrated_version >= latest:
+            return
+        with self._migrate_lock:
+            if self._migrated_version is not None and self._migrated_version >= latest:
+                return
+            conn = self.acquire()
+            try:
+                # IMMEDIATE 事务保证多个进程同时启动时迁移只执行一次
+                conn.execute("BEGIN IMMEDIATE")
+                current = conn.execute("PRAGMA user_version").fetchone()[0]
+                for version, description, apply in sorted(migrations, key=lambda m: m[0]):
+                    if version <= current:
+                        continue
+                    logger.info("%s: 执行迁移 v%d - %s", self.db_path, version, description)
+                    apply(conn)
+                    conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.release(conn)
+            self._migrated_version = latest
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str) -> ConnectionPool:
+    """获取（或创建）某个数据库文件对应的连接池。"""
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(db_path, ConnectionPool(db_path))
+    return pool
@@ -0,0 +1,63 @@
+# fulltext.py
+"""
+SQLite FTS5 全文检索的中文分词辅助。
+
+Python 的 sqlite3 无法注册自定义 FTS5 分词器，因此改为“预分词”：
+写入时由 SQL 函数 cjk_ngrams() 把文本转换为空格分隔的词元（每个汉字的单字 + 相邻两字的二元组，英文数字按单词小写），
+FTS5 表使用 unicode61 分词器按空格切分这些词元；查询时用同样的规则把关键词转换为 MATCH 表达式。
+db_pool 会在每个新连接上注册 cjk_ngrams，触发器和回填迁移都依赖它。
+"""
+import re
+
+_CJK_RUN = re.compile(r'[一-鿿㐀-䶿]+')
+_WORD = re.compile(r'[a-z0-9]+')
+_TOKEN = re.compile(r'[一-鿿㐀-䶿]+|[a-z0-9]+')
+# 高频虚词和代词。检索时丢弃含这些字的词元，避免“我们”“了吗”这类片段把几乎所有记录都匹配出来
+STOP_CHARS = re.compile(r'[的了吗呢啊吧呀嘛么着过是在有和与也就还又很这那哪你我他她它们啥什怎]')
+
+
+def cjk_ngrams(text: str | None) -> str:
+    """把文本转换为写入 FTS5 的词元串。"""
+    if not text:
+        return ''
+    grams = []
+    for token in _TOKEN.findall(text.lower()):
+        if _CJK_RUN.fullmatch(token):
+            grams.extend(token)
+            grams.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            grams.append(token)
+    return ' '.join(grams)
+
+
+def owner_token(owner_id: str) -> str:
+    """
+    把会话/角色 id（如 char_1_chat）转换为 FTS5 中的单个词元。unicode61 会在下划线处切分，
+    因此去掉下划线，与触发器中的 replace(..., '_', '') 保持一致。
+    """
+    return owner_id.replace('_', '').lower()
+
+
+def build_match_query(query: str, owner_id: str | None = None) -> str | None:
+    """
+    把用户输入的关键词转换为 FTS5 MATCH 表达式：连续汉字取相邻二元组（单个汉字取单字）。
+    没有分词时无法确定哪些二元组是真正的词（如“京都酒店”中的“都酒”），因此词元之间用 OR 连接，
+    由 BM25 让命中词元更多、更稀有的记录排在前面；含高频虚词的词元会被丢弃（全部含有时保留）。
+    指定 owner_id 时只匹配该会话/角色的记录（owner 列），FTS5 先按 owner 的倒排表缩小范围，
+    不需要在全表命中结果上再过滤。没有可检索的内容时返回 None。
+    """
+    terms = []
+    for token in _TOKEN.findall(query.lower()):
+        if _CJK_RUN.fullmatch(token) and len(token) > 1:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            terms.append(token)
+    terms = list(dict.fromkeys(terms))
+    terms = [term for term in terms if not STOP_CHARS.search(term)] or terms
+    if not terms:
+        return None
+    # 词元只含汉字和字母数字，加双引号即可避免与 FTS5 查询语法冲突
+    match = ' OR '.join(f'"{term}"' for term in terms)
+    if owner_id is None:
+        return match
+    return f'owner:"{owner_token(owner_id)}" AND grams:({match})'
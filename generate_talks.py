@@ -1,19 +1,26 @@
-import datetime
-import os.path
+import time
 
-from google import genai
 from google.genai import types
-from PIL import Image
-from io import BytesIO
-from base import llm_google, State, llm_qwen, llm_kimi, llm_google_pro, llm
+from base import State, provider_registry
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from langchain_core.messages import AIMessage
 from langchain_core.messages import HumanMessage
+from langgraph.config import get_stream_writer
 
 import asyncio
 import api_key
 from get_memory import DatabaseManager
+from context_builder import build_context, render_long_memories
+from llm_cache import cached_invoke
+from rate_limit import get_limiter, map_ordered
+from llm_router import get_router
+from image_store import get_image_store
+from metrics import IMAGE_SECONDS, IMAGE_ERRORS
+from app_logging import get_logger, truncate
+
+logger = get_logger(__name__)
+summary_db = DatabaseManager()
 
 def generate_talk(state:State)->dict:
     character_profile=state['character_profile']
@@ -44,6 +51,7 @@ def generate_talk(state:State)->dict:
 
 ### **第三层：刺激 (The Stimulus) - 近期聊天记录 (Recent Chat)**
 *   **这只是“刚刚发生的事”**，是你需要做出反应的外部输入。
+*   **更早的聊天摘要:** {summary}
 *   **聊天内容:** {short_messages}
 *   **作用：** 这是对话的“引子”。你需要对它做出反应，但**反应的方式必须完全由第一层（角色设定）决定**。
 *   **绝对禁令：** 绝不能因为聊天内容而改变你的核心性格。如果用户一直在说温柔的话，一个傲娇的角色也只会表现出“不坦率的害羞”，而不会变成一个同样温柔的人。**聊天记录是用来“考验”你人设的，而不是用来“改变”你人设的。**
@@ -80,20 +88,49 @@ def generate_talk(state:State)->dict:
 **你就是 {name}。开始对话吧。**
     """
     prompt=ChatPromptTemplate.from_template(prompt_template)
-    chain=prompt|llm_google|StrOutputParser()
+    # 通过 custom 流把每个增量片段推给调用方，SSE 端点据此逐字下发
+    writer=get_stream_writer()
+    start_time=time.perf_counter()
+    first_token_time=None
     answer=''
-    for chunk in chain.stream({'name':name,'profile':character_profile,'long_messages':long_messages,'short_messages':short_messages}):
+    # 移出短期记忆窗口的旧消息已由后台折叠成摘要（rolling_summary），这里只补上摘要
+    # 摘要读自进程内缓存，只有折叠任务保存新摘要时才会变化
+    summary=summary_db.get_summary(state['user_id']) or '无'
+    context={'name':name,'profile':character_profile,'summary':summary,
+             'long_messages':render_long_memories('generate_talk',long_messages,ai_name=name),
+             'short_messages':build_context('generate_talk',short_messages,ai_name=name)}
+    # 由 llm_router 选择当前最健康的模型，首个片段之前失败时自动换备选模型
+    for chunk in get_router().stream('generate_talk',prompt,StrOutputParser(),context):
+        if not chunk:
+            continue
+        if first_token_time is None:
+            first_token_time=time.perf_counter()
+            logger.info('generate_talk 首字延迟: %.0f ms', (first_token_time-start_time)*1000)
         answer+=chunk
+        writer({'type':'text_delta','content':chunk})
 
-    print(answer)
+    logger.debug('generate_talk 回复: %s', truncate(answer))
     message=AIMessage(content=answer)
     short_messages.append(message)
     return {'short_messages':short_messages}
 
 def generate_talk_picture(state: State) -> dict:
     messages = state['short_messages']
+    prompt = decide_talk_picture(messages)
+    if prompt:
+        path, picture_text = render_picture(prompt)
+        if picture_text:
+            messages.append(AIMessage(content='发送给用于一张图片，图片内容：'+picture_text))
+        if path:
+            return {'picture_path':path,'short_messages':messages}
+    return {'picture_path':''}
+
+def decide_talk_picture(messages: list) -> str:
+    """
+    判断最后一条消息是否值得配图。
+    :return: 需要配图时返回图片提示词，否则返回空字符串。
+    """
     contents = [messages[-1]]
-    print(contents)
     prompt_template="""
     # 角色
 你是一个精通人类情感与视觉艺术的“对话意境分析师”。你的核心任务是分析一段聊天对话，判断其内容是否蕴含一个值得被用户“看见”的瞬间，如果存在要并将其转化为一段专业、生动的图片生成提示词。
@@ -163,14 +200,23 @@ def generate_talk_picture(state: State) -> dict:
 {message}
     """
     prompt=ChatPromptTemplate.from_template(prompt_template)
-    chain=prompt|llm|JsonOutputParser()
-    answer=chain.invoke({'message':contents,})
-    print(answer)
+    answer=cached_invoke('decide_talk_picture',prompt,JsonOutputParser(),{'message':contents,})
+    logger.debug('decide_talk_picture 结果: %s', truncate(answer))
     if isinstance(answer, dict):
         prompt=answer['prompt']
-        print(prompt)
-        if prompt:
-            client = genai.Client(api_key=api_key.google_api)
+        return prompt or ''
+    return ''
+
+def render_picture(prompt: str) -> tuple[str, str]:
+    """
+    调用图片模型生成聊天配图并保存到 talk_picture 目录。
+    :return: (图片路径, 模型附带的图片描述)，未生成图片时路径为空字符串。
+    """
+    client = provider_registry.genai_client(api_key.google_api)
+    start = time.perf_counter()
+    try:
+        # 聊天配图与朋友圈配图共用 google 的限流器，避免并发生图超出接口限制
+        with get_limiter('google').slot():
             response = client.models.generate_content(
                 model="gemini-2.0-flash-preview-image-generation",
                 contents=prompt,
@@ -178,20 +224,22 @@ def generate_talk_picture(state: State) -> dict:
                     response_modalities=['TEXT', 'IMAGE']
                 )
             )
-            for part in response.candidates[0].content.parts:
-                if part.text is not None:
-                    print(part.text)
-                    messages.append(AIMessage(content='发送给用于一张图片，图片内容：'+part.text))
-                elif part.inline_data is not None:
-                    base_path='talk_picture'
-                    now = datetime.datetime.now()
-                    ts_recommended = now.strftime("%Y%m%d%H%M%S")
-                    image = Image.open(BytesIO((part.inline_data.data)))
-                    path=os.path.join(base_path, f'{ts_recommended}.png')
-                    image.save(path)
-                    print(path)
-                    return {'picture_path':path,'short_messages':messages}
-    return {'picture_path':''}
+    except Exception:
+        IMAGE_ERRORS.inc(provider='google')
+        raise
+    finally:
+        IMAGE_SECONDS.observe(time.perf_counter() - start, provider='google')
+    picture_text=''
+    for part in response.candidates[0].content.parts:
+        if part.text is not None:
+            logger.debug('图片描述: %s', truncate(part.text))
+            picture_text+=part.text
+        elif part.inline_data is not None:
+            # 按内容哈希保存为 WebP 并生成缩略图，并发生成的图片不会互相覆盖
+            path=get_image_store().save(part.inline_data.data)
+            logger.info('已生成配图: %s', path)
+            return path, picture_text
+    return '', picture_text
 
 def generate_dynamic_condition_picture(state: State) -> dict:
     messages = state['dynamic_condition']
@@ -274,46 +322,23 @@ def generate_dynamic_condition_picture(state: State) -> dict:
 {message}
     """
     prompt=ChatPromptTemplate.from_template(prompt_template)
-    chain=prompt|llm_google_pro|JsonOutputParser()
-    answer=chain.invoke({'message':message,})
+    answer=get_router().invoke('generate_dynamic_condition_picture',prompt,JsonOutputParser(),{'message':message,})
     picture_pathes = []
     if isinstance(answer, dict):
         prompts=answer['dynamic_picture_description']
-        print(prompts)
-        for prompt in prompts:
-            if prompt:
-                client = genai.Client(api_key=api_key.google_api)
-                response = client.models.generate_content(
-                    model="gemini-2.0-flash-preview-image-generation",
-                    contents=prompt,
-                    config=types.GenerateContentConfig(
-                        response_modalities=['TEXT', 'IMAGE']
-                    )
-                )
-                for part in response.candidates[0].content.parts:
-                    if part.text is not None:
-                        print(part.text)
-                    elif part.inline_data is not None:
-                        base_path='talk_picture'
-                        now = datetime.datetime.now()
-                        ts_recommended = now.strftime("%Y%m%d%H%M%S")
-                        image = Image.open(BytesIO((part.inline_data.data)))
-                        path=os.path.join(base_path, f'{ts_recommended}.png')
-                        image.save(path)
-                        print(path)
-                        picture_pathes.append(path)
-            else:
-                picture_pathes.append('')
+        logger.debug('动态配图提示词: %s', truncate(prompts))
+        # 各条动态的配图并发生成（速率与并发数由 render_picture 内的限流器控制），结果与动态一一对应；
+        # 某张图片失败时该位置为空字符串，不影响其余动态
+        picture_pathes=map_ordered(lambda p: render_picture(p)[0] if p else '', prompts,
+                                   max_workers=get_limiter('google').concurrency, default='')
     return {'dynamic_condition_picture_path':picture_pathes}
 
 def generate_diary(state:State)->dict:
     character_profile = state['character_profile']
     name = state['character_name']
     long_messages = state['long_messages']
-    long_message=''
-    for data in long_messages.keys():
-        long_message+=f'用户询问了{data}，引发了你的过往回忆，该段回忆为：\n{long_messages[data]}\n'
-    short_messages = state['short_messages'][-300:]
+    long_message = render_long_memories('generate_diary', long_messages, ai_name=name)
+    short_messages = build_context('generate_diary', state['short_messages'][-300:], ai_name=name)
     prompt_template = """
  ## 1. 核心任务 (Core Task)
 你将扮演一个特定的角色，并以该角色的第一人称视角，撰写一篇日记。这篇日记的核心内容，是你与用户近期互动中最让你感动、印象深刻或引发你深入思考的片段。你的任务不是简单地复述对话，而是要深入挖掘对话背后的情感和意义，展现你作为这个角色的内心世界、情绪波动和思想演变。
@@ -354,10 +379,9 @@ def generate_diary(state:State)->dict:
 请根据以上所有信息，开始撰写你的日记。
         """
     prompt = ChatPromptTemplate.from_template(prompt_template)
-    chain = prompt | llm_google_pro| StrOutputParser()
-    answer = chain.invoke(
+    answer = get_router().invoke('generate_diary', prompt, StrOutputParser(),
         {'name': name, 'profile': character_profile, 'long_messages': long_message, 'short_messages': short_messages})
-    print(answer)
+    logger.debug('日记: %s', truncate(answer))
     return {'diary': answer,'talk_number':0}
 
 def generate_dynamic_condition(state:State)->dict:
@@ -365,10 +389,8 @@ def generate_dynamic_condition(state:State)->dict:
     character_profile = state['character_profile']
     name = state['character_name']
     long_messages = state.get('long_messages', {})
-    long_message=''
-    for data in long_messages.keys():
-        long_message+=f'用户询问了{data}，引发了你的过往回忆，该段回忆为：\n{long_messages[data]}\n'
-    short_messages = state['short_messages'][-100:]
+    long_message = render_long_memories('generate_dynamic_condition', long_messages, ai_name=name)
+    short_messages = build_context('generate_dynamic_condition', state['short_messages'][-100:], ai_name=name)
     prompt_template = """
 
 ## 1. 核心指令 (Core Instruction)
@@ -454,14 +476,18 @@ def generate_dynamic_condition(state:State)->dict:
 }}
         """
     prompt = ChatPromptTemplate.from_template(prompt_template)
-    chain = prompt | llm_google_pro | JsonOutputParser()
-    answer = chain.invoke(
+    answer = get_router().invoke('generate_dynamic_condition', prompt, JsonOutputParser(),
         {'name': name, 'profile': character_profile, 'long_messages': long_message, 'short_messages': short_messages})
-    print(answer)
+    logger.debug('朋友圈动态: %s', truncate(answer))
+    memory_key=f"{state['memory_key']}:moment" if state.get('memory_key') else None
+    if memory_key and db.has_memory_block(state['user_id'],memory_key):
+        # 后台任务重试：本组动态的记忆块已在之前的尝试中写入
+        logger.info('记忆块 %s 已存在，跳过', memory_key)
+        return {'dynamic_condition': answer}
     dynamic_text=[]
     for ans in answer.keys():
         dynamic_text.append(AIMessage(answer[ans]['scheme']))
-    db.add_memory(state['user_id'], ['朋友圈动态'], dynamic_text)
+    db.add_memory(state['user_id'], ['朋友圈动态'], dynamic_text, source_key=memory_key)
     return {'dynamic_condition': answer}
 
 
@@ -567,10 +593,6 @@ async def main1():
                              'picture_description': '一张特写镜头，聚焦在图书馆窗台上一株顽强生长的绿色植物，它透过玻璃窗望向远方，窗外是朦胧的远山和薄雾。光线柔和，植物的叶片上沾着晶莹的露珠，背景虚化，强调了植物的坚韧和孤独的生命力。',
                              'time': '明天 08:30', 'label': ['信念', '承诺']}}}
 
-    # 你可以打印出来查看结构
-    # import json
-    # from langchain_core.load import dumpd
-    # print(json.dumps(dumpd(test_example), indent=2, ensure_ascii=False))
     answer=await generate_dynamic_condition_picture(a)
 
 
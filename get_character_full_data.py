@@ -1,86 +1,288 @@
 # get_character_full_data.py
-import sqlite3
 from flask import g
+from langchain_core.messages import HumanMessage, AIMessage
+
+from db_pool import get_pool
+from metrics import instrument_methods
+from fulltext import build_match_query
 
 # 数据库文件名
 DB_FILE = "chat_data.db"
+
+
+def _create_chat_tables(conn):
+    """v1: 聊天记录、朋友圈动态、日记三张表。"""
+    # 聊天记录表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            message_type TEXT NOT NULL, -- 'human' or 'ai'
+            content TEXT,
+            image_url TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 朋友圈动态表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS social_posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            character_db_id TEXT NOT NULL, -- e.g., "char_1"
+            content TEXT,
+            image_url TEXT,
+            tags TEXT, -- 存储为逗号分隔的字符串
+            post_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # 日记条目表
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS diary_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            character_db_id TEXT NOT NULL, -- e.g., "char_1"
+            content TEXT NOT NULL,
+            date DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _create_chat_indexes(conn):
+    """v2: 按会话/角色取数据时使用的索引，避免全表扫描。"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_conversation_time
+        ON chat_history (conversation_id, timestamp, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_history_conversation_id
+        ON chat_history (conversation_id, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_social_posts_character_time
+        ON social_posts (character_db_id, post_time)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_diary_entries_character_date
+        ON diary_entries (character_db_id, date)
+    ''')
+
+
+# 全文索引: (FTS5 表名, 源表, 归属列, 被索引的列, 需要索引的文本表达式)
+FTS_SOURCES = {
+    'chat': ('chat_history_fts', 'chat_history', 'conversation_id', 'content', "{row}.content"),
+    'diary': ('diary_entries_fts', 'diary_entries', 'character_db_id', 'content', "{row}.content"),
+    'moment': ('social_posts_fts', 'social_posts', 'character_db_id', 'content, tags',
+               "coalesce({row}.content, '') || ' ' || coalesce({row}.tags, '')"),
+}
+
+
+def _create_fts_tables(conn):
+    """
+    v3: 聊天记录、日记、朋友圈的 FTS5 全文索引。
+    使用无内容表（content=''）只保存倒排索引，原文仍从源表读取；由触发器保持同步，并回填已有数据。
+    owner 列保存会话/角色 id 对应的词元（见 fulltext.owner_token），检索时先按它缩小范围。
+    """
+    for fts, source, owner, columns, text in FTS_SOURCES.values():
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(owner, grams, content='', tokenize='unicode61')")
+        new_values = f"replace(new.{owner}, '_', ''), cjk_ngrams({text.format(row='new')})"
+        old_values = f"replace(old.{owner}, '_', ''), cjk_ngrams({text.format(row='old')})"
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {source} BEGIN
+                INSERT INTO {fts} (rowid, owner, grams) VALUES (new.id, {new_values});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {source} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, owner, grams) VALUES ('delete', old.id, {old_values});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {columns} ON {source} BEGIN
+                INSERT INTO {fts} ({fts}, rowid, owner, grams) VALUES ('delete', old.id, {old_values});
+                INSERT INTO {fts} (rowid, owner, grams) VALUES (new.id, {new_values});
+            END
+        ''')
+        conn.execute(f"""
+            INSERT INTO {fts} (rowid, owner, grams)
+            SELECT id, replace({owner}, '_', ''), cjk_ngrams({text.format(row=source)}) FROM {source}
+        """)
+
+
+# chat_data.db 的表结构迁移，版本号记录在 PRAGMA user_version 中
+CHAT_DB_MIGRATIONS = [
+    (1, '创建聊天记录/朋友圈/日记表', _create_chat_tables),
+    (2, '添加会话与角色查询索引', _create_chat_indexes),
+    (3, '聊天记录/日记/朋友圈全文索引', _create_fts_tables),
+]
+
+
+@instrument_methods('chat_db')
 class SimpleDatabase:
     """
     一个简单的 SQLite 数据库包装类。
-    这个类的每个实例代表一个独立的数据库连接。
+    连接来自 db_pool 连接池：实例创建时借出，close() 时归还，不再为每个请求新建连接。
     """
 
     def __init__(self, db_file=DB_FILE):
         self.db_file = db_file
-        # 连接数据库并设置 row_factory 以便获取类似字典的行数据
-        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+        self.pool = get_pool(self.db_file)
         self.create_tables()
+        # 连接池中的连接已设置 row_factory，可获取类似字典的行数据
+        self.conn = self.pool.acquire()
 
     def close(self):
-        """关闭数据库连接。"""
+        """把连接归还连接池。"""
         if self.conn is not None:
-            self.conn.close()
+            self.pool.release(self.conn)
+            self.conn = None
 
     def get_cursor(self):
         """获取数据库游标。"""
         return self.conn.cursor()
 
     def create_tables(self):
-        """如果表不存在，则创建它们。"""
-        cursor = self.get_cursor()
-        # 聊天记录表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversation_id TEXT NOT NULL,
-                message_type TEXT NOT NULL, -- 'human' or 'ai'
-                content TEXT,
-                image_url TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        # 朋友圈动态表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS social_posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                character_db_id TEXT NOT NULL, -- e.g., "char_1"
-                content TEXT,
-                image_url TEXT,
-                tags TEXT, -- 存储为逗号分隔的字符串
-                post_time DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        # 日记条目表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS diary_entries (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                character_db_id TEXT NOT NULL, -- e.g., "char_1"
-                content TEXT NOT NULL,
-                date DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        self.conn.commit()
+        """执行尚未应用的表结构迁移。每个进程只会在第一次调用时真正访问数据库。"""
+        self.pool.migrate(CHAT_DB_MIGRATIONS)
 
     def add_chat_message(self, conversation_id, message_type, content, image_url=None):
-        """添加一条聊天记录。"""
+        """添加一条聊天记录，返回新记录的 id。"""
         cursor = self.get_cursor()
         cursor.execute(
             "INSERT INTO chat_history (conversation_id, message_type, content, image_url) VALUES (?, ?, ?, ?)",
             (conversation_id, message_type, content, image_url)
         )
         self.conn.commit()
+        return cursor.lastrowid
+
+    def get_chat_message(self, message_id):
+        """根据 id 获取单条聊天记录，不存在时返回 None。"""
+        cursor = self.get_cursor()
+        cursor.execute("SELECT * FROM chat_history WHERE id = ?", (message_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def update_chat_image(self, message_id, image_url):
+        """为已存储的聊天记录补充图片路径（用于后台生成的配图）。"""
+        cursor = self.get_cursor()
+        cursor.execute(
+            "UPDATE chat_history SET image_url = ? WHERE id = ?",
+            (image_url, message_id)
+        )
+        self.conn.commit()
 
     def get_chat_history(self, conversation_id):
         """根据会话ID获取聊天记录。"""
         cursor = self.get_cursor()
         cursor.execute(
-            "SELECT * FROM chat_history WHERE conversation_id = ? ORDER BY timestamp ASC",
+            "SELECT * FROM chat_history WHERE conversation_id = ? ORDER BY timestamp ASC, id ASC",
             (conversation_id,)
         )
         # 将 Row 对象转换为标准字典，以便进行 JSON 序列化
         return [dict(row) for row in cursor.fetchall()]
 
+    def get_chat_page(self, conversation_id, before_id=None, limit=50):
+        """
+        按 id 做键集分页，读取 before_id 之前（不含）最新的 limit 条记录；before_id 为空时从最新一条开始。
+        :return: (按时间正序的记录列表, 是否还有更早的记录)
+        """
+        cursor = self.get_cursor()
+        if before_id is None:
+            cursor.execute(
+                "SELECT * FROM chat_history WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit + 1)
+            )
+        else:
+            cursor.execute(
+                "SELECT * FROM chat_history WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, before_id, limit + 1)
+            )
+        rows = [dict(row) for row in cursor.fetchall()]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_more
+
+    def get_chat_since(self, conversation_id, since_id, limit=200):
+        """
+        增量同步：读取 id 大于 since_id 的最多 limit 条记录。
+        :return: (按时间正序的记录列表, 是否还有更新的记录)
+        """
+        cursor = self.get_cursor()
+        cursor.execute(
+            "SELECT * FROM chat_history WHERE conversation_id = ? AND id > ? ORDER BY id ASC LIMIT ?",
+            (conversation_id, since_id, limit + 1)
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+        return rows[:limit], len(rows) > limit
+
+    def get_recent_messages(self, conversation_id, limit):
+        """
+        只读取会话最新的 limit 条记录，并转换为 LangChain 消息对象（按时间正序）。
+        用于检查点丢失后重建短期记忆，不必加载整段聊天记录。
+        """
+        cursor = self.get_cursor()
+        cursor.execute(
+            """
+            SELECT message_type, content FROM chat_history WHERE conversation_id = ?
+            ORDER BY timestamp DESC, id DESC LIMIT ?
+            """,
+            (conversation_id, limit)
+        )
+        rows = cursor.fetchall()
+        rows.reverse()
+        return [
+            HumanMessage(content=row['content'] or '') if row['message_type'] == 'human'
+            else AIMessage(content=row['content'] or '')
+            for row in rows
+        ]
+
+    def count_chat_messages(self, conversation_id):
+        """统计会话的聊天记录条数（走索引，不加载行数据）。"""
+        cursor = self.get_cursor()
+        cursor.execute("SELECT COUNT(*) FROM chat_history WHERE conversation_id = ?", (conversation_id,))
+        return cursor.fetchone()[0]
+
+    def search(self, conversation_id, query, kinds=('chat', 'diary', 'moment'), limit=20):
+        """
+        在一个角色的聊天记录、日记、朋友圈中全文检索，按 BM25 相关度排序（score 越小越相关）。
+
+        :param kinds: 要检索的内容类型，取值为 FTS_SOURCES 的键。
+        :return: [{'kind', 'id', 'content', 'time', 'score', ...}, ...]，最多 limit 条。
+        """
+        match = build_match_query(query, conversation_id)
+        if not match:
+            return []
+        cursor = self.get_cursor()
+        results = []
+        if 'chat' in kinds:
+            cursor.execute('''
+                SELECT h.id, h.message_type, h.content, h.image_url, h.timestamp AS time,
+                       bm25(chat_history_fts, 0.0, 1.0) AS score
+                FROM chat_history_fts JOIN chat_history h ON h.id = chat_history_fts.rowid
+                WHERE chat_history_fts MATCH ?
+                ORDER BY score LIMIT ?
+            ''', (match, limit))
+            results.extend(dict(row, kind='chat') for row in cursor.fetchall())
+        if 'diary' in kinds:
+            cursor.execute('''
+                SELECT d.id, d.content, d.date AS time, bm25(diary_entries_fts, 0.0, 1.0) AS score
+                FROM diary_entries_fts JOIN diary_entries d ON d.id = diary_entries_fts.rowid
+                WHERE diary_entries_fts MATCH ?
+                ORDER BY score LIMIT ?
+            ''', (match, limit))
+            results.extend(dict(row, kind='diary') for row in cursor.fetchall())
+        if 'moment' in kinds:
+            cursor.execute('''
+                SELECT p.id, p.content, p.tags, p.image_url, p.post_time AS time, bm25(social_posts_fts, 0.0, 1.0) AS score
+                FROM social_posts_fts JOIN social_posts p ON p.id = social_posts_fts.rowid
+                WHERE social_posts_fts MATCH ?
+                ORDER BY score LIMIT ?
+            ''', (match, limit))
+            for row in cursor.fetchall():
+                post = dict(row, kind='moment')
+                post['tags'] = post['tags'].split(',') if post.get('tags') else []
+                results.append(post)
+        results.sort(key=lambda r: r['score'])
+        return results[:limit]
+
     def get_all_social_posts(self, character_db_id):
         """获取指定角色的所有朋友圈动态。"""
         cursor = self.get_cursor()
@@ -96,6 +298,19 @@ class SimpleDatabase:
             posts.append(post)
         return posts
 
+    def get_image_urls(self, conversation_id):
+        """获取会话的聊天记录和朋友圈中出现过的全部图片地址，用于校验图片访问范围。"""
+        cursor = self.get_cursor()
+        cursor.execute(
+            """
+            SELECT image_url FROM chat_history WHERE conversation_id = ? AND image_url != ''
+            UNION
+            SELECT image_url FROM social_posts WHERE character_db_id = ? AND image_url != ''
+            """,
+            (conversation_id, conversation_id)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
     def get_all_diaries(self, character_db_id):
         """获取指定角色的所有日记。"""
         cursor = self.get_cursor()
@@ -1,9 +1,217 @@
-import sqlite3
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from langchain_core.messages import BaseMessage
-from langchain_core.load import dumps, loads
 
+from base import MEMORY_TAG_CACHE_SIZE, MEMORY_SNIPPET_WINDOW, SUMMARY_CACHE_TTL
+from context_builder import count_tokens, render_message
+from db_pool import get_pool
+from metrics import instrument_methods
+from fulltext import build_match_query, cjk_ngrams, owner_token
+from memory_index import get_memory_index, messages_text
+from message_codec import encode_messages, decode_messages
+from ttl_cache import TTLCache
+from app_logging import get_logger
 
+logger = get_logger(__name__)
+
+
+def _create_memory_tables(db):
+    """v1: 人物简介表与聊天记忆表。"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS character_profiles (
+            uuid TEXT PRIMARY KEY,
+            profile_content TEXT,
+            updated_at TIMESTAMP
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS chat_memories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT NOT NULL,
+            event_tag TEXT NOT NULL,
+            memory_content TEXT, -- 将存储序列化后的消息列表
+            updated_at TIMESTAMP,
+            UNIQUE(uuid, event_tag)
+        )
+    ''')
+
+
+def _normalize_memory_tables(db):
+    """
+    v2: 记忆块规范化存储。
+    每个记忆块只在 memory_blocks 中存一份，通过 block_tags 关联到 tags；
+    原 chat_memories 中每个标签的整段记忆迁移为一个记忆块（内容完全相同的只存一份），
+    旧表重命名为 chat_memories_legacy 保留备查。
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS memory_blocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT NOT NULL,
+            memory_content TEXT NOT NULL, -- 序列化后的消息列表
+            created_at TIMESTAMP
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS tags (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT NOT NULL,
+            event_tag TEXT NOT NULL,
+            updated_at TIMESTAMP,
+            UNIQUE(uuid, event_tag)
+        )
+    ''')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS block_tags (
+            tag_id INTEGER NOT NULL REFERENCES tags(id),
+            block_id INTEGER NOT NULL REFERENCES memory_blocks(id),
+            PRIMARY KEY (tag_id, block_id)
+        ) WITHOUT ROWID
+    ''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_memory_blocks_uuid ON memory_blocks (uuid)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_block_tags_block ON block_tags (block_id)")
+
+    block_ids = {}
+    rows = db.execute(
+        "SELECT uuid, event_tag, memory_content, updated_at FROM chat_memories ORDER BY id"
+    ).fetchall()
+    for user_uuid, tag, content, updated_at in rows:
+        if not content:
+            continue
+        block_id = block_ids.get((user_uuid, content))
+        if block_id is None:
+            block_id = db.execute(
+                "INSERT INTO memory_blocks (uuid, memory_content, created_at) VALUES (?, ?, ?)",
+                (user_uuid, content, updated_at)
+            ).lastrowid
+            block_ids[(user_uuid, content)] = block_id
+        tag_id = db.execute(
+            "INSERT INTO tags (uuid, event_tag, updated_at) VALUES (?, ?, ?)",
+            (user_uuid, tag, updated_at)
+        ).lastrowid
+        db.execute("INSERT INTO block_tags (tag_id, block_id) VALUES (?, ?)", (tag_id, block_id))
+    db.execute("ALTER TABLE chat_memories RENAME TO chat_memories_legacy")
+    if rows:
+        logger.info("已将 %d 条旧版标签记忆迁移为 %d 个记忆块。", len(rows), len(block_ids))
+
+
+def _create_summary_tables(db):
+    """v3: 滚动摘要。被移出短期记忆窗口的消息先写入 summary_pending，再由后台任务依次折叠进会话摘要。"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS summary_pending (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT NOT NULL,
+            memory_content TEXT NOT NULL, -- 序列化后的消息列表
+            created_at TIMESTAMP
+        )
+    ''')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_summary_pending_uuid ON summary_pending (uuid, id)")
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            uuid TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            folded_until INTEGER NOT NULL DEFAULT 0, -- 已折叠的最后一条 summary_pending.id
+            updated_at TIMESTAMP
+        )
+    ''')
+
+
+def _create_memory_fts(db):
+    """
+    v4: 记忆块的 FTS5 全文索引（无内容表，rowid 即 memory_blocks.id）。
+    记忆块内容是序列化后的消息，触发器里无法解析，因此由 add_memory 在同一事务中写入，这里回填已有记忆块。
+    """
+    db.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS memory_blocks_fts USING fts5(owner, grams, content='', tokenize='unicode61')"
+    )
+    for block_id, user_uuid, content in db.execute("SELECT id, uuid, memory_content FROM memory_blocks").fetchall():
+        db.execute("INSERT INTO memory_blocks_fts (rowid, owner, grams) VALUES (?, ?, ?)",
+                   (block_id, owner_token(user_uuid), cjk_ngrams(messages_text(decode_messages(content)))))
+
+
+def _add_block_source_key(db):
+    """
+    v5: 记忆块来源键。后台任务以任务幂等键写入记忆块，同一来源只保存一次，任务重试不会重复写入。
+    """
+    db.execute("ALTER TABLE memory_blocks ADD COLUMN source_key TEXT")
+    db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_memory_blocks_source
+        ON memory_blocks (uuid, source_key) WHERE source_key IS NOT NULL
+    ''')
+
+
+# memory_data.db 的表结构迁移，版本号记录在 PRAGMA user_version 中
+MEMORY_DB_MIGRATIONS = [
+    (1, '创建人物简介/聊天记忆表', _create_memory_tables),
+    (2, '记忆块/标签规范化存储', _normalize_memory_tables),
+    (3, '滚动摘要', _create_summary_tables),
+    (4, '记忆块全文索引', _create_memory_fts),
+    (5, '记忆块来源键', _add_block_source_key),
+]
+
+
+class TagCache:
+    """
+    进程内的事件标签缓存，按 (数据库路径, uuid) 保存标签列表，超过容量时淘汰最久未使用的会话。
+    标签只会由 add_memory 写入，add_memory 提交后直接把新标签追加到缓存（write-through），
+    因此聊天热路径上的 get_all_tags 在标签没有变化时不会访问数据库。
+    """
+
+    def __init__(self, max_entries: int = MEMORY_TAG_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str, str], list[str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple[str, str]) -> list[str] | None:
+        with self._lock:
+            tags = self._entries.get(key)
+            if tags is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(tags)
+
+    def put(self, key: tuple[str, str], tags: list[str]):
+        with self._lock:
+            self._entries[key] = list(tags)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add_tags(self, key: tuple[str, str], tags: list[str]):
+        """把新写入的标签追加到已缓存的列表；未缓存的会话不做处理，下次读取时再从数据库加载。"""
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return
+            for tag in tags:
+                if tag not in cached:
+                    cached.append(tag)
+
+    def invalidate(self, key: tuple[str, str] | None = None):
+        """清除某个会话（key 为 None 时清除全部）的缓存。"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+# 所有 DatabaseManager 实例共享同一个标签缓存（talk_agent 与 generate_talks 各自创建了实例）
+tag_cache = TagCache()
+# 滚动摘要缓存：(数据库路径, uuid) -> 摘要（没有摘要时为空字符串）。摘要只在折叠任务 save_summary 时变化，
+# 每轮对话的 generate_talk 读取时不必访问数据库
+summary_cache = TTLCache(MEMORY_TAG_CACHE_SIZE, SUMMARY_CACHE_TTL)
+
+
+@instrument_methods('memory_db')
 class DatabaseManager:
     """
     一个用于管理人物简介和聊天记忆的数据库操作类。
@@ -12,139 +220,276 @@ class DatabaseManager:
 
     def __init__(self, db_path="memory_data.db"):
         """
-        初始化数据库路径。连接将在每个同步方法中按需创建。
+        初始化数据库路径。连接从 db_pool 连接池中按需借出，用完即归还。
         :param db_path: SQLite数据库文件的路径。
         """
         self.db_path = db_path
+        self.pool = get_pool(db_path)
+        self.initialize()
 
 
     def initialize(self):
         """
-        ### CHANGE: New sync method to set up tables.
-        This must be called once after creating an instance of the class.
+        执行尚未应用的表结构迁移。每个进程只会在第一次调用时真正访问数据库，重复调用是安全的。
         """
-        with sqlite3.connect(self.db_path) as db:
-            db.execute('''
-                CREATE TABLE IF NOT EXISTS character_profiles (
-                    uuid TEXT PRIMARY KEY,
-                    profile_content TEXT,
-                    updated_at TIMESTAMP
-                )
-            ''')
-            db.execute('''
-                CREATE TABLE IF NOT EXISTS chat_memories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    uuid TEXT NOT NULL,
-                    event_tag TEXT NOT NULL,
-                    memory_content TEXT, -- 将存储序列化后的消息列表
-                    updated_at TIMESTAMP,
-                    UNIQUE(uuid, event_tag)
-                )
-            ''')
-            db.commit()
+        self.pool.migrate(MEMORY_DB_MIGRATIONS)
 
     def add_or_update_profile(self, user_uuid: str, content: str):
         """
         ### CHANGE: Converted to sync.
         添加或更新用户简介。
         """
-        print(f"[*] (Sync) 正在为 UUID: {user_uuid} 添加/更新简介...")
-        with sqlite3.connect(self.db_path) as db:
+        logger.debug("正在为 UUID: %s 添加/更新简介...", user_uuid)
+        with self.pool.connection() as db:
             db.execute('''
                 INSERT OR REPLACE INTO character_profiles (uuid, profile_content, updated_at)
                 VALUES (?, ?, ?)
             ''', (user_uuid, content, datetime.now()))
             db.commit()
-        print(f"[+] (Sync) 简介操作完成。")
+        logger.debug("简介操作完成。")
 
     def get_profile(self, user_uuid: str) -> str | None:
         """
         ### CHANGE: Converted to sync.
         根据uuid查询人物简介。
         """
-        with sqlite3.connect(self.db_path) as db:
+        with self.pool.connection() as db:
             cursor = db.execute("SELECT profile_content FROM character_profiles WHERE uuid = ?",
                                   (user_uuid,))
             result = cursor.fetchone()
         return result[0] if result else None
 
-    def add_memory(self, user_uuid: str, event_tags: list[str], new_messages: list[BaseMessage]):
+    def has_memory_block(self, user_uuid: str, source_key: str) -> bool:
+        """该会话是否已经存在来源键为 source_key 的记忆块。"""
+        with self.pool.connection() as db:
+            row = db.execute("SELECT 1 FROM memory_blocks WHERE uuid = ? AND source_key = ?",
+                             (user_uuid, source_key)).fetchone()
+        return row is not None
+
+    def add_memory(self, user_uuid: str, event_tags: list[str], new_messages: list[BaseMessage],
+                   source_key: str | None = None):
         """
-        ### CHANGE: Converted to sync.
-        【核心功能修改】存储或叠加 LangChain 消息对象列表到多个标签。
+        存储一个记忆块并关联到多个标签。
+        记忆块只写入一次，每个标签只增加一条关联记录，不再读取和重写已有记忆，写入开销只与本次块大小有关。
+        :param source_key: 来源幂等键（如后台任务的幂等键）。同一会话下已存在相同来源的记忆块时不再写入。
         """
         if not event_tags or not new_messages:
-            print("[!] 警告：传入的标签或消息为空，操作已跳过。")
+            logger.warning("传入的标签或消息为空，操作已跳过。")
             return
 
-        print(f"[*] (Sync) 正在为 UUID: {user_uuid} 的事件标签 {event_tags} 添加/叠加 {len(new_messages)} 条消息...")
+        logger.debug("正在为 UUID: %s 的事件标签 %s 添加 %d 条消息的记忆块...", user_uuid, event_tags, len(new_messages))
 
-        with sqlite3.connect(self.db_path) as db:
-            for tag in event_tags:
-                cursor = db.execute(
-                        "SELECT memory_content FROM chat_memories WHERE uuid = ? AND event_tag = ?",
-                        (user_uuid, tag)
+        now = datetime.now()
+        with self.pool.connection() as db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO memory_blocks (uuid, memory_content, created_at, source_key) VALUES (?, ?, ?, ?)",
+                (user_uuid, encode_messages(new_messages), now, source_key)
+            )
+            if cursor.rowcount == 0:
+                logger.info("来源 %s 的记忆块已存在，跳过写入。", source_key)
+                return
+            block_id = cursor.lastrowid
+            db.execute("INSERT INTO memory_blocks_fts (rowid, owner, grams) VALUES (?, ?, ?)",
+                       (block_id, owner_token(user_uuid), cjk_ngrams(messages_text(new_messages))))
+            for tag in dict.fromkeys(event_tags):
+                db.execute('''
+                    INSERT INTO tags (uuid, event_tag, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(uuid, event_tag) DO UPDATE SET updated_at = excluded.updated_at
+                ''', (user_uuid, tag, now))
+                tag_id = db.execute(
+                    "SELECT id FROM tags WHERE uuid = ? AND event_tag = ?", (user_uuid, tag)
+                ).fetchone()[0]
+                db.execute(
+                    "INSERT OR IGNORE INTO block_tags (tag_id, block_id) VALUES (?, ?)", (tag_id, block_id)
                 )
-                result = cursor.fetchone()
-
-                if result and result[0]:
-                    print(f"    - 标签 '{tag}': 发现已有记忆，进行叠加...")
-                    existing_messages = loads(result[0])
-                    combined_messages = existing_messages + new_messages
-                    updated_serialized_memory = dumps(combined_messages)
-                    db.execute('''
-                        UPDATE chat_memories
-                        SET memory_content = ?, updated_at = ?
-                        WHERE uuid = ? AND event_tag = ?
-                    ''', (updated_serialized_memory, datetime.now(), user_uuid, tag))
-                else:
-                    print(f"    - 标签 '{tag}': 未发现记忆，创建新条目...")
-                    serialized_new_messages = dumps(new_messages)
-                    db.execute('''
-                        INSERT INTO chat_memories (uuid, event_tag, memory_content, updated_at)
-                        VALUES (?, ?, ?, ?)
-                    ''', (user_uuid, tag, serialized_new_messages, datetime.now()))
-
-            db.commit()
-        print(f"[+] (Sync) 记忆操作完成。")
+        # 事务提交后再更新缓存，避免缓存里出现回滚掉的标签
+        tag_cache.add_tags((self.db_path, user_uuid), list(dict.fromkeys(event_tags)))
+        get_memory_index().add_block(user_uuid, block_id, new_messages, list(dict.fromkeys(event_tags)))
+        logger.debug("记忆操作完成。")
 
     def get_memory(self, user_uuid: str, event_tag: str) -> list[BaseMessage] | None:
         """
-        ### CHANGE: Converted to sync.
-        【核心功能修改】根据uuid和事件标签查询聊天记忆。
+        根据uuid和事件标签查询聊天记忆：按写入顺序拼接该标签下的所有记忆块。
         """
-        with sqlite3.connect(self.db_path) as db:
-            cursor = db.execute(
-                    "SELECT memory_content FROM chat_memories WHERE uuid = ? AND event_tag = ?",
-                    (user_uuid, event_tag)
-            )
-            result = cursor.fetchone()
+        with self.pool.connection() as db:
+            cursor = db.execute('''
+                SELECT b.memory_content FROM tags t
+                JOIN block_tags bt ON bt.tag_id = t.id
+                JOIN memory_blocks b ON b.id = bt.block_id
+                WHERE t.uuid = ? AND t.event_tag = ?
+                ORDER BY b.id
+            ''', (user_uuid, event_tag))
+            results = cursor.fetchall()
+
+        if not results:
+            return None
+        messages = []
+        for row in results:
+            messages.extend(decode_messages(row[0]))
+        return messages
+
+    def search_memory(self, user_uuid: str, query: str, limit: int = 5) -> list[dict]:
+        """
+        在该用户的记忆块中全文检索，按 BM25 相关度排序（score 越小越相关）。
+        :return: [{'block_id': 记忆块 id, 'tags': 关联的标签列表, 'score': BM25 分数}, ...]
+        """
+        match = build_match_query(query, user_uuid)
+        if not match:
+            return []
+        with self.pool.connection() as db:
+            rows = db.execute('''
+                SELECT b.id, bm25(memory_blocks_fts, 0.0, 1.0) AS score,
+                       (SELECT group_concat(t.event_tag, char(31)) FROM block_tags bt
+                        JOIN tags t ON t.id = bt.tag_id WHERE bt.block_id = b.id) AS tags
+                FROM memory_blocks_fts JOIN memory_blocks b ON b.id = memory_blocks_fts.rowid
+                WHERE memory_blocks_fts MATCH ?
+                ORDER BY score LIMIT ?
+            ''', (match, limit)).fetchall()
+        return [{'block_id': row[0], 'score': row[1], 'tags': row[2].split(chr(31)) if row[2] else []}
+                for row in rows]
+
+    def retrieve_snippets(self, user_uuid: str, event_tags: list[str], query: str, token_budget: int,
+                          window: int = MEMORY_SNIPPET_WINDOW) -> list[dict]:
+        """
+        在多个标签的记忆块内检索与询问最相关的消息片段，而不是返回标签下的全部记忆。
+        每个记忆块按 window 条消息、半个窗口的步长切成滑动窗口，用 memory_index 的哈希向量与询问打分，
+        按得分从高到低挑选互不重叠的窗口，直到用完 token_budget（得分相同时优先较新的内容；已有相关片段时不补充零分窗口）。
+        :return: 按时间顺序排列的片段列表，每项为
+                 {'tag': 归属的标签（记忆块命中的第一个询问标签）, 'tags': 记忆块命中的全部询问标签, 'block_id': 记忆块 id, 'start': 窗口起点, 'messages': 消息列表, 'score': 相似度, 'tokens': token 数}
+        """
+        event_tags = list(dict.fromkeys(event_tags))
+        if not event_tags:
+            return []
+        placeholders = ', '.join('?' * len(event_tags))
+        with self.pool.connection() as db:
+            rows = db.execute(f'''
+                SELECT b.id, b.memory_content, group_concat(t.event_tag, char(31)) FROM tags t
+                JOIN block_tags bt ON bt.tag_id = t.id
+                JOIN memory_blocks b ON b.id = bt.block_id
+                WHERE t.uuid = ? AND t.event_tag IN ({placeholders})
+                GROUP BY b.id
+                ORDER BY b.id
+            ''', (user_uuid, *event_tags)).fetchall()
 
-        if result and result[0]:
-            return loads(result[0])
-        return None
+        candidates = []
+        step = max(1, window // 2)
+        for block_id, content, block_tags in rows:
+            messages = decode_messages(content)
+            # 一个记忆块可能同时带有多个被询问的标签；片段只归属于按询问顺序的第一个，避免同一内容进入多条召回
+            tags = [tag for tag in event_tags if tag in block_tags.split(chr(31))]
+            for start in range(0, max(1, len(messages) - window + step), step):
+                lines = [render_message(m) for m in messages[start:start + window]]
+                candidates.append({'tag': tags[0], 'tags': tags, 'block_id': block_id, 'start': start,
+                                   'messages': messages[start:start + window],
+                                   'text': '\n'.join(lines), 'tokens': sum(count_tokens(l) + 1 for l in lines)})
+        if not candidates:
+            return []
+
+        vectorizer = get_memory_index().vectorizer
+        scores = vectorizer.transform([c['text'] for c in candidates]) @ vectorizer.transform([query])[0]
+        for candidate, score in zip(candidates, scores.tolist()):
+            candidate['score'] = score
+
+        selected, used = [], 0
+        for candidate in sorted(candidates, key=lambda c: (c['score'], c['block_id'], c['start']), reverse=True):
+            if selected and candidate['score'] <= 0:
+                break  # 已有相关片段时不再用无关内容凑满预算
+            if used + candidate['tokens'] > token_budget:
+                continue
+            if any(s['block_id'] == candidate['block_id'] and abs(s['start'] - candidate['start']) < window
+                   for s in selected):
+                continue
+            selected.append(candidate)
+            used += candidate['tokens']
+        selected.sort(key=lambda c: (c['block_id'], c['start']))
+        for candidate in selected:
+            del candidate['text']
+        logger.debug("从标签 %s 的 %d 个记忆块中检索到 %d 个片段，共 %d tokens。", event_tags, len(rows), len(selected), used)
+        return selected
+
+    def get_blocks_since(self, user_uuid: str, after_id: int = 0) -> list[tuple[int, list[BaseMessage], list[str]]]:
+        """
+        按写入顺序返回 id 大于 after_id 的记忆块，供 memory_index 增量构建索引。
+        :return: [(记忆块 id, 消息列表, 关联的标签列表), ...]
+        """
+        with self.pool.connection() as db:
+            rows = db.execute('''
+                SELECT b.id, b.memory_content, group_concat(t.event_tag, char(31)) FROM memory_blocks b
+                JOIN block_tags bt ON bt.block_id = b.id
+                JOIN tags t ON t.id = bt.tag_id
+                WHERE b.uuid = ? AND b.id > ?
+                GROUP BY b.id
+                ORDER BY b.id
+            ''', (user_uuid, after_id)).fetchall()
+        return [(row[0], decode_messages(row[1]), row[2].split(chr(31))) for row in rows]
 
     def get_all_tags(self, user_uuid: str) -> list[str]:
         """
-        ### CHANGE: Converted to sync.
         根据uuid查询该用户拥有的所有事件标签。
+        优先读取进程内标签缓存，未命中时才查询数据库并写入缓存。
         """
-        print(f"[*] (Sync) 正在查询 UUID: {user_uuid} 的所有标签...")
-        with sqlite3.connect(self.db_path) as db:
+        key = (self.db_path, user_uuid)
+        tags = tag_cache.get(key)
+        if tags is not None:
+            return tags
+
+        with self.pool.connection() as db:
             cursor = db.execute(
-                    "SELECT DISTINCT event_tag FROM chat_memories WHERE uuid = ?",
+                    "SELECT event_tag FROM tags WHERE uuid = ? ORDER BY id",
                     (user_uuid,)
             )
             results = cursor.fetchall()
 
         tags = [row[0] for row in results]
-        print(f"[+] (Sync) 查询到标签: {tags}")
-        return tags
+        tag_cache.put(key, tags)
+        logger.debug("已从数据库加载 UUID: %s 的 %d 个标签。", user_uuid, len(tags))
+        return list(tags)
+
 
+    def add_pending_summary(self, user_uuid: str, messages: list[BaseMessage]) -> int:
+        """记录一批被移出短期记忆窗口、等待折叠进摘要的消息，返回记录 id。"""
+        with self.pool.connection() as db:
+            return db.execute(
+                "INSERT INTO summary_pending (uuid, memory_content, created_at) VALUES (?, ?, ?)",
+                (user_uuid, encode_messages(messages), datetime.now())
+            ).lastrowid
+
+    def get_pending_summaries(self, user_uuid: str) -> list[tuple[int, list[BaseMessage]]]:
+        """按写入顺序返回尚未折叠的消息批次: [(记录 id, 消息列表), ...]"""
+        with self.pool.connection() as db:
+            rows = db.execute(
+                "SELECT id, memory_content FROM summary_pending WHERE uuid = ? ORDER BY id", (user_uuid,)
+            ).fetchall()
+        return [(row[0], decode_messages(row[1])) for row in rows]
+
+    def get_summary(self, user_uuid: str) -> str | None:
+        """查询会话的滚动摘要，优先读取进程内缓存。"""
+        key = (self.db_path, user_uuid)
+        summary = summary_cache.get(key)
+        if summary is None:
+            with self.pool.connection() as db:
+                row = db.execute(
+                    "SELECT summary FROM conversation_summaries WHERE uuid = ?", (user_uuid,)
+                ).fetchone()
+            summary = row[0] if row else ''
+            summary_cache.set(key, summary)
+        return summary or None
+
+    def save_summary(self, user_uuid: str, summary: str, folded_until: int):
+        """在同一个事务中更新摘要并删除已折叠的消息批次。"""
+        with self.pool.connection() as db:
+            db.execute('''
+                INSERT INTO conversation_summaries (uuid, summary, folded_until, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(uuid) DO UPDATE SET
+                    summary = excluded.summary, folded_until = excluded.folded_until, updated_at = excluded.updated_at
+            ''', (user_uuid, summary, folded_until, datetime.now()))
+            db.execute("DELETE FROM summary_pending WHERE uuid = ? AND id <= ?", (user_uuid, folded_until))
+        # 事务提交后再更新缓存
+        summary_cache.set((self.db_path, user_uuid), summary)
 
     def close(self):
-        """(Sync) 关闭数据库连接。在使用 'with' 模式下，此方法不是必需的。"""
-        print("[*] (Sync) 数据库操作模式不需要手动关闭连接。")
+        """(Sync) 连接由连接池管理，此方法不是必需的。"""
+        logger.debug("数据库连接由连接池管理，不需要手动关闭。")
         pass
 
 
@@ -0,0 +1,144 @@
+# image_store.py
+"""
+按内容寻址的生成图片存储。
+
+模型返回的图片字节按 SHA-256 命名（取前 32 位十六进制），转码为 WebP 写入 talk_picture 目录，
+同时按 IMAGE_THUMB_WIDTHS 生成等比缩放的缩略图（{hash}_{宽}.webp）。同一张图片重复保存只会落盘一次，
+并发生成的不同图片也不会互相覆盖。图片与各尺寸的元数据（宽高、字节数）记录在 SQLite 中，
+图片路由据此为请求的宽度挑选最合适的文件，并以“哈希 + 宽度”作为 ETag。
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from base import IMAGE_STORE_DIR, IMAGE_STORE_DB, IMAGE_WEBP_QUALITY, IMAGE_THUMB_WIDTHS
+from db_pool import get_pool
+from metrics import BYTES_WRITTEN
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+_HASHED_NAME = re.compile(r'^([0-9a-f]{32})(?:_\d+)?\.webp$')
+
+
+def _create_image_tables(conn):
+    """v1: 图片与缩略图元数据。width 为 0 的行是原尺寸图片。"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_variants (
+            hash TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            pixel_width INTEGER NOT NULL,
+            pixel_height INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (hash, width)
+        ) WITHOUT ROWID
+    ''')
+
+
+IMAGE_STORE_MIGRATIONS = [
+    (1, '创建图片元数据表', _create_image_tables),
+]
+
+
+class ImageStore:
+    """图片落盘、缩略图生成与按宽度查找。"""
+
+    def __init__(self, root: str = IMAGE_STORE_DIR, db_path: str = IMAGE_STORE_DB,
+                 quality: int = IMAGE_WEBP_QUALITY, thumb_widths: tuple = IMAGE_THUMB_WIDTHS):
+        self.root = root
+        self.quality = quality
+        self.thumb_widths = sorted(thumb_widths)
+        os.makedirs(root, exist_ok=True)
+        self.pool = get_pool(db_path)
+        self.pool.migrate(IMAGE_STORE_MIGRATIONS)
+
+    def _write_webp(self, image: Image.Image, path: str) -> int:
+        """先写临时文件再原子替换，读者不会看到写了一半的图片。返回文件字节数。"""
+        buffer = BytesIO()
+        image.save(buffer, format='WEBP', quality=self.quality, method=4)
+        data = buffer.getvalue()
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    def save(self, data: bytes) -> str:
+        """
+        保存图片字节（任意 PIL 可读格式），返回原尺寸 WebP 的相对路径（如 talk_picture/<hash>.webp）。
+        """
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        path = os.path.join(self.root, f'{digest}.webp')
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT path FROM image_variants WHERE hash = ? AND width = 0", (digest,)).fetchone()
+        if row and os.path.exists(row[0]):
+            return row[0]
+
+        image = Image.open(BytesIO(data))
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        variants = [(0, path, image.width, image.height, self._write_webp(image, path))]
+        for width in self.thumb_widths:
+            if width >= image.width:
+                continue
+            thumb = image.copy()
+            thumb.thumbnail((width, image.height * width // image.width + 1), Image.LANCZOS)
+            thumb_path = os.path.join(self.root, f'{digest}_{width}.webp')
+            variants.append((width, thumb_path, thumb.width, thumb.height, self._write_webp(thumb, thumb_path)))
+
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO image_variants (hash, width, path, pixel_width, pixel_height, bytes, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(digest, *variant, now) for variant in variants])
+        saved = sum(variant[4] for variant in variants)
+        BYTES_WRITTEN.inc(saved, store='image_store')
+        logger.info("保存图片 %s: 原图 %d 字节 -> WebP 及 %d 个缩略图共 %d 字节",
+                    path, len(data), len(variants) - 1, saved)
+        return path
+
+    def resolve(self, filename: str, width: int | None = None) -> tuple[str, str | None]:
+        """
+        为请求的图片路径挑选要发送的文件：宽度不小于 width 的最小缩略图，没有时用原图。
+        :return: (相对路径, ETag)。不是由本存储生成的旧图片原样返回，ETag 为 None（交给文件系统信息生成）。
+        """
+        match = _HASHED_NAME.match(os.path.basename(filename))
+        if not match:
+            return filename, None
+        digest = match.group(1)
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                "SELECT width, path FROM image_variants WHERE hash = ? ORDER BY width", (digest,)
+            ).fetchall()
+        if not rows:
+            return filename, None
+        original = next(((w, p) for w, p in rows if w == 0), rows[-1])
+        chosen = original
+        if width:
+            thumbs = [(w, p) for w, p in rows if w >= width]
+            if thumbs:
+                chosen = thumbs[0]
+        return chosen[1].replace('\\', '/'), f'{digest}-{chosen[0] or "full"}'
+
+
+_image_store = None
+_image_store_lock = threading.Lock()
+
+
+def get_image_store() -> ImageStore:
+    """获取进程内共享的图片存储（懒加载）。"""
+    global _image_store
+    if _image_store is None:
+        with _image_store_lock:
+            if _image_store is None:
+                _image_store = ImageStore()
+    return _image_store
@@ -0,0 +1,293 @@
+# job_queue.py
+"""
+基于 SQLite 的持久化后台任务队列。
+任务先写入数据库再由工作线程领取执行。领取时记录工作者 id 和租约到期时间，执行期间由心跳线程续约；
+进程崩溃后租约不再续期，过期的 running 任务会被任一进程重新领取，仍在执行的任务不会被其他进程抢走。
+支持失败重试（指数退避）和幂等键（同一个键只会入队一次）。
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable
+
+from base import JOB_QUEUE_DB, JOB_QUEUE_WORKERS, JOB_MAX_ATTEMPTS, JOB_RETRY_DELAY, JOB_LEASE_SECONDS
+from db_pool import get_pool
+from app_logging import get_logger, fields
+
+logger = get_logger(__name__)
+
+# 任务状态
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+def _create_jobs_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            idempotency_key TEXT UNIQUE,
+            payload TEXT NOT NULL, -- JSON
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            last_error TEXT,
+            result TEXT, -- JSON
+            run_after REAL NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)")
+
+
+def _add_job_lease(conn):
+    # 旧版本遗留的 running 任务没有租约，视为已过期，可直接重新领取
+    conn.execute("ALTER TABLE jobs ADD COLUMN worker_id TEXT")
+    conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+
+
+MIGRATIONS = [
+    (1, '任务表', _create_jobs_table),
+    (2, '任务租约（工作者 id、租约到期时间）', _add_job_lease),
+]
+
+
+class JobQueue:
+    """
+    一个简单的 SQLite 任务队列。
+    每个工作线程持有自己的连接，领取任务时使用 BEGIN IMMEDIATE 保证同一任务只会被一个线程拿到。
+    多个进程可以共用同一个队列数据库：每个实例有自己的工作者 id，只续约、完成自己领取的任务。
+    """
+
+    def __init__(self, db_path=JOB_QUEUE_DB, workers=JOB_QUEUE_WORKERS,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY, poll_interval=2.0,
+                 lease_seconds=JOB_LEASE_SECONDS):
+        """
+        :param db_path: 队列数据库文件路径。
+        :param workers: 工作线程数量。
+        :param max_attempts: 每个任务的默认最大尝试次数。
+        :param retry_delay: 首次重试的等待秒数，之后每次翻倍。
+        :param poll_interval: 队列为空时工作线程的轮询间隔（秒）。
+        :param lease_seconds: 任务租约时长（秒），心跳每三分之一租约续约一次。
+        """
+        self.db_path = db_path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._handlers: dict[str, Callable[[dict], Any]] = {}
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._start_lock = threading.Lock()
+        self._create_table()
+
+    def _connect(self):
+        """获取当前线程的数据库连接（按线程复用）。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: 由我们自己控制事务边界
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _create_table(self):
+        get_pool(self.db_path).migrate(MIGRATIONS)
+
+    def register(self, kind: str, handler: Callable[[dict], Any]):
+        """注册某类任务的处理函数。处理函数接收 payload 字典，返回值需可被 JSON 序列化。"""
+        self._handlers[kind] = handler
+
+    def enqueue(self, kind: str, payload: dict, idempotency_key: str | None = None,
+                max_attempts: int | None = None) -> int:
+        """
+        入队一个任务。
+        :param idempotency_key: 幂等键，已存在同键任务时直接返回该任务的 id，不会重复入队。
+        :return: 任务 id。
+        """
+        conn = self._connect()
+        cursor = conn.execute(
+            """
+            INSERT OR IGNORE INTO jobs (kind, idempotency_key, payload, status, max_attempts, run_after)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (kind, idempotency_key, json.dumps(payload, ensure_ascii=False), PENDING,
+             max_attempts or self.max_attempts, time.time())
+        )
+        if cursor.rowcount == 0:
+            row = conn.execute("SELECT id FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+            logger.debug("幂等键 %s 已存在，复用任务 %s", idempotency_key, row['id'])
+            return row['id']
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def get_job(self, job_id: int) -> dict | None:
+        """查询任务状态，不存在时返回 None。"""
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def start(self):
+        """
+        启动工作线程和租约心跳线程（重复调用是安全的）。
+        不在启动时重置 running 任务：它们可能正由其他进程执行，只有租约过期后才会被重新领取。
+        """
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f'job_worker_{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            heartbeat = threading.Thread(target=self._heartbeat_loop, name='job_heartbeat', daemon=True)
+            heartbeat.start()
+            self._threads.append(heartbeat)
+            logger.info("已启动 %d 个工作线程，工作者 %s，数据库: %s", self.workers, self.worker_id, self.db_path)
+
+    def stop(self, timeout: float | None = None):
+        """通知工作线程退出并等待结束。"""
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _claim(self) -> sqlite3.Row | None:
+        """
+        领取一个到期的待执行任务，或租约已过期的 running 任务（执行它的进程已退出），
+        将其标记为 running 并写入本实例的工作者 id 和租约。
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 租约过期且已用完尝试次数的任务不再重新执行
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?, last_error = '租约过期：执行任务的进程已退出', updated_at = CURRENT_TIMESTAMP
+                WHERE status = ? AND (lease_until IS NULL OR lease_until < ?) AND attempts >= max_attempts
+                """,
+                (FAILED, RUNNING, now)
+            )
+            row = conn.execute(
+                """
+                SELECT * FROM jobs
+                WHERE (status = ? AND run_after <= ?) OR (status = ? AND (lease_until IS NULL OR lease_until < ?))
+                ORDER BY id LIMIT 1
+                """,
+                (PENDING, now, RUNNING, now)
+            ).fetchone()
+            if row:
+                if row['status'] == RUNNING:
+                    logger.warning("任务租约已过期，重新领取", extra=fields(job_id=row['id'], kind=row['kind'],
+                                                                       previous_worker=row['worker_id']))
+                conn.execute(
+                    """
+                    UPDATE jobs SET status = ?, attempts = attempts + 1, worker_id = ?, lease_until = ?,
+                                    updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                    """,
+                    (RUNNING, self.worker_id, now + self.lease_seconds, row['id'])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def _renew_leases(self):
+        """为本实例正在执行的任务续约。"""
+        self._connect().execute(
+            "UPDATE jobs SET lease_until = ? WHERE status = ? AND worker_id = ?",
+            (time.time() + self.lease_seconds, RUNNING, self.worker_id)
+        )
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                self._renew_leases()
+            except sqlite3.OperationalError as e:
+                logger.warning("任务续约失败: %s", e)
+
+    def _finish(self, job_id: int, result: Any):
+        cursor = self._connect().execute(
+            """
+            UPDATE jobs SET status = ?, result = ?, last_error = NULL, lease_until = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND worker_id = ?
+            """,
+            (SUCCEEDED, json.dumps(result, ensure_ascii=False), job_id, self.worker_id)
+        )
+        if cursor.rowcount == 0:
+            logger.warning("任务租约已被其他工作者接管，忽略本次结果", extra=fields(job_id=job_id))
+
+    def _fail(self, job: sqlite3.Row, error: str):
+        attempts = job['attempts'] + 1
+        if attempts < job['max_attempts']:
+            delay = self.retry_delay * (2 ** (attempts - 1))
+            status, run_after = PENDING, time.time() + delay
+            logger.warning("任务第 %d 次失败，%s 秒后重试", attempts, delay,
+                           extra=fields(job_id=job['id'], kind=job['kind']))
+        else:
+            status, run_after = FAILED, job['run_after']
+            logger.error("任务已达最大尝试次数，标记为失败", extra=fields(job_id=job['id'], kind=job['kind']))
+        self._connect().execute(
+            """
+            UPDATE jobs SET status = ?, last_error = ?, run_after = ?, lease_until = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND worker_id = ?
+            """,
+            (status, error, run_after, job['id'], self.worker_id)
+        )
+
+    def _run(self, job: sqlite3.Row):
+        handler = self._handlers.get(job['kind'])
+        try:
+            if handler is None:
+                raise LookupError(f"未注册的任务类型: {job['kind']}")
+            result = handler(json.loads(job['payload']))
+        except Exception as e:
+            logger.exception("任务执行失败", extra=fields(job_id=job['id'], kind=job['kind']))
+            self._fail(job, f"{type(e).__name__}: {e}")
+        else:
+            self._finish(job['id'], result)
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.OperationalError as e:
+                logger.warning("领取任务失败: %s", e)
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """获取进程内共享的任务队列实例（懒加载）。"""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue()
+    return _job_queue
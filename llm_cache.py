@@ -0,0 +1,162 @@
+# llm_cache.py
+"""
+分类类 LLM 调用的持久化响应缓存。
+
+配图判断、记忆路由、记忆块打标签这类调用的输出只取决于输入，图因出错、重试或客户端重连而重跑时，
+相同的 prompt 不必再付一次费用。缓存键是“节点名 + 模型参数 + 渲染后的完整 prompt”的 SHA-256，
+值为解析器输出的 JSON，存放在 SQLite 中，按 TTL 过期，并在条目数超过上限时淘汰最久未命中的记录。
+只有在 base.NODE_CACHE_TTL 中配置了 TTL 的节点才会走缓存。
+"""
+import hashlib
+import json
+import threading
+import time
+from typing import Any
+
+from base import LLM_CACHE_DB, LLM_CACHE_MAX_ENTRIES, NODE_CACHE_TTL
+from db_pool import get_pool
+from llm_router import get_router
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 每写入多少条执行一次过期清理和容量淘汰
+_SWEEP_EVERY = 50
+
+
+def _create_cache_table(conn):
+    """v1: 响应缓存表。"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            node TEXT NOT NULL,
+            value TEXT NOT NULL, -- JSON
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            last_hit_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_cache (expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_hit ON llm_cache (last_hit_at)")
+
+
+LLM_CACHE_MIGRATIONS = [
+    (1, '创建 LLM 响应缓存表', _create_cache_table),
+]
+
+
+def _model_signature(llm) -> dict:
+    """参与缓存键计算的模型参数：换模型或调温度后不会命中旧结果。"""
+    return {
+        'class': type(llm).__name__,
+        'model': getattr(llm, 'model_name', None) or getattr(llm, 'model', None),
+        'base_url': str(getattr(llm, 'openai_api_base', '') or ''),
+        'temperature': getattr(llm, 'temperature', None),
+    }
+
+
+class LLMCache:
+    """SQLite 响应缓存，带 TTL、容量上限和按节点的命中统计。"""
+
+    def __init__(self, db_path: str = LLM_CACHE_DB, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.pool = get_pool(db_path)
+        self.pool.migrate(LLM_CACHE_MIGRATIONS)
+        self.max_entries = max_entries
+        self._stats: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def _count(self, node: str, field: str):
+        with self._lock:
+            stats = self._stats.setdefault(node, {'hits': 0, 'misses': 0})
+            stats[field] += 1
+
+    @staticmethod
+    def make_key(node: str, llms: list, prompt_text: str) -> str:
+        payload = json.dumps({'node': node, 'llm': [_model_signature(llm) for llm in llms], 'prompt': prompt_text},
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, node: str, key: str) -> tuple[bool, Any]:
+        """返回 (是否命中, 缓存值)。"""
+        now = time.time()
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE llm_cache SET hits = hits + 1, last_hit_at = ? WHERE key = ?", (now, key))
+        self._count(node, 'hits' if row else 'misses')
+        return (True, json.loads(row[0])) if row else (False, None)
+
+    def put(self, node: str, key: str, value: Any, ttl: float):
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO llm_cache (key, node, value, created_at, expires_at, last_hit_at, hits)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            ''', (key, node, json.dumps(value, ensure_ascii=False), now, now + ttl, now))
+        with self._lock:
+            self._puts += 1
+            sweep = self._puts % _SWEEP_EVERY == 0
+        if sweep:
+            self.sweep()
+
+    def sweep(self):
+        """删除过期条目，并在超过容量时淘汰最久未命中的条目。"""
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+            overflow = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute('''
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY last_hit_at LIMIT ?
+                    )
+                ''', (overflow,))
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """各节点的命中/未命中次数。"""
+        with self._lock:
+            return {node: dict(stats) for node, stats in self._stats.items()}
+
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache:
+    """获取进程内共享的响应缓存实例（懒加载）。"""
+    global _llm_cache
+    if _llm_cache is None:
+        with _llm_cache_lock:
+            if _llm_cache is None:
+                _llm_cache = LLMCache()
+    return _llm_cache
+
+
+def cached_invoke(node: str, prompt, parser, inputs: dict) -> Any:
+    """
+    经 llm_router 执行节点的 prompt | model | parser 链；若节点在 NODE_CACHE_TTL 中配置了 TTL，
+    则先查缓存，未命中时调用并写回。缓存键包含节点的全部候选模型，路由结果不同不影响命中。
+    解析结果为 None 或无法序列化为 JSON 时不写缓存。
+    """
+    router = get_router()
+    ttl = NODE_CACHE_TTL.get(node)
+    if not ttl:
+        return router.invoke(node, prompt, parser, inputs)
+
+    cache = get_llm_cache()
+    llms = [router.models[name] for name in router.route_names(node)]
+    key = cache.make_key(node, llms, prompt.format_prompt(**inputs).to_string())
+    hit, value = cache.get(node, key)
+    if hit:
+        logger.debug("%s: 命中缓存", node)
+        return value
+    value = router.invoke(node, prompt, parser, inputs)
+    if value is not None:
+        try:
+            cache.put(node, key, value, ttl)
+        except (TypeError, ValueError) as e:
+            logger.warning("%s: 结果无法缓存: %s", node, e)
+    return value
@@ -0,0 +1,302 @@
+# llm_router.py
+"""
+按节点的多模型路由：延迟感知、熔断、对冲请求与失败回退。
+
+每个节点在 base.NODE_MODEL_ROUTES 中列出可用的模型（第一个为首选）。路由器按 (节点, 模型) 维护最近若干次调用的
+延迟（流式调用记首字延迟）和成败，得到 p50/p95 与错误率；熔断器则按模型共享：
+- 选择：按偏好顺序取第一个“足够健康”的模型——熔断器未打开，且综合得分（p95 × 错误率惩罚）
+  不超过当前最优得分的 ROUTER_SCORE_TOLERANCE 倍。样本不足的模型视为健康，因此正常情况下始终使用首选模型，
+  只有它明显变慢或频繁出错时才会换到备选。
+  统计只使用最近 ROUTER_SAMPLE_TTL 秒内的样本，被降级的模型没有流量一段时间后会回到首选位置。
+- 熔断：模型在任意节点上连续失败 ROUTER_BREAKER_FAILURES 次（含流式调用中途断开）后打开，冷却 ROUTER_BREAKER_COOLDOWN 秒后放行一次试探请求，
+  试探成功即恢复。所有模型都熔断时仍按偏好顺序尝试，而不是直接失败。
+- 回退：调用失败时依次换下一个候选模型。
+- 对冲：节点在 ROUTER_HEDGE_AFTER 中配置了秒数时，首选模型超过该时间仍未返回就同时请求下一个模型，
+  采用先成功返回的结果；慢的那个在后台继续完成，只用于更新统计。流式调用不做对冲（已下发的片段无法撤回），
+  只在首个片段之前失败时回退。
+"""
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Iterator
+
+from base import (MODELS, NODE_MODEL_ROUTES, ROUTER_HEDGE_AFTER, ROUTER_WINDOW, ROUTER_MIN_SAMPLES,
+                  ROUTER_SCORE_TOLERANCE, ROUTER_ERROR_PENALTY, ROUTER_BREAKER_FAILURES,
+                  ROUTER_BREAKER_COOLDOWN, ROUTER_HEDGE_WORKERS, ROUTER_SAMPLE_TTL)
+from context_builder import count_tokens
+from metrics import LLM_SECONDS, LLM_ERRORS, LLM_PROMPT_TOKENS, LLM_COMPLETION_TOKENS
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+def _prompt_tokens(prompt, inputs: dict) -> int:
+    """渲染后的 prompt 的估算 token 数，仅用于指标统计。"""
+    try:
+        return count_tokens(prompt.format_prompt(**inputs).to_string())
+    except Exception:
+        return 0
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class CircuitBreaker:
+    """单个模型的熔断器：按模型共享，不区分节点和调用方式。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0.0      # 熔断打开到该时间点
+        self.probing = False       # 冷却结束后是否已放行试探请求
+
+    def record(self, ok: bool) -> bool:
+        """记录一次调用结果，返回熔断器是否因本次试探成功而关闭。"""
+        with self._lock:
+            recovered = False
+            if ok:
+                recovered = bool(self.open_until)
+                self.consecutive_failures = 0
+                self.open_until = 0.0
+            else:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= ROUTER_BREAKER_FAILURES:
+                    self.open_until = time.monotonic() + ROUTER_BREAKER_COOLDOWN
+            self.probing = False
+            return recovered
+
+    def state(self) -> str:
+        with self._lock:
+            if not self.open_until:
+                return 'closed'
+            return 'open' if time.monotonic() < self.open_until else 'half_open'
+
+    def available(self) -> bool:
+        """熔断器关闭，或冷却已结束且尚无试探请求在途。"""
+        state = self.state()
+        with self._lock:
+            return state == 'closed' or (state == 'half_open' and not self.probing)
+
+    def begin_probe(self):
+        if self.state() == 'half_open':
+            with self._lock:
+                self.probing = True
+
+
+class ModelHealth:
+    """某个节点上单个模型的滚动延迟/错误统计。
+
+    不同节点的 prompt 长度和调用方式不同（流式调用记首字延迟，非流式记完整耗时），
+    因此按 (节点, 模型) 分别统计，避免一个节点的慢调用把另一个节点的模型降级。
+    """
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self._lock = threading.Lock()
+        # (时间戳, 是否成功, 延迟秒数)；超过 ROUTER_SAMPLE_TTL 的样本不再参与统计，
+        # 因而被降级的模型在一段时间没有流量后会重新被视为健康，得到再次证明自己的机会
+        self.samples: deque[tuple[float, bool, float | None]] = deque(maxlen=window)
+
+    def record(self, ok: bool, latency: float | None = None):
+        with self._lock:
+            self.samples.append((time.monotonic(), ok, latency))
+
+    def clear(self):
+        with self._lock:
+            self.samples.clear()
+
+    def _recent(self) -> tuple[list[float], list[bool]]:
+        cutoff = time.monotonic() - ROUTER_SAMPLE_TTL
+        recent = [(ok, latency) for ts, ok, latency in self.samples if ts >= cutoff]
+        return sorted(latency for ok, latency in recent if latency is not None), [ok for ok, _ in recent]
+
+    def score(self) -> float | None:
+        """p95 延迟乘以错误率惩罚，越小越健康；样本不足时返回 None。"""
+        with self._lock:
+            latencies, outcomes = self._recent()
+        if len(outcomes) < ROUTER_MIN_SAMPLES or not latencies:
+            return None
+        error_rate = outcomes.count(False) / len(outcomes)
+        return _percentile(latencies, 0.95) * (1 + ROUTER_ERROR_PENALTY * error_rate)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies, outcomes = self._recent()
+        return {
+            'samples': len(outcomes),
+            'p50_ms': round(_percentile(latencies, 0.5) * 1000) if latencies else None,
+            'p95_ms': round(_percentile(latencies, 0.95) * 1000) if latencies else None,
+            'error_rate': round(outcomes.count(False) / len(outcomes), 4) if outcomes else 0.0,
+        }
+
+
+class LLMRouter:
+    """按节点选择模型并执行 prompt | model | parser 链。"""
+
+    def __init__(self, models: dict = MODELS, routes: dict = NODE_MODEL_ROUTES,
+                 hedge_after: dict = ROUTER_HEDGE_AFTER):
+        self.models = models
+        self.routes = routes
+        self.hedge_after = hedge_after
+        self.breakers = {name: CircuitBreaker() for name in models}
+        self.health: dict[tuple[str, str], ModelHealth] = {}
+        self._health_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=ROUTER_HEDGE_WORKERS, thread_name_prefix='llm_hedge')
+
+    def node_health(self, node: str, name: str) -> ModelHealth:
+        """节点上某个模型的延迟/错误统计（懒创建）。"""
+        with self._health_lock:
+            return self.health.setdefault((node, name), ModelHealth())
+
+    def _record(self, node: str, name: str, ok: bool, latency: float | None = None):
+        """记录一次调用结果：更新模型的熔断器和该节点上的统计。"""
+        if self.breakers[name].record(ok):
+            # 试探成功，熔断关闭；熔断前的失败样本不再拖累该模型在各节点上的得分
+            with self._health_lock:
+                stale = [health for (_, model), health in self.health.items() if model == name]
+            for health in stale:
+                health.clear()
+        self.node_health(node, name).record(ok, latency)
+
+    def route_names(self, node: str) -> list[str]:
+        """节点的候选模型名（按偏好顺序），未配置的节点使用 default 路由。"""
+        return self.routes.get(node) or self.routes['default']
+
+    def candidates(self, node: str) -> list[str]:
+        """按本次调用的尝试顺序返回候选模型名。"""
+        names = self.route_names(node)
+        available = [name for name in names if self.breakers[name].available()]
+        if not available:
+            return list(names)
+        # 冷却结束的模型先接一次试探请求，失败时仍会回退到其余模型
+        probes = [name for name in available if self.breakers[name].state() == 'half_open']
+        available = [name for name in available if name not in probes]
+        scores = {name: self.node_health(node, name).score() for name in available}
+        known = [score for score in scores.values() if score is not None]
+        best = min(known) if known else None
+        healthy = [name for name in available
+                   if best is None or scores[name] is None or scores[name] <= best * ROUTER_SCORE_TOLERANCE]
+        # 健康的模型按偏好顺序在前，其余按得分排在后面作为回退
+        rest = sorted((name for name in available if name not in healthy), key=lambda name: scores[name])
+        return probes + healthy + rest
+
+    def _call(self, node: str, name: str, prompt, parser, inputs: dict, prompt_tokens: int) -> Any:
+        self.breakers[name].begin_probe()
+        start = time.perf_counter()
+        try:
+            result = (prompt | self.models[name] | parser).invoke(inputs)
+        except Exception:
+            self._record(node, name, False)
+            LLM_ERRORS.inc(node=node, model=name)
+            raise
+        latency = time.perf_counter() - start
+        self._record(node, name, True, latency)
+        LLM_SECONDS.observe(latency, node=node, model=name)
+        LLM_PROMPT_TOKENS.inc(prompt_tokens, node=node, model=name)
+        LLM_COMPLETION_TOKENS.inc(count_tokens(str(result)), node=node, model=name)
+        return result
+
+    def _submit(self, node: str, name: str, prompt, parser, inputs: dict, prompt_tokens: int):
+        # 复制上下文，保证 LangChain/LangGraph 的回调配置在工作线程中可见
+        return self._executor.submit(contextvars.copy_context().run, self._call,
+                                     node, name, prompt, parser, inputs, prompt_tokens)
+
+    def invoke(self, node: str, prompt, parser, inputs: dict) -> Any:
+        """执行一次非流式调用，按需对冲并在失败时回退。所有候选都失败时抛出最后一个异常。"""
+        names = self.candidates(node)
+        hedge_after = self.hedge_after.get(node)
+        prompt_tokens = _prompt_tokens(prompt, inputs)
+        last_error = None
+        while names:
+            name = names.pop(0)
+            if not hedge_after or not names:
+                try:
+                    return self._call(node, name, prompt, parser, inputs, prompt_tokens)
+                except Exception as e:
+                    logger.warning("%s: %s 调用失败，尝试下一个模型: %s", node, name, e)
+                    last_error = e
+                    continue
+
+            primary = self._submit(node, name, prompt, parser, inputs, prompt_tokens)
+            done, _ = wait([primary], timeout=hedge_after)
+            if not done:
+                hedge_name = names.pop(0)
+                logger.info("%s: %s 超过 %ss 未返回，对冲请求 %s", node, name, hedge_after, hedge_name)
+                hedge = self._submit(node, hedge_name, prompt, parser, inputs, prompt_tokens)
+                pending = {primary: name, hedge: hedge_name}
+            else:
+                pending = {primary: name}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    failed_name = pending.pop(future)
+                    try:
+                        return future.result()
+                    except Exception as e:
+                        logger.warning("%s: %s 调用失败: %s", node, failed_name, e)
+                        last_error = e
+        raise last_error
+
+    def stream(self, node: str, prompt, parser, inputs: dict) -> Iterator:
+        """
+        流式调用：记录首字延迟；首个片段之前失败时换下一个模型，之后的失败直接抛出。
+        每次尝试在流结束时只记录一次结果（延迟为首字延迟），首字之后的中断同样计为失败，
+        否则持续断流的模型会因首字成功而不断重置熔断计数。
+        """
+        last_error = None
+        prompt_tokens = _prompt_tokens(prompt, inputs)
+        for name in self.candidates(node):
+            self.breakers[name].begin_probe()
+            start = time.perf_counter()
+            first_chunk = None
+            completion = []
+            try:
+                for chunk in (prompt | self.models[name] | parser).stream(inputs):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - start
+                        LLM_SECONDS.observe(first_chunk, node=node, model=name)
+                    completion.append(str(chunk))
+                    yield chunk
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - start
+                    LLM_SECONDS.observe(first_chunk, node=node, model=name)
+                self._record(node, name, True, first_chunk)
+                LLM_PROMPT_TOKENS.inc(prompt_tokens, node=node, model=name)
+                LLM_COMPLETION_TOKENS.inc(count_tokens(''.join(completion)), node=node, model=name)
+                return
+            except GeneratorExit:
+                # 调用方提前关闭了流，模型本身没有出错；同时结束可能在途的试探请求
+                self._record(node, name, True, first_chunk)
+                raise
+            except Exception as e:
+                LLM_ERRORS.inc(node=node, model=name)
+                self._record(node, name, False, first_chunk)
+                if first_chunk is not None:
+                    raise
+                logger.warning("%s: %s 流式调用失败，尝试下一个模型: %s", node, name, e)
+                last_error = e
+        raise last_error
+
+    def stats(self) -> dict[str, dict]:
+        """各“节点/模型”的样本数、p50/p95 延迟（毫秒）、错误率，以及该模型的熔断器状态。"""
+        with self._health_lock:
+            items = list(self.health.items())
+        return {f'{node}/{name}': dict(health.snapshot(), circuit=self.breakers[name].state())
+                for (node, name), health in items}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> LLMRouter:
+    """获取进程内共享的路由器（懒加载）。"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = LLMRouter()
+    return _router
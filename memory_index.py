@@ -0,0 +1,205 @@
+# memory_index.py
+"""
+长期记忆的本地向量索引，用于在调用 LLM 做记忆路由之前先在本地筛选候选标签。
+
+- 向量化：字符 n-gram 哈希向量（中文按连续汉字切 2/3-gram，英文数字按单词），不依赖任何模型，纯 CPU；
+- 存储：每个会话一个 float32 矩阵文件（.f32，行追加写入）和一个 JSON 元数据文件，读取时用 numpy.memmap 映射；
+- 每一行对应一个标签名或一个记忆块的文本，标签得分取标签名与其关联记忆块相似度中的最大值；
+- 索引第一次用到时从 memory_data.db 增量构建，之后由 DatabaseManager.add_memory 写入时同步追加。
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from base import MEMORY_INDEX_DIR, MEMORY_INDEX_DIM, MEMORY_INDEX_HOT
+from fulltext import STOP_CHARS
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 向量化规则变化时递增，已有索引文件会被丢弃并重新构建
+INDEX_VERSION = 2
+
+_CJK_RUN = re.compile(r'[一-鿿㐀-䶿]+')
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+class HashingVectorizer:
+    """字符 n-gram 哈希向量化器，输出 L2 归一化的 float32 向量。"""
+
+    def __init__(self, dim: int = MEMORY_INDEX_DIM, ngram_range: tuple[int, int] = (2, 3)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def features(self, text: str) -> list[str]:
+        text = text.lower()
+        feats = []
+        low, high = self.ngram_range
+        # 在高频虚词处断开汉字串，避免“我们”“了吗”这类片段带来的噪声匹配
+        for run in _CJK_RUN.findall(STOP_CHARS.sub(' ', text)):
+            for n in range(low, high + 1):
+                feats.extend(run[i:i + n] for i in range(len(run) - n + 1))
+        feats.extend(_WORD.findall(text))
+        return feats
+
+    def transform(self, texts: list[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feat in self.features(text):
+                h = zlib.crc32(feat.encode('utf-8'))
+                # 用哈希的最高位决定符号，减小哈希冲突带来的偏差
+                matrix[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+            # 次线性词频，避免长记忆块里的高频片段压过其它特征
+            matrix[row] = np.sign(matrix[row]) * np.log1p(np.abs(matrix[row]))
+            norm = np.linalg.norm(matrix[row])
+            if norm > 0:
+                matrix[row] /= norm
+        return matrix
+
+
+def messages_text(messages) -> str:
+    """把消息列表拼成一段用于向量化的文本（忽略非文本内容）。"""
+    return '\n'.join(m.content for m in messages if isinstance(getattr(m, 'content', None), str))
+
+
+class _ConversationIndex:
+    """单个会话的索引：矩阵文件 + 元数据（每行的类型、标签，以及已索引到的最大记忆块 id）。"""
+
+    def __init__(self, base_path: str, dim: int):
+        self.data_path = base_path + '.f32'
+        self.meta_path = base_path + '.json'
+        self.dim = dim
+        self.rows: list[list] = []
+        self.last_block_id = 0
+        self.matrix = None
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('dim') == self.dim and meta.get('version') == INDEX_VERSION:
+                self.rows = meta['rows']
+                self.last_block_id = meta['last_block_id']
+        self._map()
+
+    def _map(self):
+        expected = len(self.rows) * self.dim * 4
+        if not self.rows or not os.path.exists(self.data_path) or os.path.getsize(self.data_path) < expected:
+            # 元数据与矩阵文件不一致（例如维度或向量化规则变了），丢弃后重新构建
+            self.rows, self.last_block_id, self.matrix = [], 0, None
+            return
+        self.matrix = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(len(self.rows), self.dim))
+
+    def append(self, vectors: np.ndarray, rows: list[list], last_block_id: int):
+        """追加若干行。先写矩阵再原子替换元数据，中途崩溃时多出来的矩阵行会在下次追加前截掉。"""
+        self.matrix = None
+        mode = 'r+b' if os.path.exists(self.data_path) and self.rows else 'wb'
+        with open(self.data_path, mode) as f:
+            f.truncate(len(self.rows) * self.dim * 4)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        self.rows = self.rows + rows
+        self.last_block_id = max(self.last_block_id, last_block_id)
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'dim': self.dim, 'last_block_id': self.last_block_id,
+                       'rows': self.rows}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.meta_path)
+        self._map()
+
+    def known_tags(self) -> set[str]:
+        return {row[1] for row in self.rows if row[0] == 'tag'}
+
+
+class MemoryIndex:
+    """按会话管理向量索引，内存中只保留最近使用的 MEMORY_INDEX_HOT 个会话的映射。"""
+
+    def __init__(self, index_dir: str = MEMORY_INDEX_DIR, dim: int = MEMORY_INDEX_DIM,
+                 hot_conversations: int = MEMORY_INDEX_HOT):
+        self.index_dir = index_dir
+        self.vectorizer = HashingVectorizer(dim)
+        self.hot_conversations = hot_conversations
+        self._indexes: OrderedDict[str, _ConversationIndex] = OrderedDict()
+        self._lock = threading.RLock()
+        os.makedirs(index_dir, exist_ok=True)
+
+    def _base_path(self, user_uuid: str) -> str:
+        safe = re.sub(r'[^A-Za-z0-9_-]', '_', user_uuid)[:64]
+        digest = hashlib.md5(user_uuid.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.index_dir, f'{safe}_{digest}')
+
+    def _open(self, db, user_uuid: str) -> _ConversationIndex:
+        """取出会话索引；第一次打开时把数据库中尚未索引的记忆块补进来。"""
+        index = self._indexes.get(user_uuid)
+        if index is not None:
+            self._indexes.move_to_end(user_uuid)
+            return index
+        index = _ConversationIndex(self._base_path(user_uuid), self.vectorizer.dim)
+        blocks = db.get_blocks_since(user_uuid, index.last_block_id)
+        if blocks:
+            self._append_blocks(index, blocks)
+            logger.debug("%s: 已索引 %d 个新记忆块，共 %d 行", user_uuid, len(blocks), len(index.rows))
+        self._indexes[user_uuid] = index
+        while len(self._indexes) > self.hot_conversations:
+            self._indexes.popitem(last=False)
+        return index
+
+    def _append_blocks(self, index: _ConversationIndex, blocks: list[tuple[int, list, list[str]]]):
+        known = index.known_tags()
+        texts, rows = [], []
+        for block_id, messages, tags in blocks:
+            for tag in tags:
+                if tag not in known:
+                    known.add(tag)
+                    texts.append(tag)
+                    rows.append(['tag', tag])
+            texts.append(messages_text(messages))
+            rows.append(['block', block_id, tags])
+        index.append(self.vectorizer.transform(texts), rows, max(b[0] for b in blocks))
+
+    def add_block(self, user_uuid: str, block_id: int, messages: list, tags: list[str]):
+        """add_memory 写入后调用。会话索引不在内存中时不做处理，下次打开时会从数据库补齐。"""
+        with self._lock:
+            index = self._indexes.get(user_uuid)
+            if index is None or block_id <= index.last_block_id:
+                return
+            self._append_blocks(index, [(block_id, messages, tags)])
+
+    def search(self, db, user_uuid: str, query: str, top_k: int) -> list[tuple[str, float]]:
+        """
+        对询问打分，返回得分最高的 top_k 个标签及其相似度（降序）。
+        :param db: DatabaseManager，用于首次打开会话时补齐索引。
+        """
+        with self._lock:
+            index = self._open(db, user_uuid)
+            if index.matrix is None:
+                return []
+            scores = np.asarray(index.matrix @ self.vectorizer.transform([query])[0])
+            rows = index.rows
+        best: dict[str, float] = {}
+        for row, score in zip(rows, scores.tolist()):
+            for tag in ([row[1]] if row[0] == 'tag' else row[2]):
+                if score > best.get(tag, -1.0):
+                    best[tag] = score
+        return sorted(best.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+_memory_index = None
+_memory_index_lock = threading.Lock()
+
+
+def get_memory_index() -> MemoryIndex:
+    """获取进程内共享的记忆索引实例（懒加载）。"""
+    global _memory_index
+    if _memory_index is None:
+        with _memory_index_lock:
+            if _memory_index is None:
+                _memory_index = MemoryIndex()
+    return _memory_index
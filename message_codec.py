@@ -0,0 +1,209 @@
+# message_codec.py
+"""
+消息列表与检查点的紧凑二进制编码。
+
+记忆块、待折叠消息原先用 langchain_core.load.dumps 存成 JSON，每条消息都带完整的类路径和全部默认字段，
+读写时要整体解析/生成。这里改为带版本号的二进制格式：
+
+    头部: MAGIC(2 字节) + 版本(1 字节) + 压缩方式(1 字节)
+    正文: varint 条数，随后每条消息一条记录：
+          标志字节（低 3 位角色，IMAGE/ID 位表示带图片引用/消息 ID，FALLBACK 位表示 JSON 记录）
+          + varint 长度前缀的 UTF-8 内容 [+ 图片引用] [+ 消息 ID]
+
+只有 human/ai/system 且内容为字符串、没有工具调用等附加字段的消息走紧凑记录，其它消息整条按 JSON 记录保存，
+不会丢字段。正文超过 CODEC_MIN_COMPRESS 字节时用 zstd 压缩（未安装 zstandard 时用 zlib），
+压缩方式记在头部，解码时不依赖当前配置。旧的 JSON 文本（str 或不以 MAGIC 开头的 bytes）按原格式读取。
+
+CompactSerializer 包装 LangGraph 默认的序列化器，给检查点加上同样的头部与压缩，旧检查点照常读取。
+"""
+import zlib
+from typing import Any
+
+from langchain_core.load import dumps, loads
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from base import CODEC_COMPRESSION, CODEC_LEVEL, CODEC_MIN_COMPRESS
+
+try:
+    import zstandard
+except ImportError:  # zstandard 是可选依赖，缺失时退化为 zlib
+    zstandard = None
+
+MAGIC = b'MC'
+VERSION = 1
+
+# 压缩方式
+RAW = 0
+ZLIB = 1
+ZSTD = 2
+
+# 记录标志
+ROLE_MASK = 0x07
+HAS_IMAGE = 0x08
+HAS_ID = 0x10
+FALLBACK = 0x80
+
+ROLES = {HumanMessage: 0, AIMessage: 1, SystemMessage: 2}
+ROLE_CLASSES = {code: cls for cls, code in ROLES.items()}
+# additional_kwargs 中存放图片引用的键
+IMAGE_KEY = 'image_url'
+
+
+def _default_compression() -> int:
+    if CODEC_COMPRESSION == 'zstd' and zstandard is not None:
+        return ZSTD
+    return ZLIB if CODEC_COMPRESSION in ('zstd', 'zlib') else RAW
+
+
+def pack(body: bytes, compression: int | None = None) -> bytes:
+    """为正文加上头部，超过 CODEC_MIN_COMPRESS 字节时压缩。"""
+    method = _default_compression() if compression is None else compression
+    if len(body) < CODEC_MIN_COMPRESS:
+        method = RAW
+    if method == ZSTD:
+        body = zstandard.compress(body, CODEC_LEVEL)
+    elif method == ZLIB:
+        body = zlib.compress(body, CODEC_LEVEL)
+    return MAGIC + bytes((VERSION, method)) + body
+
+
+def is_packed(blob) -> bool:
+    return isinstance(blob, (bytes, bytearray, memoryview)) and bytes(blob[:2]) == MAGIC
+
+
+def unpack(blob: bytes) -> bytes:
+    """pack 的逆操作，返回解压后的正文。"""
+    version, method = blob[2], blob[3]
+    if version > VERSION:
+        raise ValueError(f"不支持的编码版本: {version}")
+    body = bytes(blob[4:])
+    if method == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("数据使用 zstd 压缩，但未安装 zstandard")
+        return zstandard.decompress(body)
+    if method == ZLIB:
+        return zlib.decompress(body)
+    if method == RAW:
+        return body
+    raise ValueError(f"未知的压缩方式: {method}")
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_str(out: bytearray, text: str):
+    raw = text.encode('utf-8')
+    _write_varint(out, len(raw))
+    out += raw
+
+
+def _read_str(data: bytes, pos: int) -> tuple[str, int]:
+    size, pos = _read_varint(data, pos)
+    return data[pos:pos + size].decode('utf-8'), pos + size
+
+
+def _compact_fields(message: BaseMessage) -> tuple[int, str | None] | None:
+    """可以用紧凑记录表示时返回 (角色, 图片引用)，否则返回 None。"""
+    role = ROLES.get(type(message))
+    if role is None or not isinstance(message.content, str) or message.name or message.response_metadata:
+        return None
+    if isinstance(message, AIMessage) and (message.tool_calls or message.invalid_tool_calls or message.usage_metadata):
+        return None
+    extra = message.additional_kwargs
+    image = extra.get(IMAGE_KEY)
+    if len(extra) > (IMAGE_KEY in extra) or (image is not None and not isinstance(image, str)):
+        return None
+    return role, image
+
+
+def encode_messages(messages: list[BaseMessage], compression: int | None = None) -> bytes:
+    """把消息列表编码为带头部的二进制数据。"""
+    out = bytearray()
+    _write_varint(out, len(messages))
+    for message in messages:
+        fields = _compact_fields(message)
+        if fields is None:
+            out.append(FALLBACK)
+            _write_str(out, dumps(message))
+            continue
+        role, image = fields
+        flags = role | (HAS_IMAGE if image is not None else 0) | (HAS_ID if message.id else 0)
+        out.append(flags)
+        _write_str(out, message.content)
+        if image is not None:
+            _write_str(out, image)
+        if message.id:
+            _write_str(out, message.id)
+    return pack(bytes(out), compression)
+
+
+def decode_messages(blob: bytes | str) -> list[BaseMessage]:
+    """解码 encode_messages 的结果；旧的 langchain JSON 文本原样用 loads 读取。"""
+    if not is_packed(blob):
+        return loads(blob if isinstance(blob, str) else bytes(blob).decode('utf-8'))
+    data = unpack(blob)
+    count, pos = _read_varint(data, 0)
+    messages = []
+    for _ in range(count):
+        flags = data[pos]
+        pos += 1
+        text, pos = _read_str(data, pos)
+        if flags & FALLBACK:
+            messages.append(loads(text))
+            continue
+        kwargs = {}
+        if flags & HAS_IMAGE:
+            image, pos = _read_str(data, pos)
+            kwargs['additional_kwargs'] = {IMAGE_KEY: image}
+        if flags & HAS_ID:
+            kwargs['id'], pos = _read_str(data, pos)
+        messages.append(ROLE_CLASSES[flags & ROLE_MASK](content=text, **kwargs))
+    return messages
+
+
+class CompactSerializer:
+    """
+    检查点序列化器：内部序列化器（默认 JsonPlusSerializer）的结果超过 CODEC_MIN_COMPRESS 字节时
+    压缩并在类型名后追加 '+packed'。没有该后缀的旧检查点直接交给内部序列化器。
+    """
+
+    SUFFIX = '+packed'
+
+    def __init__(self, inner=None):
+        if inner is None:
+            from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+            inner = JsonPlusSerializer()
+        self.inner = inner
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.inner.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self.inner.loads(data)
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.inner.dumps_typed(obj)
+        if len(data) < CODEC_MIN_COMPRESS:
+            return type_, data
+        return type_ + self.SUFFIX, pack(data)
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_.endswith(self.SUFFIX):
+            return self.inner.loads_typed((type_[:-len(self.SUFFIX)], unpack(payload)))
+        return self.inner.loads_typed((type_, payload))
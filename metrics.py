@@ -0,0 +1,207 @@
+# metrics.py
+"""
+进程内指标与 Prometheus 文本格式导出。
+
+不依赖 prometheus_client：计数器和直方图都是带锁的字典，记录一次只需一次 perf_counter 差值、
+一次二分查找和一次加锁累加，开销在微秒级，可以包在每个图节点、每次模型调用和每个数据库方法上。
+各模块已有的统计（召回缓存、上下文预算、标签缓存、LLM 缓存、路由器、连接池等）通过 register_collector
+注册为采集回调，在 /metrics 被抓取时才读取。
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from typing import Callable, Iterable
+
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 秒
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def expose(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in values)
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # 标签值 -> [各桶计数（非累计）..., 总和, 次数]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            slots = self._values.get(key)
+            if slots is None:
+                slots = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            slots[index] += 1
+            slots[-2] += value
+            slots[-1] += 1
+
+    def expose(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(slots)) for key, slots in self._values.items()]
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for key, slots in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), slots):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), key + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {slots[-2]}')
+            lines.append(f'{self.name}_count{labels} {slots[-1]}')
+        return lines
+
+
+NODE_SECONDS = Histogram('graph_node_seconds', '图节点执行耗时（秒）', ('node',))
+NODE_ERRORS = Counter('graph_node_errors_total', '图节点抛出的异常次数', ('node',))
+LLM_SECONDS = Histogram('llm_request_seconds', '模型调用耗时（秒，流式调用为首字延迟）', ('node', 'model'))
+LLM_ERRORS = Counter('llm_errors_total', '模型调用失败次数', ('node', 'model'))
+LLM_PROMPT_TOKENS = Counter('llm_prompt_tokens_total', '发送给模型的 prompt token 数（本地估算）', ('node', 'model'))
+LLM_COMPLETION_TOKENS = Counter('llm_completion_tokens_total', '模型输出的 token 数（本地估算）', ('node', 'model'))
+IMAGE_SECONDS = Histogram('image_request_seconds', '生图调用耗时（秒，含限流等待）', ('provider',))
+IMAGE_ERRORS = Counter('image_errors_total', '生图调用失败次数', ('provider',))
+DB_SECONDS = Histogram('db_call_seconds', '数据库方法耗时（秒）', ('store', 'method'))
+DB_ERRORS = Counter('db_errors_total', '数据库方法抛出的异常次数', ('store', 'method'))
+BYTES_WRITTEN = Counter('bytes_written_total', '写入存储的数据量（字节，数据库为文本载荷的 UTF-8 长度）', ('store',))
+
+_metrics = [NODE_SECONDS, NODE_ERRORS, LLM_SECONDS, LLM_ERRORS, LLM_PROMPT_TOKENS, LLM_COMPLETION_TOKENS,
+            IMAGE_SECONDS, IMAGE_ERRORS, DB_SECONDS, DB_ERRORS, BYTES_WRITTEN]
+# (指标名, 说明, 回调)；回调返回 {标签字典的 items 元组: 数值}
+_collectors: list[tuple[str, str, Callable[[], dict]]] = []
+
+
+def register_collector(name: str, documentation: str, collect: Callable[[], dict]):
+    """
+    注册一个 gauge 采集回调，抓取时调用。collect 返回 {((标签名, 标签值), ...): 数值}。
+    """
+    _collectors.append((name, documentation, collect))
+
+
+def flatten_stats(stats: dict, label: str) -> dict:
+    """把 {对象名: {字段: 数值}} 形式的统计转换为 {((label, 对象名), ('field', 字段)): 数值}，忽略非数值字段。"""
+    return {((label, owner), ('field', field)): value
+            for owner, fields in stats.items() for field, value in fields.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)}
+
+
+def instrument_node(fn: Callable) -> Callable:
+    """包装图节点，记录耗时和异常次数。保留原函数签名与类型注解，LangGraph 据此推断状态类型。"""
+    node = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            NODE_ERRORS.inc(node=node)
+            raise
+        finally:
+            NODE_SECONDS.observe(time.perf_counter() - start, node=node)
+
+    return wrapper
+
+
+def _payload_bytes(values: Iterable) -> int:
+    size = 0
+    for value in values:
+        if isinstance(value, str):
+            size += len(value.encode('utf-8'))
+        elif isinstance(value, bytes):
+            size += len(value)
+        elif isinstance(value, list):
+            size += sum(len(str(getattr(item, 'content', item)).encode('utf-8')) for item in value)
+    return size
+
+
+def instrument_methods(store: str, write_prefixes: tuple = ('add_', 'update_', 'save_'),
+                       exclude: tuple = ('close', 'get_cursor')):
+    """
+    类装饰器：为类的全部公开方法记录耗时和异常次数；名称以 write_prefixes 开头的方法额外累计写入的载荷字节数。
+    """
+
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not inspect.isfunction(method):
+                continue
+            setattr(cls, name, _wrap_method(store, name, method, name.startswith(write_prefixes)))
+        return cls
+
+    return decorate
+
+
+def _wrap_method(store: str, name: str, method: Callable, is_write: bool) -> Callable:
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(store=store, method=name)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, store=store, method=name)
+        if is_write:
+            BYTES_WRITTEN.inc(_payload_bytes(args[1:]) + _payload_bytes(kwargs.values()), store=store)
+        return result
+
+    return wrapper
+
+
+def render() -> str:
+    """以 Prometheus 文本格式（0.0.4）导出全部指标。"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.expose())
+    for name, documentation, collect in _collectors:
+        try:
+            values = collect()
+        except Exception as e:
+            logger.warning("采集 %s 失败: %s", name, e)
+            continue
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in values.items():
+            names = tuple(label for label, _ in labels)
+            label_values = tuple(label_value for _, label_value in labels)
+            lines.append(f'{name}{_format_labels(names, label_values)} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,94 @@
+# post_talk_jobs.py
+"""
+对话后的朋友圈、日记生成任务。
+由聊天接口入队，在 job_queue 的工作线程中执行，结果通过 SimpleDatabase 写入 chat_data.db。
+"""
+from base import SHORT_MEMORY_CAPACITY, SHORT_MEMORY_WINDOW
+from get_character_full_data import SimpleDatabase
+from job_queue import JobQueue
+from talk_agent import get_agent_and_checkpointer
+
+MOMENT_JOB = 'generate_moment'
+DIARY_JOB = 'generate_diary'
+
+
+def job_key(kind: str, conversation_id: str, talk_number: int, turn_id: int) -> str:
+    """
+    幂等键：同一会话的同一轮对话只生成一次朋友圈/日记。
+    talk_number 在检查点重建后可能重复，因此额外带上触发该轮对话的用户消息 id。
+    """
+    return f"{kind}:{conversation_id}:{talk_number}:{turn_id}"
+
+
+def _load_chat_state(kind: str, payload: dict, app_db: SimpleDatabase) -> dict:
+    """
+    读取聊天线程的最新状态作为生成输入。
+    检查点丢失（例如进程重启）时，按与聊天接口相同的规则从聊天记录重建短期记忆：
+    没超过短期记忆容量时全部读回，否则只读窗口内的部分。
+    """
+    agent, _ = get_agent_and_checkpointer()
+    thread_config = {"configurable": {"thread_id": payload['conversation_id']}}
+    state = dict(agent.get_state(thread_config).values or {})
+    if not state.get('short_messages'):
+        message_count = app_db.count_chat_messages(payload['conversation_id'])
+        limit = message_count if message_count <= SHORT_MEMORY_CAPACITY else SHORT_MEMORY_WINDOW
+        state['short_messages'] = app_db.get_recent_messages(payload['conversation_id'], limit)
+        state['long_messages'] = {}
+    state['character_name'] = payload['character_name']
+    state['character_profile'] = payload['character_profile']
+    state['user_id'] = payload['conversation_id']
+    state['talk_number'] = payload['talk_number']
+    # 记忆块以任务幂等键为来源键写入，任务重试时 storage_memory_block 会跳过已写入的块
+    state['memory_key'] = payload.get('job_key') or f"{kind}:{payload['conversation_id']}:{payload['talk_number']}"
+    return state
+
+
+def run_moment_job(payload: dict) -> dict:
+    """生成一组朋友圈动态（含配图）并写入 social_posts。"""
+    app_db = SimpleDatabase()
+    try:
+        agent, _ = get_agent_and_checkpointer()
+        state = _load_chat_state(MOMENT_JOB, payload, app_db)
+        state['page'] = 'generate_dynamic_condition'
+        moment_thread_config = {"configurable": {"thread_id": payload['generate_id']}}
+        moment_message = {}
+        posts = []
+        for chunk in agent.stream(state, moment_thread_config, stream_mode="updates"):
+            if 'generate_dynamic_condition' in chunk:
+                moment_message = chunk['generate_dynamic_condition']['dynamic_condition']
+            if 'generate_dynamic_condition_picture' in chunk:
+                picture_paths = chunk['generate_dynamic_condition_picture']['dynamic_condition_picture_path']
+                posts = list(zip(moment_message.keys(), picture_paths))
+        # 整个分支成功后再统一落库，避免重试时写入半组动态
+        for k, v_path in posts:
+            app_db.add_social_post(payload['conversation_id'], moment_message[k]['scheme'],
+                                   moment_message[k]['label'], moment_message[k]['time'], v_path)
+        return {'posts': len(posts)}
+    finally:
+        app_db.close()
+
+
+def run_diary_job(payload: dict) -> dict:
+    """生成一篇日记并写入 diary_entries。"""
+    app_db = SimpleDatabase()
+    try:
+        agent, _ = get_agent_and_checkpointer()
+        state = _load_chat_state(DIARY_JOB, payload, app_db)
+        state['page'] = 'generate_diary'
+        diary_thread_config = {"configurable": {"thread_id": payload['generate_id']}}
+        diary_content = None
+        for chunk in agent.stream(state, diary_thread_config, stream_mode="updates"):
+            if 'generate_diary' in chunk:
+                diary_content = chunk['generate_diary']['diary']
+        if diary_content is None:
+            raise RuntimeError('generate_diary 未产生日记内容')
+        app_db.add_diary_entry(payload['conversation_id'], diary_content)
+        return {'diaries': 1}
+    finally:
+        app_db.close()
+
+
+def register_post_talk_jobs(queue: JobQueue):
+    """把朋友圈、日记任务注册到队列。"""
+    queue.register(MOMENT_JOB, run_moment_job)
+    queue.register(DIARY_JOB, run_diary_job)
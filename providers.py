@@ -0,0 +1,154 @@
+# providers.py
+"""
+模型服务商的共享 HTTP 连接池。
+
+每个服务商（按 API 域名划分）只持有一对长连接的 httpx.Client / httpx.AsyncClient，
+同一服务商下的所有 ChatOpenAI 实例共用它们；Gemini 生图客户端按 API key 缓存，整个进程只创建一次，
+连接池参数与文本模型一致。这样 TLS 握手和 TCP 建连只在连接池冷启动或连接过期时发生。
+
+每个服务商记录请求数和新建连接数（通过 httpcore 的 trace 事件统计），stats() 返回连接复用率。
+"""
+import atexit
+import threading
+
+import httpx
+
+
+class _ProviderStats:
+    """单个服务商的请求/建连计数。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def on_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def on_trace(self, event_name: str):
+        # 每新建一条 TCP 连接触发一次；复用空闲连接时不会出现该事件
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self.new_connections += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            requests, new_connections = self.requests, self.new_connections
+        reused = max(requests - new_connections, 0)
+        return {
+            'requests': requests,
+            'new_connections': new_connections,
+            'reused_connections': reused,
+            'reuse_ratio': round(reused / requests, 4) if requests else 0.0,
+        }
+
+
+class ProviderRegistry:
+    """
+    按服务商名称懒加载并缓存 httpx 客户端。
+    pool_size 为单个服务商的最大并发连接数，keepalive 为最多保留的空闲连接数，
+    keepalive_expiry 为空闲连接的保留秒数；connect_timeout/read_timeout 单位为秒。
+    """
+
+    def __init__(self, pool_size: int = 20, keepalive: int = 10, keepalive_expiry: float = 60.0,
+                 connect_timeout: float = 10.0, read_timeout: float = 120.0):
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=keepalive,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._clients: dict[str, httpx.Client] = {}
+        self._async_clients: dict[str, httpx.AsyncClient] = {}
+        self._genai_clients: dict[str, object] = {}
+        self._stats: dict[str, _ProviderStats] = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _provider_stats(self, provider: str) -> _ProviderStats:
+        with self._lock:
+            return self._stats.setdefault(provider, _ProviderStats())
+
+    def _sync_hooks(self, provider: str) -> dict:
+        stats = self._provider_stats(provider)
+
+        def trace(event_name, info):
+            stats.on_trace(event_name)
+
+        def on_request(request: httpx.Request):
+            stats.on_request()
+            request.extensions['trace'] = trace
+
+        return {'request': [on_request]}
+
+    def _async_hooks(self, provider: str) -> dict:
+        stats = self._provider_stats(provider)
+
+        async def trace(event_name, info):
+            stats.on_trace(event_name)
+
+        async def on_request(request: httpx.Request):
+            stats.on_request()
+            request.extensions['trace'] = trace
+
+        return {'request': [on_request]}
+
+    def _client_args(self, provider: str, is_async: bool) -> dict:
+        return {
+            'limits': self.limits,
+            'timeout': self.timeout,
+            'event_hooks': self._async_hooks(provider) if is_async else self._sync_hooks(provider),
+        }
+
+    def http_client(self, provider: str) -> httpx.Client:
+        """服务商共享的同步客户端，传给 ChatOpenAI(http_client=...)。"""
+        with self._lock:
+            client = self._clients.get(provider)
+        if client is None:
+            client = httpx.Client(**self._client_args(provider, is_async=False))
+            with self._lock:
+                client = self._clients.setdefault(provider, client)
+        return client
+
+    def async_http_client(self, provider: str) -> httpx.AsyncClient:
+        """服务商共享的异步客户端，传给 ChatOpenAI(http_async_client=...)。"""
+        with self._lock:
+            client = self._async_clients.get(provider)
+        if client is None:
+            client = httpx.AsyncClient(**self._client_args(provider, is_async=True))
+            with self._lock:
+                client = self._async_clients.setdefault(provider, client)
+        return client
+
+    def genai_client(self, api_key: str, provider: str = 'google'):
+        """
+        按 API key 缓存的 Gemini 客户端。google-genai 在内部自建 httpx 客户端，
+        这里通过 client_args 让它使用与文本模型相同的连接池参数和统计钩子。
+        """
+        from google import genai
+        from google.genai import types
+
+        with self._lock:
+            client = self._genai_clients.get(api_key)
+        if client is None:
+            http_options = types.HttpOptions(
+                timeout=int(self.timeout.read * 1000),  # 毫秒
+                client_args=self._client_args(provider, is_async=False),
+                async_client_args=self._client_args(provider, is_async=True),
+            )
+            client = genai.Client(api_key=api_key, http_options=http_options)
+            with self._lock:
+                client = self._genai_clients.setdefault(api_key, client)
+        return client
+
+    def stats(self) -> dict[str, dict]:
+        """各服务商的请求数、新建连接数和连接复用率。"""
+        with self._lock:
+            providers = dict(self._stats)
+        return {provider: stats.snapshot() for provider, stats in providers.items()}
+
+    def close(self):
+        """关闭同步连接池（异步客户端随事件循环结束释放）。"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
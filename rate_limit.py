@@ -0,0 +1,94 @@
+# rate_limit.py
+"""
+按服务商的令牌桶限速 + 并发上限，以及保持顺序的并发执行辅助。
+
+Gemini 生图接口对请求速率和并发数都有严格限制。所有生图调用在发请求前先 acquire 对应服务商的限流器：
+令牌桶控制平均速率（rate 次/秒，允许 burst 次突发），信号量控制同时在途的请求数。
+聊天配图线程池和朋友圈批量生图共用同一个限流器，互相之间也不会超限。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator
+
+from base import PROVIDER_RATE_LIMITS
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class TokenBucket:
+    """线程安全的令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个。"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取走一个令牌，令牌不足时阻塞到补充为止。"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ProviderLimiter:
+    """单个服务商的限流器：令牌桶 + 并发信号量。"""
+
+    def __init__(self, rate: float, burst: int, concurrency: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """占用一个并发名额并取得令牌后再执行请求。"""
+        with self._semaphore:
+            self.bucket.acquire()
+            yield
+
+
+_limiters: dict[str, ProviderLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str) -> ProviderLimiter:
+    """获取服务商的共享限流器，参数取自 base.PROVIDER_RATE_LIMITS（未配置时使用 default）。"""
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            config = PROVIDER_RATE_LIMITS.get(provider, PROVIDER_RATE_LIMITS['default'])
+            limiter = ProviderLimiter(config['rate'], config['burst'], config['concurrency'])
+            _limiters[provider] = limiter
+        return limiter
+
+
+def map_ordered(fn: Callable[[Any], Any], items: Iterable, max_workers: int, default: Any = None) -> list:
+    """
+    并发执行 fn(item)，按输入顺序返回结果。单个任务抛出异常时记录日志并以 default 代替，
+    不影响其余任务（部分成功）。限速由 fn 内部的限流器负责，这里只决定同时提交的任务数。
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    def run(index_item):
+        index, item = index_item
+        try:
+            return fn(item)
+        except Exception as e:
+            logger.warning("第 %d 个任务失败，使用默认值: %s", index + 1, e)
+            return default
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        return list(executor.map(run, enumerate(items)))
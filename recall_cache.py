@@ -0,0 +1,104 @@
+# recall_cache.py
+"""
+图状态中 long_messages 的有界召回缓存。
+
+long_messages 的结构为 {标签: {'question': 触发召回的用户询问, 'messages': 召回的消息, 'tokens': 估算 token 数,
+'last_used': 最近一次召回时的对话轮次}}：
+- 同一个标签只保留一份，再次召回时刷新内容并移到最新；
+- 单个条目按 RECALL_ENTRY_TOKEN_BUDGET 从最新的消息往前截断；
+- 条目数超过 RECALL_MAX_ENTRIES 或总 token 数超过 RECALL_TOKEN_BUDGET 时按最久未使用淘汰。
+这样状态和每个检查点的大小都是有界的，generate_talk 每轮重发的召回内容也不会无限增长。
+"""
+from langchain_core.messages import BaseMessage
+
+from base import (RECALL_ENTRY_TOKEN_BUDGET, RECALL_MAX_ENTRIES, RECALL_TOKEN_BUDGET,
+                  RECALL_USAGE_SIZE, RECALL_USAGE_TTL)
+from context_builder import count_tokens, render_message
+from ttl_cache import TTLCache
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# 近期活跃会话的召回内容占用，供监控读取: 会话 id -> {'entries': 条目数, 'tokens': token 数, 'chars': 字符数}
+# 有界（LRU + TTL），长时间没有召回活动的会话不再占用内存，也不再计入汇总
+_usage = TTLCache(RECALL_USAGE_SIZE, RECALL_USAGE_TTL)
+
+
+def _trim(messages: list[BaseMessage], budget: int) -> tuple[list[BaseMessage], int]:
+    """从最新的消息往前保留，直到用完预算（至少保留一条）。"""
+    kept, used = [], 0
+    for message in reversed(messages):
+        cost = count_tokens(render_message(message)) + 1
+        if kept and used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept, used
+
+
+def normalize(long_messages: dict | None) -> dict:
+    """兼容旧版状态 {用户询问: 消息列表}：转换为以询问为标签的条目，空条目直接丢弃。"""
+    normalized = {}
+    for key, entry in (long_messages or {}).items():
+        if isinstance(entry, dict):
+            normalized[key] = entry
+        elif entry:
+            messages, tokens = _trim(entry, RECALL_ENTRY_TOKEN_BUDGET)
+            normalized[key] = {'question': key, 'messages': messages, 'tokens': tokens, 'last_used': 0}
+    return normalized
+
+
+def _evict(long_messages: dict) -> dict:
+    """按最久未使用淘汰，直到条目数和总 token 数都在预算内。dict 的插入顺序即使用顺序。"""
+    entries = list(long_messages.items())
+    total = sum(entry['tokens'] for _, entry in entries)
+    while entries and (len(entries) > RECALL_MAX_ENTRIES or total > RECALL_TOKEN_BUDGET):
+        tag, entry = entries.pop(0)
+        total -= entry['tokens']
+        logger.debug("淘汰召回记忆: %s (%d tokens)", tag, entry['tokens'])
+    return dict(entries)
+
+
+def _report(user_id: str, long_messages: dict):
+    usage = {
+        'entries': len(long_messages),
+        'tokens': sum(entry['tokens'] for entry in long_messages.values()),
+        'chars': sum(len(render_message(m)) for entry in long_messages.values() for m in entry['messages']),
+    }
+    _usage.set(user_id, usage)
+
+
+def remember(user_id: str, long_messages: dict | None, tag: str, question: str,
+             messages: list[BaseMessage] | None, turn: int) -> dict:
+    """
+    记录一次召回，返回新的 long_messages（不修改传入的 dict）。
+    :param turn: 当前对话轮次（talk_number），记为 last_used。
+    """
+    long_messages = normalize(long_messages)
+    if messages:
+        long_messages.pop(tag, None)
+        kept, tokens = _trim(messages, RECALL_ENTRY_TOKEN_BUDGET)
+        long_messages[tag] = {'question': question, 'messages': kept, 'tokens': tokens, 'last_used': turn}
+        long_messages = _evict(long_messages)
+    _report(user_id, long_messages)
+    return long_messages
+
+
+def forget_questions(user_id: str, long_messages: dict | None, questions: set[str]) -> dict:
+    """触发召回的用户询问被移出短期记忆后，对应的召回条目也一并移除。"""
+    long_messages = {tag: entry for tag, entry in normalize(long_messages).items()
+                     if entry['question'] not in questions}
+    _report(user_id, long_messages)
+    return long_messages
+
+
+def recall_metrics() -> dict[str, int]:
+    """近期活跃会话召回内容的汇总占用: 会话数、条目数、token 数和字符数。"""
+    usages = _usage.values()
+    return {
+        'conversations': len(usages),
+        'entries': sum(u['entries'] for u in usages),
+        'tokens': sum(u['tokens'] for u in usages),
+        'chars': sum(u['chars'] for u in usages),
+    }
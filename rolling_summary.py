@@ -0,0 +1,92 @@
+# rolling_summary.py
+"""
+短期记忆的滚动摘要。
+
+op_memory 把超出 SHORT_MEMORY_WINDOW 的消息成批移出短期记忆，写入 summary_pending 后入队一个折叠任务；
+任务在 job_queue 的工作线程中按写入顺序把每一批消息折叠进该会话的摘要（conversation_summaries）。
+generate_talk 使用“摘要 + 较小的近期窗口”，不再需要几百条原始消息。
+"""
+import threading
+
+from langchain_core.messages import BaseMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from base import SUMMARY_MAX_CHARS
+from context_builder import build_context
+from get_memory import DatabaseManager
+from job_queue import JobQueue, get_job_queue
+from llm_router import get_router
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+SUMMARY_JOB = 'fold_summary'
+
+# 同一会话的折叠必须串行，否则两个任务可能基于同一份旧摘要各自覆盖
+_fold_locks: dict[str, threading.Lock] = {}
+_fold_locks_guard = threading.Lock()
+
+
+def _fold_lock(user_uuid: str) -> threading.Lock:
+    with _fold_locks_guard:
+        return _fold_locks.setdefault(user_uuid, threading.Lock())
+
+
+def schedule_summary(db: DatabaseManager, user_uuid: str, character_name: str, messages: list[BaseMessage]) -> int:
+    """
+    记录被移出窗口的消息并入队折叠任务。
+    :return: 任务 id。幂等键带上批次 id，重复调用不会重复折叠。
+    """
+    pending_id = db.add_pending_summary(user_uuid, messages)
+    payload = {'user_id': user_uuid, 'character_name': character_name, 'db_path': db.db_path}
+    job_id = get_job_queue().enqueue(SUMMARY_JOB, payload, f"{SUMMARY_JOB}:{user_uuid}:{pending_id}")
+    logger.info("%s: %d 条消息移出短期记忆，折叠任务 %s", user_uuid, len(messages), job_id)
+    return job_id
+
+
+def fold_messages(summary: str | None, messages: list[BaseMessage], character_name: str) -> str:
+    """调用 LLM 把一批消息合并进已有摘要，返回新的摘要。"""
+    prompt_template = """
+# 任务
+你负责维护一段角色扮演对话的“前情摘要”。请把【新的聊天记录】中的信息合并进【已有摘要】，输出更新后的完整摘要。
+
+# 要求
+1.  保留对后续对话有用的信息：人物称呼与关系的变化、发生过的事件、约定与承诺、用户的喜好与近况、{name}的情绪变化。
+2.  删去寒暄、重复和无关紧要的细节；较早的内容可以进一步压缩，但不能丢掉关键事实。
+3.  以第三人称客观叙述，按时间先后组织，不超过 {max_chars} 字。
+4.  只输出摘要正文，不要任何解释或标题。
+
+# 已有摘要
+{summary}
+
+# 新的聊天记录
+{messages}
+    """
+    prompt = ChatPromptTemplate.from_template(prompt_template)
+    return get_router().invoke(SUMMARY_JOB, prompt, StrOutputParser(), {
+        'name': character_name,
+        'max_chars': SUMMARY_MAX_CHARS,
+        'summary': summary or '（暂无）',
+        'messages': build_context(SUMMARY_JOB, messages, ai_name=character_name),
+    }).strip()
+
+
+def run_summary_job(payload: dict) -> dict:
+    """依次折叠该会话所有待处理的消息批次，每折叠一批就保存一次，重试时从未完成的批次继续。"""
+    user_uuid = payload['user_id']
+    db = DatabaseManager(payload['db_path'])
+    with _fold_lock(user_uuid):
+        pending = db.get_pending_summaries(user_uuid)
+        summary = db.get_summary(user_uuid)
+        for pending_id, messages in pending:
+            summary = fold_messages(summary, messages, payload['character_name'])
+            db.save_summary(user_uuid, summary, pending_id)
+    if pending:
+        logger.info("%s: 已折叠 %d 批消息，摘要 %d 字", user_uuid, len(pending), len(summary))
+    return {'folded': len(pending)}
+
+
+def register_summary_jobs(queue: JobQueue):
+    """把摘要折叠任务注册到队列。"""
+    queue.register(SUMMARY_JOB, run_summary_job)
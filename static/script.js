@@ -15,6 +15,16 @@ document.addEventListener('DOMContentLoaded', () => {
         currentIndex: 0
     };
     // --- END OF MODIFICATION ---
+    // 聊天记录分页状态：oldestId 用于向上翻页，newestId 用于增量同步
+    const HISTORY_PAGE_SIZE = 50;
+    let historyState = {
+        oldestId: null,
+        newestId: null,
+        hasMore: false,
+        loading: false,
+        syncing: false,
+        renderedIds: new Set()
+    };
 
     // --- DOM Elements ---
     const views = {
@@ -76,7 +86,8 @@ document.addEventListener('DOMContentLoaded', () => {
         if (!baseUrl || !baseUrl.startsWith('/')) {
             return baseUrl || 'assets/default_avatar.png';
         }
-        if (baseUrl.includes('?token=') || baseUrl.includes('&token=')) {
+        // 已带访问令牌或会话范围图片签名的地址原样使用
+        if (/[?&](token|sig)=/.test(baseUrl)) {
             return baseUrl;
         }
         if (state.token) {
@@ -157,18 +168,20 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
-    const addChatMessage = (type, { text, imageUrl }) => {
+    const messageImageHtml = (imageUrl) => {
+        if (!imageUrl || typeof imageUrl !== 'string' || imageUrl.trim() === '') return '';
+        const authenticatedImageUrl = getAuthenticatedUrl(imageUrl);
+        return `<img src="${authenticatedImageUrl}" alt="Generated image" class="message-image" onerror="this.onerror=null;this.style.display='none';">`;
+    };
+
+    const addChatMessage = (type, { text, imageUrl, messageId }, prepend = false) => {
         const messageDiv = document.createElement('div');
         const isUserMessage = type === 'user' || type === 'human';
         const displayType = isUserMessage ? 'user' : 'ai';
         messageDiv.className = `chat-message ${displayType}-message`;
 
         const avatarSrc = isUserMessage ? state.userAvatar : getAuthenticatedUrl(state.currentCharacter.avatar_url);
-        let imageHtml = '';
-        if (imageUrl && typeof imageUrl === 'string' && imageUrl.trim() !== '') {
-            const authenticatedImageUrl = getAuthenticatedUrl(imageUrl);
-            imageHtml = `<img src="${authenticatedImageUrl}" alt="Generated image" class="message-image" onerror="this.onerror=null;this.style.display='none';">`;
-        }
+        const imageHtml = messageImageHtml(imageUrl);
 
         messageDiv.innerHTML = `
             <img src="${avatarSrc}" alt="avatar" class="avatar" onerror="this.onerror=null;this.src='assets/default_avatar.png';">
@@ -177,11 +190,87 @@ document.addEventListener('DOMContentLoaded', () => {
                 ${imageHtml}
             </div>
         `;
-        appElements.chatWindow.appendChild(messageDiv);
-        appElements.chatWindow.scrollTop = appElements.chatWindow.scrollHeight;
+        if (messageId !== undefined && messageId !== null) {
+            markMessage(messageDiv, messageId);
+        }
+        if (prepend) {
+            appElements.chatWindow.insertBefore(messageDiv, appElements.chatWindow.firstChild);
+        } else {
+            appElements.chatWindow.appendChild(messageDiv);
+            appElements.chatWindow.scrollTop = appElements.chatWindow.scrollHeight;
+        }
         return messageDiv;
     };
 
+    // 记录气泡对应的数据库 id，增量同步时据此跳过已经显示的消息
+    const markMessage = (messageDiv, messageId) => {
+        if (!messageDiv || messageId === undefined || messageId === null) return;
+        messageDiv.dataset.messageId = messageId;
+        historyState.renderedIds.add(messageId);
+    };
+
+    // 把配图插入它所属的 AI 消息气泡（配图可能在用户发出下一条消息之后才到达）
+    const attachMessageImage = (messageDiv, imageUrl) => {
+        const bubble = messageDiv && messageDiv.querySelector('.message-bubble');
+        if (!bubble || bubble.querySelector('.message-image')) return;
+        bubble.insertAdjacentHTML('beforeend', messageImageHtml(imageUrl));
+    };
+
+    const findMessage = (messageId) => {
+        if (messageId === undefined || messageId === null) return null;
+        return appElements.chatWindow.querySelector(`.chat-message[data-message-id="${messageId}"]`);
+    };
+
+    const renderHistoryMessage = (msg, prepend = false) => {
+        if (historyState.oldestId === null || msg.id < historyState.oldestId) historyState.oldestId = msg.id;
+        if (historyState.newestId === null || msg.id > historyState.newestId) historyState.newestId = msg.id;
+        if (historyState.renderedIds.has(msg.id)) return;
+        addChatMessage(msg.message_type, { text: msg.content, imageUrl: msg.image_url, messageId: msg.id }, prepend);
+    };
+
+    // 向上滚动到顶部时加载更早的一页
+    const loadOlderHistory = async () => {
+        if (!state.currentCharacter || !historyState.hasMore || historyState.loading) return;
+        historyState.loading = true;
+        const characterId = state.currentCharacter.id;
+        try {
+            const page = await api.request(`/characters/${characterId}/history?before_id=${historyState.oldestId}&limit=${HISTORY_PAGE_SIZE}`);
+            if (!state.currentCharacter || state.currentCharacter.id !== characterId) return;
+            const previousHeight = appElements.chatWindow.scrollHeight;
+            // 从新到旧依次插入顶部，保持时间正序
+            for (let i = page.messages.length - 1; i >= 0; i--) {
+                renderHistoryMessage(page.messages[i], true);
+            }
+            // 保持用户当前看到的位置不跳动
+            appElements.chatWindow.scrollTop += appElements.chatWindow.scrollHeight - previousHeight;
+            historyState.hasMore = page.has_more;
+        } catch (error) {
+            console.error('加载更早的聊天记录失败:', error);
+        } finally {
+            historyState.loading = false;
+        }
+    };
+
+    // 只拉取 newestId 之后的新消息（例如其它标签页发送的消息）
+    const syncNewMessages = async () => {
+        if (!state.currentCharacter || historyState.syncing) return;
+        historyState.syncing = true;
+        const characterId = state.currentCharacter.id;
+        try {
+            let hasMore = true;
+            while (hasMore) {
+                const page = await api.request(`/characters/${characterId}/history?since_id=${historyState.newestId ?? 0}&limit=200`);
+                if (!state.currentCharacter || state.currentCharacter.id !== characterId) return;
+                page.messages.forEach(msg => renderHistoryMessage(msg));
+                hasMore = page.has_more && page.messages.length > 0;
+            }
+        } catch (error) {
+            console.error('同步新消息失败:', error);
+        } finally {
+            historyState.syncing = false;
+        }
+    };
+
     // --- Event Handlers & Logic ---
     const handleLogin = async (e) => {
         e.preventDefault();
@@ -263,14 +352,23 @@ document.addEventListener('DOMContentLoaded', () => {
             appElements.openDiaryBtn.classList.remove('has-notification');
             showView('app');
 
-            const history = await api.request(`/characters/${state.currentCharacter.id}/history`);
+            historyState = {
+                oldestId: null,
+                newestId: null,
+                hasMore: false,
+                loading: false,
+                syncing: false,
+                renderedIds: new Set()
+            };
+            // 先只加载最新的一页，更早的记录在向上滚动时再加载
+            const page = await api.request(`/characters/${state.currentCharacter.id}/history?limit=${HISTORY_PAGE_SIZE}`);
             appElements.chatWindow.innerHTML = '';
 
-            if (history && history.length > 0) {
-                history.forEach(msg => {
-                    addChatMessage(msg.message_type, { text: msg.content, imageUrl: msg.image_url });
-                });
+            if (page && page.messages.length > 0) {
+                page.messages.forEach(msg => renderHistoryMessage(msg));
             }
+            historyState.hasMore = page ? page.has_more : false;
+            appElements.chatWindow.scrollTop = appElements.chatWindow.scrollHeight;
 
         } catch (error) {
             console.error("selectCharacter 出错:", error);
@@ -305,11 +403,32 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
+    // 轮询后台任务（朋友圈/日记）状态，完成后在对应按钮上显示提醒
+    const watchJob = (jobId, notifyButton, interval = 5000) => {
+        const poll = async () => {
+            try {
+                const job = await api.request(`/jobs/${jobId}`);
+                if (job.status === 'succeeded') {
+                    notifyButton.classList.add('has-notification');
+                    return;
+                }
+                if (job.status === 'failed') {
+                    console.error(`后台任务 ${jobId} 失败:`, job.last_error);
+                    return;
+                }
+            } catch (error) {
+                console.error(`查询后台任务 ${jobId} 出错:`, error);
+            }
+            setTimeout(poll, interval);
+        };
+        setTimeout(poll, interval);
+    };
+
     const handleSendMessage = async () => {
         const text = appElements.messageInput.value.trim();
         if (!text) return;
 
-        addChatMessage('user', { text });
+        const userMessageBubble = addChatMessage('user', { text });
         appElements.messageInput.value = '';
         appElements.sendBtn.disabled = true;
 
@@ -338,15 +457,29 @@ document.addEventListener('DOMContentLoaded', () => {
                     try {
                         const data = JSON.parse(jsonData);
 
-                        if (data.type === 'text') {
+                        if (data.type === 'user_message') {
+                            markMessage(userMessageBubble, data.message_id);
+                        } else if (data.type === 'text_delta') {
+                            // 逐字到达的增量片段，直接追加到当前气泡
+                            if (!currentAiMessageBubble) {
+                                currentAiMessageBubble = addChatMessage('ai', { text: data.content });
+                            } else {
+                                currentAiMessageBubble.querySelector('p').textContent += data.content;
+                            }
+                        } else if (data.type === 'text') {
                             if (!currentAiMessageBubble) {
                                 currentAiMessageBubble = addChatMessage('ai', { text: data.content });
                             } else {
                                 currentAiMessageBubble.querySelector('p').textContent = data.content;
                             }
+                            markMessage(currentAiMessageBubble, data.message_id);
                         } else if (data.type === 'image') {
+                            if (currentAiMessageBubble && !currentAiMessageBubble.dataset.messageId) {
+                                markMessage(currentAiMessageBubble, data.message_id);
+                            }
+                            // 按 message_id 找到这条回复原来的气泡，而不是追加到聊天窗口底部
                             if (data.url) {
-                                currentAiMessageBubble = addChatMessage('ai', { text: '', imageUrl: data.url });
+                                attachMessageImage(findMessage(data.message_id) || currentAiMessageBubble, data.url);
                             }
                         } else if (data.type === 'event') {
                             console.log('Received event:', data.event_name);
@@ -354,9 +487,15 @@ document.addEventListener('DOMContentLoaded', () => {
                                 appElements.openMomentsBtn.classList.add('has-notification');
                             } else if (data.event_name === 'new_diary_available') {
                                 appElements.openDiaryBtn.classList.add('has-notification');
+                            } else if (data.event_name === 'moment_job_queued') {
+                                watchJob(data.job_id, appElements.openMomentsBtn);
+                            } else if (data.event_name === 'diary_job_queued') {
+                                watchJob(data.job_id, appElements.openDiaryBtn);
                             }
                         } else if (data.type === 'done') {
                             console.log('Stream finished.');
+                            // 文字回复已完成，配图和朋友圈/日记会在同一连接上稍后到达，不必阻塞输入
+                            appElements.sendBtn.disabled = false;
                         }
                     } catch (e) {
                         console.error('解析 SSE 数据出错:', e, '数据:', jsonData);
@@ -369,6 +508,7 @@ document.addEventListener('DOMContentLoaded', () => {
             addChatMessage('ai', { text: `抱歉，我好像出错了: ${error.message}` });
         } finally {
             appElements.sendBtn.disabled = false;
+            syncNewMessages();
         }
     };
 
@@ -478,6 +618,12 @@ document.addEventListener('DOMContentLoaded', () => {
         charElements.showCreateBtn.addEventListener('click', () => showModal('createCharacter'));
         appElements.backBtn.addEventListener('click', () => showView('character'));
         appElements.sendBtn.addEventListener('click', handleSendMessage);
+        appElements.chatWindow.addEventListener('scroll', () => {
+            if (appElements.chatWindow.scrollTop < 80) loadOlderHistory();
+        });
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'visible' && views.app.classList.contains('active-view')) syncNewMessages();
+        });
         appElements.openMomentsBtn.addEventListener('click', handleOpenMoments);
         appElements.openDiaryBtn.addEventListener('click', handleOpenDiary);
         appElements.messageInput.addEventListener('keydown', (e) => { if (e.key === 'Enter' && !e.shiftKey) { e.preventDefault(); handleSendMessage(); } });
@@ -1,5 +1,7 @@
 
-from base import llm_google, State, llm_qwen, llm_kimi, llm
+from base import llm_google, State, llm_qwen, llm_kimi, llm, DEFER_TALK_PICTURE, MEMORY_INDEX_THRESHOLD, \
+    MEMORY_INDEX_TOP_K, SHORT_MEMORY_WINDOW, SHORT_MEMORY_CAPACITY, RECALL_ENTRY_TOKEN_BUDGET, \
+    MEMORY_FTS_MIN_SCORE
 from get_character_full_data import SimpleDatabase  # 导入流式缓冲区
 
 from langchain_core.prompts import ChatPromptTemplate
@@ -8,33 +10,48 @@ from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.messages import HumanMessage, AIMessage
 from langgraph.constants import START, END
 
-from langgraph.checkpoint.memory import MemorySaver
+from bounded_checkpointer import BoundedSqliteSaver
 
 from langgraph.graph import StateGraph
 from typing import Literal
 from generate_talks import  generate_talk,generate_diary,generate_dynamic_condition,generate_dynamic_condition_picture,generate_talk_picture
 from get_memory import  DatabaseManager
+from memory_index import get_memory_index
+from context_builder import build_context, render_message
+from rolling_summary import schedule_summary
+from llm_cache import cached_invoke
+from metrics import instrument_node
+from app_logging import get_logger, truncate
+import recall_cache
+
+logger = get_logger(__name__)
 
 db = DatabaseManager("memory_data.db")
 def start_talk(state:State)->dict:
     talk_number=state.get('talk_number',0)
     talk_number=talk_number+1
-    print('欢迎开始聊天')
+    logger.debug('start_talk: 第 %d 轮', talk_number)
     return {'talk_number':talk_number}
 
 def op_memory(state:State)->dict:
     long_messages = state.get('long_messages', {})
-    if len(state['short_messages'])>=400:
-        short_messages=state['short_messages'][-400:]
-        pop_short_messages=state['short_messages'][:-400]
-        for p in pop_short_messages:
-            if isinstance(p,HumanMessage) and p.content in long_messages.keys():
-                long_messages.pop(p)
+    # 超出窗口 SUMMARY_BATCH_SIZE 条后一次性移出，移出的消息交给后台折叠进滚动摘要
+    if len(state['short_messages'])>=SHORT_MEMORY_CAPACITY:
+        short_messages=state['short_messages'][-SHORT_MEMORY_WINDOW:]
+        pop_short_messages=state['short_messages'][:-SHORT_MEMORY_WINDOW]
+        schedule_summary(db,state['user_id'],state['character_name'],pop_short_messages)
+        popped_questions={p.content for p in pop_short_messages if isinstance(p,HumanMessage)}
+        long_messages=recall_cache.forget_questions(state['user_id'],long_messages,popped_questions)
 
         return {'short_messages':short_messages,'long_messages':long_messages}
     return {'short_messages':state['short_messages'],'long_messages':long_messages}
 
 def storage_memory_block(state:State):
+    memory_key=state.get('memory_key')
+    if memory_key and db.has_memory_block(state['user_id'],memory_key):
+        # 后台任务重试：记忆块已在之前的尝试中写入，不再重复生成标签和写入
+        logger.info('记忆块 %s 已存在，跳过', memory_key)
+        return
     tags=db.get_all_tags(state['user_id'])
     prompt_template="""
     # 角色与目标
@@ -99,12 +116,12 @@ A: 好主意！一直想去看看。那就这么定了。
 # 请根据以上要求开始你的工作。
     """
     prompt=ChatPromptTemplate.from_template(prompt_template)
-    chain=prompt|llm_google|JsonOutputParser()
     memory_block=state['short_messages'][:100]
-    generate_tags=chain.invoke({'message':memory_block,'tags':tags})
+    generate_tags=cached_invoke('storage_memory_block',prompt,JsonOutputParser(),
+                                {'message':build_context('storage_memory_block',memory_block,ai_name=state['character_name']),'tags':tags})
     generate_tags=generate_tags['tags']
-    print(f'为该段记忆生成的记忆标签：{generate_tags}')
-    db.add_memory(state['user_id'],generate_tags,memory_block)
+    logger.info('为该段记忆生成的记忆标签：%s', generate_tags)
+    db.add_memory(state['user_id'],generate_tags,memory_block,source_key=memory_key)
 
 
 
@@ -116,7 +133,19 @@ def jude_path(state:State)->Literal['get_long_message','generate_diary','generat
 def get_long_message(state:State)->dict:
     short_messages=state['short_messages'][:-1]
     user_ask=state['short_messages'][-1]
-    tags=db.get_all_tags(state['user_id'])
+    long_messages=state.get('long_messages',{})
+    # 先用本地向量索引给标签打分：没有候选达到阈值时直接跳过 LLM 路由，否则只把前 top_k 个候选标签交给 LLM
+    candidates=get_memory_index().search(db,state['user_id'],user_ask.content,MEMORY_INDEX_TOP_K)
+    tags=[tag for tag,score in candidates if score>=MEMORY_INDEX_THRESHOLD]
+    # 全文检索补充关键词精确命中的记忆块（BM25 分数越小越相关）
+    for hit in db.search_memory(state['user_id'],user_ask.content,MEMORY_INDEX_TOP_K):
+        if -hit['score']>=MEMORY_FTS_MIN_SCORE:
+            tags.extend(tag for tag in hit['tags'] if tag not in tags)
+    if not tags:
+        best=f'{candidates[0][0]}({candidates[0][1]:.3f})' if candidates else '无'
+        logger.debug('本地索引无候选标签（最高: %s），跳过长期记忆路由', best)
+        return {'long_messages': long_messages}
+    logger.debug('本地索引候选标签: %s', tags)
     prompt_template="""
     # 角色与任务
 
@@ -227,16 +256,21 @@ AI: 我们提到了预算将在下周的会议上进行初步讨论。
 
     """
     prompt=ChatPromptTemplate.from_template(prompt_template)
-    chain=prompt|llm|JsonOutputParser()
-    answer=chain.invoke(
-        {'short_messages':short_messages,'user_ask':user_ask,'tags':tags})
-    print(answer)
-    long_messages=state.get('long_messages',{})
+    answer=cached_invoke('get_long_message',prompt,JsonOutputParser(),
+        {'short_messages':build_context('get_long_message',short_messages),
+         'user_ask':render_message(user_ask),'tags':tags})
+    logger.debug('长期记忆路由结果: %s', truncate(answer))
     if isinstance(answer, dict):
         tags=answer['tags']
+        tags=[tags] if isinstance(tags,str) else list(tags or [])
+        tags=[tag for tag in tags if tag]
         if tags:
-            user_ask=user_ask.content
-            long_messages[user_ask]=db.get_memory(state['user_id'],tags)
+            # 只取命中标签的记忆块里与询问最相关的片段，召回量与标签下记忆的总量无关
+            snippets=db.retrieve_snippets(state['user_id'],tags,user_ask.content,RECALL_ENTRY_TOKEN_BUDGET)
+            for tag in tags:
+                messages=[m for snippet in snippets if snippet['tag']==tag for m in snippet['messages']]
+                long_messages=recall_cache.remember(state['user_id'],long_messages,tag,user_ask.content,
+                                                    messages,state.get('talk_number',0))
     return {'long_messages': long_messages}
 
 agent = None
@@ -245,29 +279,34 @@ def get_agent_and_checkpointer():
     global agent, checkpointer
 
     if agent is None:
-        print("--- LAZY LOADING: Creating Agent and Checkpointer for the first time... ---")
+        logger.info("首次使用，创建 Agent 和 Checkpointer")
         workflow = StateGraph(State)
-        workflow.add_node(start_talk.__name__, start_talk)
-        workflow.add_node(generate_diary.__name__, generate_diary)
-        workflow.add_node(generate_dynamic_condition.__name__, generate_dynamic_condition)
-        workflow.add_node(generate_dynamic_condition_picture.__name__, generate_dynamic_condition_picture)
-        workflow.add_node(generate_talk.__name__, generate_talk)
-        workflow.add_node(generate_talk_picture.__name__, generate_talk_picture)
-        workflow.add_node(get_long_message.__name__, get_long_message)
-        workflow.add_node(op_memory.__name__, op_memory)
-        workflow.add_node(storage_memory_block.__name__, storage_memory_block)
+        workflow.add_node(start_talk.__name__, instrument_node(start_talk))
+        workflow.add_node(generate_diary.__name__, instrument_node(generate_diary))
+        workflow.add_node(generate_dynamic_condition.__name__, instrument_node(generate_dynamic_condition))
+        workflow.add_node(generate_dynamic_condition_picture.__name__, instrument_node(generate_dynamic_condition_picture))
+        workflow.add_node(generate_talk.__name__, instrument_node(generate_talk))
+        if not DEFER_TALK_PICTURE:
+            workflow.add_node(generate_talk_picture.__name__, instrument_node(generate_talk_picture))
+        workflow.add_node(get_long_message.__name__, instrument_node(get_long_message))
+        workflow.add_node(op_memory.__name__, instrument_node(op_memory))
+        workflow.add_node(storage_memory_block.__name__, instrument_node(storage_memory_block))
         workflow.add_edge(START, start_talk.__name__)
         workflow.add_conditional_edges(start_talk.__name__, jude_path)
         workflow.add_edge(get_long_message.__name__, generate_talk.__name__)
-        workflow.add_edge(generate_talk.__name__, generate_talk_picture.__name__)
-        workflow.add_edge(generate_talk_picture.__name__, op_memory.__name__)
+        if DEFER_TALK_PICTURE:
+            # 配图交给 talk_picture_worker 在后台完成，文字回复生成后直接整理记忆
+            workflow.add_edge(generate_talk.__name__, op_memory.__name__)
+        else:
+            workflow.add_edge(generate_talk.__name__, generate_talk_picture.__name__)
+            workflow.add_edge(generate_talk_picture.__name__, op_memory.__name__)
         workflow.add_edge(op_memory.__name__, END)
         workflow.add_edge(generate_diary.__name__, storage_memory_block.__name__)
         workflow.add_edge(generate_dynamic_condition.__name__, generate_dynamic_condition_picture.__name__)
         workflow.add_edge(generate_dynamic_condition_picture.__name__, storage_memory_block.__name__)
         workflow.add_edge(storage_memory_block.__name__, END)
-        checkpointer = MemorySaver()
+        checkpointer = BoundedSqliteSaver()
         agent = workflow.compile(checkpointer=checkpointer)  # Pass checkpointer correctly
-        print("--- LAZY LOADING: Agent and Checkpointer created. ---")
+        logger.info("Agent 和 Checkpointer 已创建")
 
     return agent, checkpointer
@@ -0,0 +1,60 @@
+# talk_picture_worker.py
+"""
+聊天配图的后台线程池。
+文字回复落库并发送 done 之后，配图判断与图片生成在这里异步完成，
+结果回写到 chat_history 中对应的那一行。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from base import TALK_PICTURE_WORKERS
+from generate_talks import decide_talk_picture, render_picture
+from get_character_full_data import SimpleDatabase, DB_FILE
+
+_executor = ThreadPoolExecutor(max_workers=TALK_PICTURE_WORKERS, thread_name_prefix='talk_picture')
+# message_id -> Future，任务结束后即移除，之后的状态以数据库为准
+_pending: dict[int, Future] = {}
+_pending_lock = threading.Lock()
+
+
+def _generate_and_attach(message_id: int, messages: list, db_file: str) -> str:
+    """判断是否需要配图，需要时生成图片并写回聊天记录，返回图片路径（无图片时为空字符串）。"""
+    path = ''
+    try:
+        prompt = decide_talk_picture(messages)
+        if prompt:
+            path, _ = render_picture(prompt)
+    finally:
+        # 无论成功与否都写回结果，'' 表示该消息确定没有配图
+        app_db = SimpleDatabase(db_file)
+        try:
+            app_db.update_chat_image(message_id, path)
+        finally:
+            app_db.close()
+    return path
+
+
+def submit_talk_picture(message_id: int, messages: list, db_file: str = DB_FILE) -> Future:
+    """
+    提交一条 AI 回复的配图任务。
+    :param message_id: 已存储的 AI 消息在 chat_history 中的 id。
+    :param messages: 短期记忆，只使用最后一条（即该 AI 回复）做判断。
+    :return: Future，结果为图片路径。
+    """
+    future = _executor.submit(_generate_and_attach, message_id, list(messages[-1:]), db_file)
+    with _pending_lock:
+        _pending[message_id] = future
+
+    def _forget(_):
+        with _pending_lock:
+            _pending.pop(message_id, None)
+
+    future.add_done_callback(_forget)
+    return future
+
+
+def is_picture_pending(message_id: int) -> bool:
+    """该消息的配图任务是否仍在进行中。"""
+    with _pending_lock:
+        future = _pending.get(message_id)
+    return future is not None and not future.done()
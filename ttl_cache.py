@@ -0,0 +1,65 @@
+# ttl_cache.py
+"""
+线程安全的进程内 TTL + LRU 缓存。
+
+用于请求热路径上读多写少的数据（令牌解码结果、用户、角色归属等）：
+条目在 ttl 秒后过期，超过 maxsize 时淘汰最久未使用的条目；数据变化时由调用方显式失效。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not _MISSING:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        """写入条目；ttl 为 None 时使用缓存的默认 TTL。"""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def values(self) -> list[Any]:
+        """未过期条目的值（快照），不影响 LRU 顺序和命中统计。"""
+        now = time.monotonic()
+        with self._lock:
+            return [value for expires, value in self._data.values() if expires > now]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}